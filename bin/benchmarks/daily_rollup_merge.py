@@ -0,0 +1,130 @@
+"""
+Runs the dailyadstats rollup in every mode against a local mongod & checks they agree:
+pulled into Python & upserted back (default mode), `$merge`d server-side, and incremental
+hour by hour. Also checks that a `$merge` fallback over an incrementally built day (as
+hourly_pipeline does when an incremental run fails) updates the same documents rather
+than adding new ones.
+
+Seeds a scratch database w/ one day of synthetic hourlyadstats, including defaults rows w/o
+advertiser & campaign, rolls it up into separate output collections, compares them document
+by document & reports timings. The scratch database is dropped afterwards unless --keep is
+passed. Needs MongoDB >= 4.2.
+
+Usage:
+    python bin/benchmarks/daily_rollup_merge.py [--host localhost] [--port 27017] [--rows 100000]
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+from time import time
+from pymongo import MongoClient
+from cliquesadmin.etl.mongo_etl import DailyMongoAggregationETL, IncrementalDailyMongoAggregationETL, \
+    AppliedHoursLedger
+from cliquesadmin.etl.query_templates.mongo.daily_ad_stats import daily_ad_stats_pipeline, \
+    DAILY_AD_STATS_UPDATE_KEYS, DAILY_AD_STATS_SUM_FIELDS, DAILY_AD_STATS_AVERAGE_FIELDS
+
+DAY = datetime(2016, 1, 1)
+METRICS = ['bids', 'imps', 'defaults', 'clearprice', 'clearprice_sum', 'clearprice_count', 'spend', 'clicks',
+           'view_convs', 'click_convs']
+
+
+def seed_hourlyadstats(collection, num_rows, num_combos=2000):
+    ids = ['%024x' % random.getrandbits(96) for _ in range(200)]
+    combos = [dict((k, random.choice(ids)) for k in DAILY_AD_STATS_UPDATE_KEYS if k != 'date')
+              for _ in range(num_combos)]
+    # defaults rows, which have no advertiser or campaign
+    for combo in combos[:num_combos // 10]:
+        del combo['advertiser'], combo['campaign']
+    docs = []
+    for _ in range(num_rows):
+        doc = dict(random.choice(combos))
+        doc['hour'] = DAY + timedelta(hours=random.randint(0, 23))
+        doc.update({
+            'bids': random.randint(0, 1000),
+            'imps': random.randint(0, 1000),
+            'defaults': random.randint(0, 10),
+            'clearprice': random.random() * 5,
+            'spend': random.random() * 10,
+            'clicks': random.randint(0, 10),
+            'view_convs': random.randint(0, 2),
+            'click_convs': random.randint(0, 2)
+        })
+        docs.append(doc)
+        if len(docs) == 10000:
+            collection.insert_many(docs)
+            docs = []
+    if docs:
+        collection.insert_many(docs)
+
+
+def run_rollup(db, output_name, merge):
+    etl = DailyMongoAggregationETL('date', daily_ad_stats_pipeline, db.hourlyadstats, db[output_name],
+                                   upsert=True, update_keys=DAILY_AD_STATS_UPDATE_KEYS, merge=merge)
+    start = time()
+    etl.run(start_datetime=DAY, end_datetime=DAY + timedelta(days=1))
+    return time() - start
+
+
+def run_incremental_rollup(db, output_name):
+    etl = IncrementalDailyMongoAggregationETL('date', daily_ad_stats_pipeline, db.hourlyadstats, db[output_name],
+                                              DAILY_AD_STATS_UPDATE_KEYS, DAILY_AD_STATS_SUM_FIELDS,
+                                              AppliedHoursLedger(db[output_name + '_applied_hours']),
+                                              average_fields=DAILY_AD_STATS_AVERAGE_FIELDS)
+    start = time()
+    etl.run(start_datetime=DAY, end_datetime=DAY + timedelta(days=1))
+    return time() - start
+
+
+def load_rollup(collection):
+    docs = {}
+    for doc in collection.find({}, {'_id': 0}):
+        key = tuple(doc.get(k) for k in DAILY_AD_STATS_UPDATE_KEYS)
+        assert key not in docs, 'Duplicate documents for %s in %s' % (key, collection.name)
+        docs[key] = doc
+    return docs
+
+
+def check_same(expected, actual, name):
+    assert set(expected) == set(actual), '%s rollup contains different documents' % name
+    for key, doc in expected.items():
+        for metric in METRICS:
+            # Python path stores null averages as NaN
+            a, b = [None if v != v else v for v in (doc.get(metric), actual[key].get(metric))]
+            assert (a is None and b is None) or abs(a - b) < 1e-6, \
+                '%s rollup mismatch in %s for %s' % (name, metric, key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares Python & $merge dailyadstats rollups on a local mongod')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', default='cliquesadmin_rollup_benchmark', help='scratch database, dropped first')
+    parser.add_argument('--rows', type=int, default=100000, help='hourlyadstats documents to seed')
+    parser.add_argument('--keep', action='store_true', help="don't drop scratch database afterwards")
+    args = parser.parse_args()
+
+    client = MongoClient(args.host, args.port)
+    client.drop_database(args.db)
+    db = client[args.db]
+    seed_hourlyadstats(db.hourlyadstats, args.rows)
+    db.hourlyadstats.create_index('hour')
+
+    upsert_time = run_rollup(db, 'dailyadstats_upsert', merge=False)
+    merge_time = run_rollup(db, 'dailyadstats_merge', merge=True)
+    incremental_time = run_incremental_rollup(db, 'dailyadstats_incremental')
+    # merge fallback over a day already built incrementally must land on the same documents
+    run_incremental_rollup(db, 'dailyadstats_fallback')
+    run_rollup(db, 'dailyadstats_fallback', merge=True)
+
+    merged = load_rollup(db.dailyadstats_merge)
+    assert any(key[1] == '' for key in merged), 'No defaults rows rolled up'
+    check_same(merged, load_rollup(db.dailyadstats_upsert), 'upsert')
+    check_same(merged, load_rollup(db.dailyadstats_incremental), 'incremental')
+    check_same(merged, load_rollup(db.dailyadstats_fallback), 'merge after incremental')
+
+    print('%s hourlyadstats rows rolled up into %s dailyadstats documents, results match' % (args.rows, len(merged)))
+    print('%12s %10.2fs' % ('upsert', upsert_time))
+    print('%12s %10.2fs (%.1fx)' % ('merge', merge_time, upsert_time / merge_time))
+    print('%12s %10.2fs (%.1fx)' % ('incremental', incremental_time, upsert_time / incremental_time))
+    if not args.keep:
+        client.drop_database(args.db)
@@ -0,0 +1,76 @@
+"""
+Benchmarks `BqMongoKeywordETL.transform`'s vectorized keyword splitting against the
+original `iterrows` / `set_value` loop on synthetic keywordadstats-shaped frames.
+
+Usage:
+    python bin/benchmarks/keyword_transform.py [--sizes 10000 50000 200000]
+"""
+import argparse
+import random
+from time import time
+import pandas as pd
+from cliquesadmin.etl.bigquery_etl import split_keywords
+
+KEYWORDS = ['keyword%s' % i for i in range(500)]
+
+
+def legacy_split_keywords(dataframe):
+    """
+    Original row-wise transform, kept here as the benchmark baseline.
+    """
+    for index, row in dataframe.iterrows():
+        if row['keywords']:
+            row['keywords'] = row['keywords'].split(',')
+        dataframe.set_value(index, 'keywords', row['keywords'])
+    return dataframe
+
+
+def make_keyword_frame(num_rows, null_fraction=0.05):
+    """
+    Builds a keywordadstats-shaped frame w/ 1-10 keywords per row, and a mix of
+    null & empty keyword strings.
+    """
+    keywords = []
+    for _ in range(num_rows):
+        r = random.random()
+        if r < null_fraction:
+            keywords.append(None)
+        elif r < 2 * null_fraction:
+            keywords.append('')
+        else:
+            keywords.append(','.join(random.sample(KEYWORDS, random.randint(1, 10))))
+    return pd.DataFrame({
+        'hour': pd.Timestamp('2016-01-01'),
+        'advertiser': ['%024x' % random.getrandbits(96) for _ in range(num_rows)],
+        'campaign': ['%024x' % random.getrandbits(96) for _ in range(num_rows)],
+        'keywords': keywords,
+        'imps': [random.randint(0, 1000) for _ in range(num_rows)],
+        'clicks': [random.randint(0, 10) for _ in range(num_rows)],
+    })
+
+
+def time_transform(transform, dataframe, repeat):
+    best = None
+    for _ in range(repeat):
+        df = dataframe.copy()
+        start = time()
+        df = transform(df)
+        elapsed = time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks keyword splitting transform')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 200000])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per transform & size, best is reported')
+    args = parser.parse_args()
+
+    print('%10s %18s %18s %8s' % ('rows', 'legacy rows/sec', 'vector rows/sec', 'speedup'))
+    for size in args.sizes:
+        frame = make_keyword_frame(size)
+        legacy_time, legacy_df = time_transform(legacy_split_keywords, frame, args.repeat)
+        vector_time, vector_df = time_transform(split_keywords, frame, args.repeat)
+        assert legacy_df['keywords'].tolist() == vector_df['keywords'].tolist()
+        print('%10d %18.0f %18.0f %7.1fx' % (size, size / legacy_time, size / vector_time,
+                                             legacy_time / vector_time))
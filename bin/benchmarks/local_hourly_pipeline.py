@@ -0,0 +1,119 @@
+"""
+Runs the whole hourly ad stats pipeline, BigQuery intermediates included, against an embedded
+sqlite stand-in for BigQuery (see `cliquesadmin.gce_utils.local_bigquery`) & a local mongod,
+then checks the loaded aggregates against counts taken straight from the synthetic events.
+
+Reports time spent in each step, summed over all hours. Step times are for sqlite, not BigQuery,
+so compare them between revisions of a template or ETL class rather than against production.
+The scratch database is dropped afterwards unless --keep is passed.
+
+Usage:
+    python bin/benchmarks/local_hourly_pipeline.py [--host localhost] [--port 27017] [--hours 3]
+        [--scale 5000] [--chunksize 1000] [--incremental-attribution]
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import time
+from pymongo import MongoClient
+from cliquesadmin.etl.scheduler import ETLScheduler
+from cliquesadmin.etl.hourly_pipeline import hourly_adstats_steps
+from cliquesadmin.gce_utils.local_bigquery import LocalBigQueryService, synthetic_ad_events, SYNTHETIC_INDEXES
+
+START = datetime(2018, 1, 1, 12)
+DATASET = 'ad_events'
+LOOKBACK = 30
+
+
+def expected_hourly_counts(events, start, hours):
+    """
+    Per-hour imps, clicks, defaults & conversions computed from raw synthetic events.
+    """
+    counts = defaultdict(lambda: defaultdict(int))
+    auctions = dict((a['impid'], a) for a in events['auctions'])
+    for imp in events['impressions']:
+        counts[auctions[imp['impid']]['tstamp'].replace(minute=0, second=0)]['imps'] += 1
+    for click in events['clicks']:
+        counts[auctions[click['impid']]['tstamp'].replace(minute=0, second=0)]['clicks'] += 1
+    for default in events['auction_defaults']:
+        counts[default['tstamp'].replace(minute=0, second=0)]['defaults'] += 1
+    touches = defaultdict(list)
+    for imp in events['impressions']:
+        touches[(imp['uuid'], imp['advertiser'])].append(imp['tstamp'])
+    for action in events['actions']:
+        matched = [t for t in touches[(action['uuid'], action['advertiser'])]
+                   if action['tstamp'] - timedelta(days=LOOKBACK) <= t <= action['tstamp']]
+        if matched:
+            counts[action['tstamp'].replace(minute=0, second=0)]['convs'] += 1
+    return dict((hour, counts[hour]) for hour in [start + timedelta(hours=h) for h in range(hours)])
+
+
+def loaded_hourly_counts(db, hour):
+    totals = defaultdict(int)
+    for doc in db.hourlyadstats.find({'hour': hour}):
+        for field in ('imps', 'clicks', 'defaults', 'view_convs', 'click_convs'):
+            totals[field] += doc.get(field) or 0
+    totals['convs'] = totals.pop('view_convs') + totals.pop('click_convs')
+    return totals
+
+
+def run_pipeline(service, db, hours, pricing='CPM', chunksize=None, incremental_attribution=False):
+    """
+    :return: dict of step name -> seconds spent, summed over all hours
+    """
+    step_times = defaultdict(float)
+    for h in range(hours):
+        start = START + timedelta(hours=h)
+        steps = hourly_adstats_steps(db, DATASET, start, start + timedelta(hours=1), pricing=pricing,
+                                     view_lookback=LOOKBACK, click_lookback=LOOKBACK, chunksize=chunksize,
+                                     service=service, incremental_attribution=incremental_attribution)
+        ETLScheduler(steps).run()
+        for step in steps:
+            step_times[step.name] += step.elapsed
+    return step_times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the hourly pipeline against a local BigQuery stand-in')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', default='cliquesadmin_local_pipeline', help='scratch database, dropped first')
+    parser.add_argument('--hours', type=int, default=3, help='hours of events to generate & run the pipeline for')
+    parser.add_argument('--scale', type=int, default=5000, help='auctions per hour')
+    parser.add_argument('--pricing', choices=['CPM', 'CPC'], default='CPM')
+    parser.add_argument('--chunksize', type=int, default=None, help='run MongoDB loads in streaming mode')
+    parser.add_argument('--incremental-attribution', action='store_true',
+                        help='match actions against last-touch state tables, built on the first hour')
+    parser.add_argument('--keep', action='store_true', help="don't drop scratch database afterwards")
+    args = parser.parse_args()
+
+    client = MongoClient(args.host, args.port)
+    client.drop_database(args.db)
+    db = client[args.db]
+
+    # events from an hour before the first pipeline hour, so auction_stats' wide window has data
+    events = synthetic_ad_events(START - timedelta(hours=1), hours=args.hours + 2, scale=args.scale)
+    service = LocalBigQueryService()
+    for table_id, rows in events.items():
+        service.load_rows(table_id, rows, indexes=SYNTHETIC_INDEXES.get(table_id))
+
+    started = time()
+    step_times = run_pipeline(service, db, args.hours, pricing=args.pricing, chunksize=args.chunksize,
+                              incremental_attribution=args.incremental_attribution)
+    elapsed = time() - started
+
+    expected = expected_hourly_counts(events, START, args.hours)
+    mismatches = 0
+    for hour, counts in sorted(expected.items()):
+        loaded = loaded_hourly_counts(db, hour)
+        for field in ('imps', 'clicks', 'defaults', 'convs'):
+            if loaded[field] != counts[field]:
+                mismatches += 1
+                print('MISMATCH %s %s: loaded %s, expected %s' % (hour, field, loaded[field], counts[field]))
+
+    print('%s hours x %s auctions run in %.2fs, %s' % (args.hours, args.scale, elapsed,
+                                                     'counts match' if not mismatches else '%s mismatches' % mismatches))
+    for name, seconds in sorted(step_times.items(), key=lambda item: -item[1]):
+        print('%25s %8.2fs' % (name, seconds))
+    if not args.keep:
+        client.drop_database(args.db)
@@ -0,0 +1,101 @@
+"""
+Benchmarks building MongoDB documents from a DataFrame with `iter_record_batches`
+against the original `to_dict(orient='records')` + per-cell Timestamp loop, on
+synthetic hourlyadstats-shaped frames.
+
+Each path & size runs in a fresh subprocess, so peak memory (max RSS growth over
+the frame itself) isn't polluted by the other path. Documents are discarded instead
+of inserted, so only document building is measured.
+
+Usage:
+    python bin/benchmarks/mongo_records.py [--sizes 100000 1000000] [--batch-size 5000]
+"""
+import sys
+import argparse
+import random
+import resource
+import subprocess
+from time import time
+import numpy as np
+import pandas as pd
+from cliquesadmin.etl.records import iter_record_batches, DEFAULT_BATCH_SIZE
+
+STRING_COLUMNS = ['publisher', 'site', 'page', 'placement', 'advertiser', 'campaign',
+                  'creativegroup', 'creative', 'pub_clique', 'adv_clique']
+INTEGER_COLUMNS = ['bids', 'imps', 'uniques', 'clicks', 'view_convs', 'click_convs']
+FLOAT_COLUMNS = ['clearprice', 'spend']
+
+
+def legacy_records(dataframe):
+    """
+    Original record building, kept here as the benchmark baseline.
+    """
+    records = dataframe.to_dict(orient='records')
+    for row in records:
+        for k in row:
+            if isinstance(row[k], pd.Timestamp):
+                row[k] = row[k].to_pydatetime()
+    return records
+
+
+def make_frame(num_rows):
+    ids = ['%024x' % random.getrandbits(96) for _ in range(1000)]
+    data = {'hour': pd.Timestamp('2016-01-01') + pd.to_timedelta(np.random.randint(0, 24, num_rows), unit='h')}
+    for c in STRING_COLUMNS:
+        data[c] = np.array(ids, dtype=object)[np.random.randint(0, len(ids), num_rows)]
+    for c in INTEGER_COLUMNS:
+        data[c] = np.random.randint(0, 10000, num_rows)
+    for c in FLOAT_COLUMNS:
+        data[c] = np.random.random(num_rows) * 10
+    return pd.DataFrame(data)
+
+
+def max_rss_kb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_worker(path, num_rows, batch_size):
+    """
+    Builds all documents for one path & prints `<seconds> <peak KB growth>`.
+    """
+    frame = make_frame(num_rows)
+    baseline = max_rss_kb()
+    start = time()
+    if path == 'legacy':
+        num_docs = len(legacy_records(frame))
+    else:
+        num_docs = 0
+        for batch in iter_record_batches(frame, batch_size=batch_size):
+            num_docs += len(batch)
+    elapsed = time() - start
+    assert num_docs == num_rows
+    print('%f %d' % (elapsed, max_rss_kb() - baseline))
+
+
+def run_in_subprocess(path, num_rows, batch_size):
+    out = subprocess.check_output([sys.executable, __file__, '--worker', path,
+                                   '--sizes', str(num_rows), '--batch-size', str(batch_size)])
+    elapsed, peak_kb = out.decode('utf-8').split()
+    return float(elapsed), int(peak_kb)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks DataFrame to MongoDB document conversion')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--worker', choices=['legacy', 'batched'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.sizes[0], args.batch_size)
+        sys.exit(0)
+
+    print('%10s %16s %16s %8s %14s %14s' % ('rows', 'legacy docs/sec', 'batched docs/sec', 'speedup',
+                                             'legacy peak MB', 'batched peak MB'))
+    for size in args.sizes:
+        legacy_time, legacy_kb = run_in_subprocess('legacy', size, args.batch_size)
+        batched_time, batched_kb = run_in_subprocess('batched', size, args.batch_size)
+        print('%10d %16.0f %16.0f %7.1fx %14.1f %14.1f' % (size, size / legacy_time, size / batched_time,
+                                                          legacy_time / batched_time,
+                                                          legacy_kb / 1024.0, batched_kb / 1024.0))
@@ -0,0 +1,109 @@
+"""
+Benchmarks `query_response_to_dataframe` against the original row-wise decoder
+on synthetic hourlyadstats-shaped `getQueryResults` responses.
+
+Usage:
+    python bin/benchmarks/query_response_decoder.py [--sizes 10000 100000 1000000]
+"""
+import argparse
+import random
+from time import time
+import numpy as np
+import pandas as pd
+from cliquesadmin.gce_utils.bigquery import query_response_to_dataframe, BQ_NP_TYPE_MAPPING
+
+SCHEMA = [
+    ('hour', 'TIMESTAMP'),
+    ('publisher', 'STRING'),
+    ('site', 'STRING'),
+    ('page', 'STRING'),
+    ('placement', 'STRING'),
+    ('advertiser', 'STRING'),
+    ('campaign', 'STRING'),
+    ('creativegroup', 'STRING'),
+    ('creative', 'STRING'),
+    ('pub_clique', 'STRING'),
+    ('adv_clique', 'STRING'),
+    ('clearprice', 'FLOAT'),
+    ('bids', 'INTEGER'),
+    ('imps', 'INTEGER'),
+    ('uniques', 'INTEGER'),
+    ('clicks', 'INTEGER'),
+    ('spend', 'FLOAT'),
+    ('view_convs', 'INTEGER'),
+    ('click_convs', 'INTEGER'),
+]
+
+
+def legacy_query_response_to_dataframe(query_response):
+    """
+    Original row-wise decoder, kept here as the benchmark baseline.
+    """
+    rows = [tuple(map(lambda field: field['v'], row['f']))
+            for row in query_response['rows']]
+    dtypes = []
+    tstamp_cols = []
+    for field in query_response['schema']['fields']:
+        dtype_tuple = (str(field['name']),
+                       BQ_NP_TYPE_MAPPING[field['type']])
+        dtypes.append(dtype_tuple)
+        if field['type'] == 'TIMESTAMP':
+            tstamp_cols.append(field['name'])
+    arr = np.array(rows, dtype=dtypes)
+    df = pd.DataFrame(arr)
+    for col in tstamp_cols:
+        df[col] = df[col].astype('datetime64[s]')
+    return df
+
+
+def random_cell(bq_type):
+    if bq_type == 'TIMESTAMP':
+        return '%.9E' % (1.5e9 + random.randint(0, 86400) * 3600)
+    if bq_type == 'STRING':
+        return '%024x' % random.getrandbits(96)
+    if bq_type == 'FLOAT':
+        return repr(random.random() * 10)
+    return str(random.randint(0, 10000))
+
+
+def make_query_response(num_rows):
+    """
+    Builds a `getQueryResults`-shaped response w/ `num_rows` random rows. Rows are
+    drawn from a pool of 1000 so building large responses stays quick.
+    """
+    pool = [{'f': [{'v': random_cell(t)} for _, t in SCHEMA]} for _ in range(1000)]
+    return {
+        'kind': 'bigquery#getQueryResultsResponse',
+        'schema': {'fields': [{'name': n, 'type': t, 'mode': 'NULLABLE'} for n, t in SCHEMA]},
+        'rows': [pool[i % len(pool)] for i in range(num_rows)],
+        'totalRows': str(num_rows),
+        'jobComplete': True
+    }
+
+
+def time_decoder(decoder, query_response, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time()
+        df = decoder(query_response)
+        elapsed = time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks BigQuery query response decoding')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per decoder & size, best is reported')
+    args = parser.parse_args()
+
+    print('%10s %18s %18s %8s' % ('rows', 'legacy rows/sec', 'columnar rows/sec', 'speedup'))
+    for size in args.sizes:
+        response = make_query_response(size)
+        legacy_time, legacy_df = time_decoder(legacy_query_response_to_dataframe, response, args.repeat)
+        columnar_time, columnar_df = time_decoder(query_response_to_dataframe, response, args.repeat)
+        # sanity check, TIMESTAMPs differ only in legacy truncating to the second
+        assert list(legacy_df.columns) == list(columnar_df.columns)
+        assert (legacy_df['imps'].values == columnar_df['imps'].values).all()
+        print('%10d %18.0f %18.0f %7.1fx' % (size, size / legacy_time, size / columnar_time,
+                                             legacy_time / columnar_time))
@@ -0,0 +1,81 @@
+"""
+Checks query result cache keys of the hourly pipeline's BigQuery templates are the same in
+every process, so reruns hit the cache entries an earlier run wrote. Keys for one hour are
+computed in two child processes, each w/ its own error callback as in production, and the
+check exits non-zero if any of them differ.
+
+Usage:
+    python bin/check_cache_keys.py [--hour "2017-11-09 13:00:00"]
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+from cliquesadmin import logger
+from cliquesadmin.jsonconfig import JsonConfigParser
+from cliquesadmin.misc_utils import datetimearg
+from cliquesadmin.gce_utils import get_service
+from cliquesadmin.gce_utils.bigquery import cliques_bq_settings
+from cliquesadmin.etl.bigquery_etl import BigQueryETL
+from cliquesadmin.etl.hourly_pipeline import hourly_template_vars
+from cliquesadmin.etl.query_cache import QueryResultCache
+
+config = JsonConfigParser()
+
+dataset = config.get('ETL', 'bigQuery', 'adEventDataset')
+view_lookback = config.get('ETL', 'action_lookback', 'view')
+click_lookback = config.get('ETL', 'action_lookback', 'click')
+pricing = config.get('Pricing')
+
+
+def cache_keys(hour):
+    """
+    Cache key of each hourly query for `hour`, as computed by this process.
+
+    :return: dict of step name -> key
+    """
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = QueryResultCache(cache_dir)
+        service = get_service(cliques_bq_settings)
+        keys = {}
+        queries = hourly_template_vars(dataset, hour, hour + timedelta(hours=1), pricing=pricing,
+                                       view_lookback=view_lookback, click_lookback=click_lookback)
+        for name, template_name, template_vars in queries:
+            etl = BigQueryETL(template_name, cliques_bq_settings, cache=cache, service=service)
+            template_vars = dict(template_vars, error_callback=lambda message: logger.error(message))
+            keys[name] = etl.cache_key(etl.render_template(**template_vars), **template_vars)
+        return keys
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks query result cache keys are stable across processes')
+    parser.add_argument('--hour', type=datetimearg,
+                        default=datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1),
+                        help='hour to render templates for, "%%Y-%%m-%%d %%H:%%M:%%S", default last full hour')
+    parser.add_argument('--print-keys', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.print_keys:
+        print(json.dumps(cache_keys(args.hour)))
+        sys.exit(0)
+
+    logger.info('Environment "%s" loaded' % os.environ.get('ENV', None))
+    command = [sys.executable, os.path.abspath(__file__), '--hour', args.hour.strftime('%Y-%m-%d %H:%M:%S'),
+               '--print-keys']
+    runs = [json.loads(subprocess.check_output(command).decode('utf-8').strip().splitlines()[-1])
+            for _ in range(2)]
+    unstable = sorted(name for name in runs[0] if runs[0][name] != runs[1].get(name))
+    for name in sorted(runs[0]):
+        logger.info('%35s: %s' % (name, runs[0][name]))
+    if unstable:
+        logger.error('Cache keys differ between processes for %s, reruns will never hit the cache'
+                     % ', '.join(unstable))
+        sys.exit(1)
+    logger.info('All %s cache keys are the same across processes.' % len(runs[0]))
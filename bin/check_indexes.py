@@ -0,0 +1,61 @@
+"""
+Reports missing & unused indexes on ETL target collections, and collection scans in the
+plans of the queries ETLs run against them. Pass --ensure to create missing indexes,
+including unique ones, which ETLs never build themselves. Duplicate keys are removed first,
+keeping the newest document of each, and null dailyadstats keys are set to '' to match what
+its rollups write. Recompute the days logged as having had duplicates afterwards.
+
+Usage:
+    python bin/check_indexes.py [--ensure]
+"""
+import os
+import argparse
+from pymongo import MongoClient
+from cliquesadmin import logger
+from cliquesadmin.jsonconfig import JsonConfigParser
+from cliquesadmin.etl.indexes import INDEX_SPECS, check_indexes, ensure_indexes, remove_duplicates
+
+config = JsonConfigParser()
+
+mongo_host = config.get('ETL', 'mongodb', 'host')
+mongo_port = config.get('ETL', 'mongodb', 'port')
+mongo_user = config.get('ETL', 'mongodb', 'user')
+mongo_pwd = config.get('ETL', 'mongodb', 'pwd')
+mongo_source_db = config.get('ETL', 'mongodb', 'db')
+
+client = MongoClient(mongo_host, mongo_port)
+if os.environ.get('ENV', None) != 'production':
+    destination_db = client.exchange_dev
+else:
+    destination_db = client.exchange
+destination_db.authenticate(mongo_user, mongo_pwd, source=mongo_source_db)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks indexes on ETL target collections')
+    parser.add_argument('--ensure', action='store_true', help='create any missing declared indexes first')
+    args = parser.parse_args()
+
+    logger.info('Checking indexes on %s' % destination_db.name)
+    if args.ensure:
+        for name, specs in INDEX_SPECS.items():
+            for spec in specs:
+                if not spec.get('unique'):
+                    continue
+                keys = [k for k, _ in spec['keys']]
+                # daily rollups store missing update keys as ''
+                missing_value = '' if name == 'dailyadstats' else None
+                duplicated = remove_duplicates(destination_db[name], keys, missing_value=missing_value)
+                dates = sorted(set(d['date'] for d in duplicated if d.get('date') is not None))
+                if dates:
+                    logger.warn('Removed duplicates from %s on %s, recompute these dates'
+                                % (name, ', '.join(str(d) for d in dates)))
+            ensure_indexes(destination_db[name], build_unique=True)
+    report = check_indexes(destination_db)
+    for name, keys in report['missing']:
+        logger.warn('MISSING index on %s: %s' % (name, keys))
+    for name, index_name in report['unused']:
+        logger.warn('UNUSED index on %s: %s' % (name, index_name))
+    for name, description in report['collscans']:
+        logger.warn('COLLSCAN on %s for %s' % (name, description))
+    if not any(report.values()):
+        logger.info('All declared indexes present & used, no collection scans found.')
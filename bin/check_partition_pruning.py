@@ -0,0 +1,73 @@
+"""
+Dry runs every BigQuery template of the hourly pipeline for one hour, once as rendered & once
+w/o the `_PARTITIONTIME` predicates from macros.sql, and reports bytes each would process.
+Dry runs are free & don't run the queries.
+
+Templates reading raw event tables should process a small fraction of what they would w/o
+partition predicates: a day or two of partitions for hourly windows, the lookback for
+attribution. Exits non-zero if any of them isn't pruned at all, e.g. because a new template
+filters raw tables w/o the macros.
+
+Usage:
+    python bin/check_partition_pruning.py [--hour "2017-11-09 13:00:00"]
+"""
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+from googleapiclient.errors import HttpError
+from cliquesadmin import logger
+from cliquesadmin.jsonconfig import JsonConfigParser
+from cliquesadmin.misc_utils import datetimearg
+from cliquesadmin.gce_utils import get_service
+from cliquesadmin.gce_utils.bigquery import cliques_bq_settings, dry_run_bytes
+from cliquesadmin.etl.bigquery_etl import jinja_bq_env
+from cliquesadmin.etl.hourly_pipeline import hourly_template_vars
+
+config = JsonConfigParser()
+
+dataset = config.get('ETL', 'bigQuery', 'adEventDataset')
+view_lookback = config.get('ETL', 'action_lookback', 'view')
+click_lookback = config.get('ETL', 'action_lookback', 'click')
+pricing = config.get('Pricing')
+
+
+def gigabytes(num_bytes):
+    return '%.2f GB' % (num_bytes / 1024.0 ** 3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks BigQuery templates prune raw event table partitions')
+    parser.add_argument('--hour', type=datetimearg,
+                        default=datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1),
+                        help='hour to render templates for, "%%Y-%%m-%%d %%H:%%M:%%S", default last full hour')
+    args = parser.parse_args()
+
+    logger.info('Environment "%s" loaded' % os.environ.get('ENV', None))
+    jobs = get_service(cliques_bq_settings).jobs()
+    not_pruned = []
+    queries = hourly_template_vars(dataset, args.hour, args.hour + timedelta(hours=1), pricing=pricing,
+                                   view_lookback=view_lookback, click_lookback=click_lookback)
+    for name, template_name, template_vars in queries:
+        template = jinja_bq_env.get_template(template_name)
+        pruned_query = template.render(**template_vars)
+        if '_PARTITIONTIME' not in pruned_query:
+            logger.info('%25s: reads no raw event tables' % name)
+            continue
+        try:
+            pruned = dry_run_bytes(jobs, cliques_bq_settings.PROJECT_ID, pruned_query)
+            unpruned = dry_run_bytes(jobs, cliques_bq_settings.PROJECT_ID,
+                                     template.render(prunePartitions=False, **template_vars))
+        except HttpError as e:
+            # e.g. touch state tables that don't exist yet
+            logger.warn('%25s: dry run failed, skipping: %s' % (name, e))
+            continue
+        logger.info('%25s: %s w/ partition predicates, %s w/o (%.1f%%)'
+                    % (name, gigabytes(pruned), gigabytes(unpruned), 100.0 * pruned / unpruned if unpruned else 100))
+        if unpruned and pruned >= unpruned:
+            not_pruned.append(name)
+
+    if not_pruned:
+        logger.error('Partition predicates prune nothing for %s' % ', '.join(not_pruned))
+        sys.exit(1)
+    logger.info('All templates reading raw event tables are pruned.')
@@ -0,0 +1,81 @@
+"""
+Converts existing BigQuery intermediate tables (auction_stats, hourly_imp_facts, imp_ &
+click_matched_actions) to the partitioning & clustering declared in
+`cliquesadmin.etl.hourly_pipeline.INTERMEDIATE_TABLE_LAYOUTS`. Until converted, the hourly ETL
+keeps appending to them unpartitioned, so every downstream query scans them in full.
+
+Each table is copied to `<table>_backup`, deleted & recreated from the backup w/ its layout.
+Tables are missing while being recreated, so pause the hourly ETL while this runs. Backups are
+kept unless --drop-backups is passed. Tables that are missing or already converted are skipped.
+
+Usage:
+    python bin/convert_intermediate_tables.py [--tables auction_stats,imp_matched_actions]
+        [--dry-run] [--drop-backups]
+"""
+import os
+import sys
+import argparse
+from cliquesadmin import logger
+from cliquesadmin.jsonconfig import JsonConfigParser
+from cliquesadmin.gce_utils import get_service
+from cliquesadmin.gce_utils.bigquery import cliques_bq_settings, get_table, has_layout, relayout_table, JobWaiter
+from cliquesadmin.etl.hourly_pipeline import INTERMEDIATE_TABLE_LAYOUTS
+
+config = JsonConfigParser()
+
+dataset = config.get('ETL', 'bigQuery', 'adEventDataset')
+job_deadline = config.get('ETL', 'bigQuery', 'jobDeadline')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts BigQuery intermediate tables to their '
+                                                 'partitioned & clustered layout')
+    parser.add_argument('--tables', type=lambda s: [t.strip() for t in s.split(',') if t.strip()],
+                        default=sorted(INTERMEDIATE_TABLE_LAYOUTS),
+                        help='comma-separated tables to convert, default all of %s'
+                             % ', '.join(sorted(INTERMEDIATE_TABLE_LAYOUTS)))
+    parser.add_argument('--dry-run', action='store_true', help='only report which tables need converting')
+    parser.add_argument('--drop-backups', action='store_true', help='drop each backup once its table is converted')
+    args = parser.parse_args()
+    unknown = [t for t in args.tables if t not in INTERMEDIATE_TABLE_LAYOUTS]
+    if unknown:
+        parser.error('no layout declared for %s' % ', '.join(unknown))
+
+    logger.info('Environment "%s" loaded' % os.environ.get('ENV', None))
+    project_id = cliques_bq_settings.PROJECT_ID
+    service = get_service(cliques_bq_settings)
+    job_waiter = JobWaiter(deadline=job_deadline)
+    failed = []
+    for table_id in args.tables:
+        layout = INTERMEDIATE_TABLE_LAYOUTS[table_id]
+        table = get_table(service.tables(), project_id, dataset, table_id)
+        if table is None:
+            logger.info('%s.%s does not exist yet, ETL will create it partitioned' % (dataset, table_id))
+            continue
+        if has_layout(table, layout):
+            logger.info('%s.%s already converted' % (dataset, table_id))
+            continue
+        if args.dry_run:
+            logger.info('%s.%s needs converting (%s rows, %s bytes)'
+                        % (dataset, table_id, table.get('numRows'), table.get('numBytes')))
+            continue
+        backup_table_id = '%s_backup' % table_id
+        try:
+            relayout_table(service, project_id, dataset, table_id, layout, job_waiter,
+                           backup_table_id=backup_table_id)
+        except Exception:
+            logger.exception('Converting %s.%s failed, check whether it still needs recreating from %s'
+                             % (dataset, table_id, backup_table_id))
+            failed.append(table_id)
+            continue
+        converted = get_table(service.tables(), project_id, dataset, table_id)
+        if converted.get('numRows') != table.get('numRows'):
+            logger.error('Converted %s.%s has %s rows rather than %s, keeping %s'
+                         % (dataset, table_id, converted.get('numRows'), table.get('numRows'), backup_table_id))
+            failed.append(table_id)
+            continue
+        logger.info('Converted %s.%s, %s rows' % (dataset, table_id, converted.get('numRows')))
+        if args.drop_backups:
+            service.tables().delete(projectId=project_id, datasetId=dataset, tableId=backup_table_id).execute()
+            logger.info('Dropped %s.%s' % (dataset, backup_table_id))
+    if failed:
+        sys.exit(1)
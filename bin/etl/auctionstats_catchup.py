@@ -1,15 +1,37 @@
 """
-!!!!!! DO NOT RUN THIS IN PRODUCTION !!!!!
-SHOULD ONLY BE RUN ON AN AS_NEEDED BASIS
+Backfills the hourly ad stats ETLs for a range of hours, using the same steps as
+bin/etl/hourlyadstats.py.
+
+--workers hours are run at once, each through its own `ETLScheduler` w/ the configured
+per-backend concurrency. BigQuery jobs run w/ BATCH priority by default, so they don't take
+interactive slots from the live hourly ETL. --steps picks which steps to run, e.g. to reload
+just hourlyadstats imps & clicks once auction_stats is already in place.
+
+Finished hours are recorded in --state-file, so rerunning the same command after an
+interruption picks up where it stopped. Each MongoDB-loading step deletes its documents for
+the hour before loading it, so hours which were partly loaded when they failed aren't
+duplicated by the rerun. If daily_rollup is one of the steps, it's run once per day at the
+end rather than after every hour, for each day whose hours all succeeded. Exits non-zero if
+any hour or daily rollup failed.
+
+Usage:
+    python bin/etl/auctionstats_catchup.py --start "2017-11-09 13:00:00" --end "2017-11-09 15:00:00"
+        [--workers 2] [--steps hourly_imps_clicks,hourly_actions] [--priority BATCH] [--state-file path]
 """
 
 from pymongo import MongoClient
 import os
-from datetime import datetime, timedelta
+import sys
+from datetime import timedelta
 from cliquesadmin import logger
-from cliquesadmin.pagerduty_utils import stacktrace_to_pd_event, create_pd_event_wrapper
+from cliquesadmin.pagerduty_utils import create_pd_event_wrapper
+from cliquesadmin.misc_utils import parse_hourly_backfill_args
 from cliquesadmin.jsonconfig import JsonConfigParser
-from cliquesadmin.gce_utils.bigquery import BigQueryMongoETL, cliques_bq_settings, BqMongoKeywordETL
+from cliquesadmin.etl.scheduler import ETLScheduler
+from cliquesadmin.etl.hourly_pipeline import hourly_adstats_steps, HOURLY_STEP_NAMES, DEFAULT_CONCURRENCY
+from cliquesadmin.etl.backfill import BackfillState, day_range, hour_range, partition, run_partitions
+from cliquesadmin.etl.query_cache import QueryResultCache
+from cliquesadmin.gce_utils.bigquery import JobWaiter
 
 config = JsonConfigParser()
 
@@ -19,6 +41,25 @@ mongo_user = config.get('ETL', 'mongodb', 'user')
 mongo_pwd = config.get('ETL', 'mongodb', 'pwd')
 mongo_source_db = config.get('ETL', 'mongodb', 'db')
 
+view_lookback = config.get('ETL', 'action_lookback', 'view')
+click_lookback = config.get('ETL', 'action_lookback', 'click')
+
+chunksize = config.get('ETL', 'chunksize')
+page_size = config.get('ETL', 'bigQuery', 'pageSize')
+num_readers = config.get('ETL', 'bigQuery', 'numReaders') or 1
+job_deadline = config.get('ETL', 'bigQuery', 'jobDeadline')
+writer_options = config.get('ETL', 'mongodb', 'writer')
+daily_mode = config.get('ETL', 'dailyMode') or 'upsert'
+concurrency = config.get('ETL', 'concurrency') or DEFAULT_CONCURRENCY
+
+cache_dir = config.get('ETL', 'cache', 'dir')
+if cache_dir:
+    query_cache = QueryResultCache(os.path.expanduser(cache_dir),
+                                   max_bytes=config.get('ETL', 'cache', 'maxBytes') or 2 * 1024 ** 3,
+                                   ttl=config.get('ETL', 'cache', 'ttl') or 7 * 24 * 3600)
+else:
+    query_cache = None
+
 pd_api_key = config.get('PagerDuty', 'api_key')
 pd_subdomain = config.get('PagerDuty', 'subdomain')
 pd_service_key = config.get('PagerDuty', 'service_key')
@@ -27,11 +68,8 @@ if os.environ.get('ENV', None) == 'production':
 else:
     pd_error_callback = None
 
-client = MongoClient(mongo_host, mongo_port)
-client.exchange.authenticate(mongo_user, mongo_pwd, source=mongo_source_db)
-
 # get dataset from config
-dataset = config.get('ETL', 'bigquery', 'adEventDataset')
+dataset = config.get('ETL', 'bigQuery', 'adEventDataset')
 
 client = MongoClient(mongo_host, mongo_port)
 if os.environ.get('ENV', None) != 'production':
@@ -40,160 +78,72 @@ else:
     destination_db = client.exchange
 destination_db.authenticate(mongo_user, mongo_pwd, source=mongo_source_db)
 
-GLOBAL_QUERY_OPTS = {
-    'destinationTable':
-        {
-            'datasetId': dataset,
-            'projectId': cliques_bq_settings.PROJECT_ID,
-        },
-        'createDisposition': 'CREATE_AS_NEEDED',
-        'writeDisposition': 'WRITE_APPEND'
-}
-name = 'Hourly Ad Stats Catchup'
+pricing = config.get('Pricing')
+job_waiter = JobWaiter(deadline=job_deadline)
 
-if __name__ == '__main__':
+name = 'HourlyAdStatsBackfill'
 
-    # args = parse_hourly_etl_args(name)
-    datetimes = [datetime(2017, 11, 9, h) for h in range(13, 15)] #for n in range(1,2)]
-    # datetimes += [datetime(2017, 3, 3, h) for h in range(0, 6)]
-
-    for dt in datetimes:
-        start = dt
-        end = dt + timedelta(hours=1)
-
-        logger.info('Beginning %s ETLs for interval %s to %s' % (name, start, end))
-
-        # Wrap whole thing in blanket exception handler to write to log
-        try:
-           # ##########################################
-           #  # LOAD IMP & CLICK AGGREGATES TO MONGODB #
-           #  ##########################################
-           #  HOURLY_ADSTAT_COLLECTION = destination_db.hourlyadstats
-           #  main_etl = BigQueryMongoETL('hourlyadstats/hourlyadstats_imps_clicks.sql', cliques_bq_settings, HOURLY_ADSTAT_COLLECTION)
-           #  logger.info('Now loading imps and clicks aggregates to MongoDB')
-           #  result = main_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-           #  if result is not None:
-           #      logger.info('Inserted %s documents into collection %s' %
-           #                  (len(result.inserted_ids), HOURLY_ADSTAT_COLLECTION.full_name))
-           #      logger.info('%s Primary ETL Complete' % name)
-           #  else:
-           #      logger.info('No rows to insert, Primary ETL complete.')
-           #
-           #  #####################################
-           #  # LOAD ACTION AGGREGATES TO MONGODB #
-           #  #####################################
-           #  actions_etl = BigQueryMongoETL('hourlyadstats/hourlyadstats_actions.sql', cliques_bq_settings, HOURLY_ADSTAT_COLLECTION)
-           #  logger.info('Now loading matched action aggregates to MongoDB')
-           #  result = actions_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-           #  if result is not None:
-           #      logger.info('Inserted %s documents into collection %s' %
-           #                  (len(result.inserted_ids), HOURLY_ADSTAT_COLLECTION.full_name))
-           #      logger.info('%s Actions ETL Complete' % name)
-           #  else:
-           #      logger.info('No rows to insert, Actions ETL complete.')
-           #
-           #  ##############################################
-           #  # LOAD DEFAULT AUCTION AGGREGATES TO MONGODB #
-           #  ##############################################
-           #  defaults_etl = BigQueryMongoETL('hourlyadstats/hourlyadstats_defaults.sql', cliques_bq_settings, HOURLY_ADSTAT_COLLECTION)
-           #  logger.info('Now loading auction default aggregates to MongoDB')
-           #  new_result = defaults_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-           #  if new_result is not None:
-           #      logger.info('Inserted %s documents into collection %s' %
-           #                  (len(new_result.inserted_ids), HOURLY_ADSTAT_COLLECTION.full_name))
-           #      logger.info('%s Auction Defaults ETL Complete' % name)
-           #  else:
-           #      logger.info('No rows to insert, Auction Defaults ETL complete.')
-           #
-           #  ##############################################
-           #  # LOAD GEO IMP & CLICK AGGREGATES TO MONGODB #
-           #  ##############################################
-           #  GEO_ADSTAT_COLLECTION = destination_db.geoadstats
-           #  geo_main_etl = BigQueryMongoETL('geoadstats/geoadstats_imps_clicks.sql', cliques_bq_settings,
-           #                                  GEO_ADSTAT_COLLECTION)
-           #  logger.info('Now loading GEO imps and clicks aggregates to MongoDB')
-           #  result = geo_main_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-           #  if result is not None:
-           #      logger.info('Inserted %s documents into collection %s' %
-           #                  (len(result.inserted_ids), GEO_ADSTAT_COLLECTION.full_name))
-           #      logger.info('%s Primary ETL Complete' % GEO_ADSTAT_COLLECTION.full_name)
-           #  else:
-           #      logger.info('No rows to insert, Geo Primary ETL complete.')
-           #
-           #  #########################################
-           #  # LOAD GEO ACTION AGGREGATES TO MONGODB #
-           #  #########################################
-           #  geo_actions_etl = BigQueryMongoETL('geoadstats/geoadstats_actions.sql', cliques_bq_settings,
-           #                                     GEO_ADSTAT_COLLECTION)
-           #  logger.info('Now loading GEO matched action aggregates to MongoDB')
-           #  result = geo_actions_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-           #  if result is not None:
-           #      logger.info('Inserted %s documents into collection %s' %
-           #                  (len(result.inserted_ids), GEO_ADSTAT_COLLECTION.full_name))
-           #      logger.info('%s Actions ETL Complete' % GEO_ADSTAT_COLLECTION.full_name)
-           #  else:
-           #      logger.info('No rows to insert, Geo Actions ETL complete.')
-           #
-           #  ##################################################
-           #  # LOAD GEO DEFAULT AUCTION AGGREGATES TO MONGODB #
-           #  ##################################################
-           #  geo_defaults_etl = BigQueryMongoETL('geoadstats/geoadstats_defaults.sql', cliques_bq_settings,
-           #                                      GEO_ADSTAT_COLLECTION)
-           #  logger.info('Now loading GEO auction default aggregates to MongoDB')
-           #  new_result = geo_defaults_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-           #  if new_result is not None:
-           #      logger.info('Inserted %s documents into collection %s' %
-           #                  (len(new_result.inserted_ids), GEO_ADSTAT_COLLECTION.full_name))
-           #      logger.info('%s Auction Defaults ETL Complete' % GEO_ADSTAT_COLLECTION.full_name)
-           #  else:
-           #      logger.info('No rows to insert, GEO Auction Defaults ETL complete.')
-
-            ###################################################
-            # LOAD KEYWORDS IMP & CLICK AGGREGATES TO MONGODB #
-            ###################################################
-            KEYWORD_ADSTAT_COLLECTION = destination_db.keywordadstats
-            keyword_main_etl = BqMongoKeywordETL('keywordadstats/keywordadstats_imps_clicks.sql', cliques_bq_settings,
-                                                KEYWORD_ADSTAT_COLLECTION)
-            logger.info('Now loading KEYWORD imps and clicks aggregates to MongoDB')
-            result = keyword_main_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-            if result is not None:
-                logger.info('Inserted %s documents into collection %s' %
-                            (len(result.inserted_ids), KEYWORD_ADSTAT_COLLECTION.full_name))
-                logger.info('%s Primary ETL Complete' % KEYWORD_ADSTAT_COLLECTION.full_name)
-            else:
-                logger.info('No rows to insert, Keyword Primary ETL complete.')
-
-            #############################################
-            # LOAD KEYWORD ACTION AGGREGATES TO MONGODB #
-            #############################################
-            keyword_actions_etl = BqMongoKeywordETL('keywordadstats/keywordadstats_actions.sql', cliques_bq_settings,
-                                                   KEYWORD_ADSTAT_COLLECTION)
-            logger.info('Now loading KEYWORD matched action aggregates to MongoDB')
-            result = keyword_actions_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-            if result is not None:
-                logger.info('Inserted %s documents into collection %s' %
-                            (len(result.inserted_ids), KEYWORD_ADSTAT_COLLECTION.full_name))
-                logger.info('%s Actions ETL Complete' % KEYWORD_ADSTAT_COLLECTION.full_name)
-            else:
-                logger.info('No rows to insert, Keyword Actions ETL complete.')
-
-            ######################################################
-            # LOAD KEYWORD DEFAULT AUCTION AGGREGATES TO MONGODB #
-            ######################################################
-            keyword_defaults_etl = BqMongoKeywordETL('keywordadstats/keywordadstats_defaults.sql', cliques_bq_settings,
-                                                    KEYWORD_ADSTAT_COLLECTION)
-            logger.info('Now loading KEYWORD auction default aggregates to MongoDB')
-            new_result = keyword_defaults_etl.run(start=start, end=end, dataset=dataset, error_callback=pd_error_callback)
-            if new_result is not None:
-                logger.info('Inserted %s documents into collection %s' %
-                            (len(new_result.inserted_ids), KEYWORD_ADSTAT_COLLECTION.full_name))
-                logger.info('%s Auction Defaults ETL Complete' % KEYWORD_ADSTAT_COLLECTION.full_name)
-            else:
-                logger.info('No rows to insert, KEYWORD Auction Defaults ETL complete.')
-
-        except:
-            # Trigger incident in PagerDuty, then write out to log file
-            if os.environ.get('ENV', None) == 'production':
-                stacktrace_to_pd_event(pd_subdomain, pd_api_key, pd_service_key)
-            logger.exception('Uncaught exception while running ETL!')
-            raise
\ No newline at end of file
+
+def run_steps(start, end, step_names, priority, bypass_cache):
+    steps = hourly_adstats_steps(destination_db, dataset, start, end,
+                                 pricing=pricing,
+                                 view_lookback=view_lookback,
+                                 click_lookback=click_lookback,
+                                 error_callback=pd_error_callback,
+                                 chunksize=chunksize,
+                                 page_size=page_size,
+                                 num_readers=num_readers,
+                                 job_waiter=job_waiter,
+                                 cache=query_cache,
+                                 cache_bypass=bypass_cache,
+                                 writer_options=writer_options,
+                                 daily_mode=daily_mode,
+                                 priority=priority,
+                                 step_names=step_names,
+                                 replace_rows=True)
+    return ETLScheduler(steps, concurrency=concurrency).run()
+
+
+if __name__ == '__main__':
+    args = parse_hourly_backfill_args(name, HOURLY_STEP_NAMES)
+    logger.info('Environment "%s" loaded' % os.environ.get('ENV', None))
+    step_names = args.steps or HOURLY_STEP_NAMES
+    # rolling up the whole day after each hour would just redo the same work, so do it once per day at the end
+    hourly_step_names = [s for s in step_names if s != 'daily_rollup']
+
+    state_file = args.state_file or os.path.expanduser(
+        '~/logs/%s_%s_%s.json' % (name, args.start.strftime('%Y%m%d%H'), args.end.strftime('%Y%m%d%H')))
+    state = BackfillState(state_file)
+    hours = state.pending(hour_range(args.start, args.end))
+    logger.info('Beginning %s for %s to (but not including) %s: %s hours left, steps %s, %s priority'
+                % (name, args.start, args.end, len(hours), ', '.join(step_names), args.priority))
+
+    failures = []
+    if hourly_step_names:
+        failures = run_partitions(partition(hours, 1),
+                                  lambda p: run_steps(p[0], p[0] + timedelta(hours=1), hourly_step_names,
+                                                      args.priority, args.bypass_cache),
+                                  workers=args.workers, state=state, unit_name='hours')
+
+    failed_rollups = []
+    if 'daily_rollup' in step_names:
+        failed_days = set(p[0].replace(hour=0) for p, _ in failures)
+        for day in day_range(args.start.replace(hour=0), args.end):
+            if day in failed_days:
+                logger.warn('Skipping daily rollup for %s, some of its hours failed' % day)
+                continue
+            try:
+                run_steps(day, day + timedelta(days=1), ['daily_rollup'], args.priority, args.bypass_cache)
+            except Exception:
+                logger.exception('Daily rollup for %s failed' % day)
+                failed_rollups.append(day)
+
+    if failures:
+        logger.error('%s hours failed, rerun the same command to retry them: %s'
+                     % (len(failures), ', '.join(str(p[0]) for p, _ in failures)))
+    if failed_rollups:
+        logger.error('%s daily rollups failed, rerun w/ --steps daily_rollup to retry them: %s'
+                     % (len(failed_rollups), ', '.join(str(d) for d in failed_rollups)))
+    if failures or failed_rollups:
+        sys.exit(1)
+    logger.info('%s complete.' % name)
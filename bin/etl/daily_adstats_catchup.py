@@ -1,15 +1,32 @@
 """
-!!!!!! DO NOT RUN THIS IN PRODUCTION !!!!!
-SHOULD ONLY BE RUN ON AN AS_NEEDED BASIS
+Rebuilds dailyadstats from hourlyadstats for a range of days.
+
+Days are split into partitions of --days-per-partition consecutive days, and --workers
+partitions are rolled up at once. With --single-pass each partition is rolled up by one
+aggregation grouped by day, rather than one aggregation per day. Finished days are recorded
+in --state-file, so rerunning the same command after an interruption picks up where it
+stopped.
+
+Results are upserted on DAILY_AD_STATS_UPDATE_KEYS, so rerunning days is safe. Exits non-zero
+if any partition failed.
+
+Usage:
+    python bin/etl/daily_adstats_catchup.py --start 2017-09-28 --end 2018-10-17 [--workers 4]
+        [--days-per-partition 7] [--single-pass] [--merge] [--chunksize 50000] [--state-file path]
 """
 
 from pymongo import MongoClient
 import os
+import sys
+from datetime import timedelta
 from cliquesadmin import logger
-from datetime import datetime, timedelta
+from cliquesadmin.misc_utils import parse_daily_backfill_args
 from cliquesadmin.jsonconfig import JsonConfigParser
-from cliquesadmin.etl.query_templates.mongo.daily_ad_stats import daily_ad_stats_pipeline
-from cliquesadmin.etl.mongo_etl import DailyMongoAggregationETL
+from cliquesadmin.etl.query_templates.mongo.daily_ad_stats import daily_ad_stats_pipeline, \
+    DAILY_AD_STATS_UPDATE_KEYS
+from cliquesadmin.etl.mongo_etl import DailyMongoAggregationETL, AppliedHoursLedger, mark_full_recompute
+from cliquesadmin.etl.hourly_pipeline import DAILY_LEDGER_COLLECTION
+from cliquesadmin.etl.backfill import BackfillState, day_range, partition, run_partitions
 
 config = JsonConfigParser()
 
@@ -19,8 +36,8 @@ mongo_user = config.get('ETL', 'mongodb', 'user')
 mongo_pwd = config.get('ETL', 'mongodb', 'pwd')
 mongo_source_db = config.get('ETL', 'mongodb', 'db')
 
-client = MongoClient(mongo_host, mongo_port)
-client.exchange.authenticate(mongo_user, mongo_pwd, source=mongo_source_db)
+writer_options = config.get('ETL', 'mongodb', 'writer')
+
 client = MongoClient(mongo_host, mongo_port)
 if os.environ.get('ENV', None) != 'production':
     destination_db = client.exchange_dev
@@ -30,29 +47,61 @@ destination_db.authenticate(mongo_user, mongo_pwd, source=mongo_source_db)
 
 name = 'DailyAdStatsCatchup'
 
+
+def backfill_days(days, single_pass=False, merge=False, chunksize=None):
+    """
+    Rolls up hourlyadstats into dailyadstats for a partition of consecutive days.
+
+    :param days: list of consecutive day datetimes
+    :param single_pass: roll up all days in one aggregation grouped by day
+    :param merge: `$merge` results server-side
+    :param chunksize: rows per chunk when loading from Python
+    """
+    input_collection = destination_db.hourlyadstats
+    etl = DailyMongoAggregationETL('date', daily_ad_stats_pipeline, input_collection,
+                                   destination_db.dailyadstats, upsert=True,
+                                   update_keys=DAILY_AD_STATS_UPDATE_KEYS, chunksize=chunksize,
+                                   writer_options=writer_options, merge=merge)
+    start = days[0]
+    end = days[-1] + timedelta(days=1)
+    if single_pass:
+        etl.run(start_datetime=start, end_datetime=end, by_day=True)
+    else:
+        for day in days:
+            etl.run(start_datetime=day, end_datetime=day + timedelta(days=1))
+    # these days are now a full recompute of their hours, so incremental runs mustn't re-add them
+    mark_full_recompute(AppliedHoursLedger(destination_db[DAILY_LEDGER_COLLECTION]), input_collection,
+                        start, end)
+
+
 if __name__ == '__main__':
+    args = parse_daily_backfill_args(name)
     logger.info('Environment "%s" loaded' % os.environ.get('ENV', None))
-    dt = datetime(2017, 9, 28, 0, 0, 0)
-    while dt < datetime(2018, 10, 17, 0, 0, 0):
-        start = dt
-        end = dt + timedelta(days=1)
-        logger.info('Beginning %s ETLs for interval %s to %s' % (name, start, end))
-        input_collection = destination_db.hourlyadstats
-        output_collection = destination_db.dailyadstats
-        update_keys = [
-            "date",
-            "advertiser",
-            "campaign",
-            "adv_clique",
-            "publisher",
-            "site",
-            "pub_clique"
-        ]
-        logger.info('Now inserting MongoDB DailyAdStats with aggregation results from HourlyAdStats...')
-        logger.info('Day interval is %s to (but not including) %s' % (start, end))
-        etl = DailyMongoAggregationETL('date', daily_ad_stats_pipeline, input_collection, output_collection,
-                                       upsert=False)
-        result = etl.run(start_datetime=start,
-                         end_datetime=end)
-        logger.info('DailyAdStats ETL complete.')
-        dt = end
+
+    state_file = args.state_file or os.path.expanduser(
+        '~/logs/%s_%s_%s.json' % (name, args.start.strftime('%Y%m%d'), args.end.strftime('%Y%m%d')))
+    state = BackfillState(state_file)
+    days = state.pending(day_range(args.start, args.end))
+    logger.info('Beginning %s for %s to (but not including) %s: %s days left to backfill'
+                % (name, args.start, args.end, len(days)))
+
+    # pending days may not be consecutive after a resume, so only partition runs of consecutive days
+    partitions = []
+    run = []
+    for day in days:
+        if run and (day - run[-1]).days != 1:
+            partitions.extend(partition(run, args.days_per_partition))
+            run = []
+        run.append(day)
+    if run:
+        partitions.extend(partition(run, args.days_per_partition))
+
+    failures = run_partitions(partitions,
+                              lambda p: backfill_days(p, single_pass=args.single_pass, merge=args.merge,
+                                                      chunksize=args.chunksize),
+                              workers=args.workers, state=state, unit_name='days')
+    if failures:
+        logger.error('%s partitions failed, rerun the same command to retry them: %s'
+                     % (len(failures), ', '.join('%s to %s' % (p[0], p[-1]) for p, _ in failures)))
+        sys.exit(1)
+    logger.info('%s complete.' % name)
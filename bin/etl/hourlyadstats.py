@@ -1,14 +1,14 @@
 from pymongo import MongoClient
 import os
 from cliquesadmin import logger
-from datetime import timedelta
 from cliquesadmin.pagerduty_utils import stacktrace_to_pd_event, create_pd_event_wrapper
 from cliquesadmin.misc_utils import parse_hourly_etl_args
 from cliquesadmin.jsonconfig import JsonConfigParser
-from cliquesadmin.etl.bigquery_etl import BigQueryMongoETL, BigQueryIntermediateETL, BqMongoKeywordETL
-from cliquesadmin.gce_utils.bigquery import cliques_bq_settings
-from cliquesadmin.etl.query_templates.mongo.daily_ad_stats import daily_ad_stats_pipeline
-from cliquesadmin.etl.mongo_etl import DailyMongoAggregationETL
+from cliquesadmin.etl.scheduler import ETLScheduler
+from cliquesadmin.etl.hourly_pipeline import hourly_adstats_steps, DEFAULT_CONCURRENCY
+from cliquesadmin.etl.query_cache import QueryResultCache
+from cliquesadmin.etl.scan_budget import ScanBudget
+from cliquesadmin.gce_utils.bigquery import JobWaiter
 
 config = JsonConfigParser()
 
@@ -21,6 +21,48 @@ mongo_source_db = config.get('ETL', 'mongodb', 'db')
 view_lookback = config.get('ETL', 'action_lookback', 'view')
 click_lookback = config.get('ETL', 'action_lookback', 'click')
 
+# rows per chunk for streaming BigQuery -> MongoDB loads, None loads each result in one go
+chunksize = config.get('ETL', 'chunksize')
+
+# BigQuery result paging, large results are read w/ num_readers parallel tabledata.list calls
+page_size = config.get('ETL', 'bigQuery', 'pageSize')
+num_readers = config.get('ETL', 'bigQuery', 'numReaders') or 1
+
+# max seconds to wait on any single BigQuery job before giving up, None waits forever
+job_deadline = config.get('ETL', 'bigQuery', 'jobDeadline')
+
+# local cache of BigQuery results, so reruns of the same hour skip BigQuery. Disabled if no dir set.
+cache_dir = config.get('ETL', 'cache', 'dir')
+if cache_dir:
+    query_cache = QueryResultCache(os.path.expanduser(cache_dir),
+                                   max_bytes=config.get('ETL', 'cache', 'maxBytes') or 2 * 1024 ** 3,
+                                   ttl=config.get('ETL', 'cache', 'ttl') or 7 * 24 * 3600)
+else:
+    query_cache = None
+
+# MongoWriter settings for all MongoDB loads, e.g. {"batch_size": 5000, "num_threads": 4,
+# "write_concern": {"w": 1, "j": false}}. Aggregates can always be rebuilt from BigQuery,
+# so relaxed journaling is fine here.
+writer_options = config.get('ETL', 'mongodb', 'writer')
+
+# how the dailyadstats rollup is written: 'upsert' (default), 'merge' (server-side, MongoDB >= 4.2)
+# or 'incremental' (only the hours just loaded, as $inc deltas)
+daily_mode = config.get('ETL', 'dailyMode') or 'upsert'
+
+# max number of steps running against each backend at once, e.g. {"bigquery": 4, "mongo": 3}
+concurrency = config.get('ETL', 'concurrency') or DEFAULT_CONCURRENCY
+
+# match actions against last-touch state tables kept up to date by each hourly run, rather than
+# rescanning the whole lookback of impressions & clicks. Falls back to the full scan whenever the
+# state isn't current to the hour being run.
+incremental_attribution = config.get('ETL', 'incrementalAttribution') or False
+
+# dry run every BigQuery query before running it & refuse (or run w/ BATCH priority, "onExceed": "batch")
+# any over budget, e.g. {"stepBytes": 50000000000, "runBytes": 200000000000, "onExceed": "refuse",
+# "pricePerTB": 5.0, "costTable": "~/logs/bigquery_costs.csv"}. Estimated & actual bytes per query are
+# logged after each run & appended to costTable if set. Disabled if not configured.
+scan_budget_config = config.get('ETL', 'bigQuery', 'budget')
+
 pd_api_key = config.get('PagerDuty', 'api_key')
 pd_subdomain = config.get('PagerDuty', 'subdomain')
 pd_service_key = config.get('PagerDuty', 'service_key')
@@ -39,16 +81,6 @@ else:
     destination_db = client.exchange
 destination_db.authenticate(mongo_user, mongo_pwd, source=mongo_source_db)
 
-GLOBAL_QUERY_OPTS = {
-    'destinationTable':
-        {
-            'datasetId': dataset,
-            'projectId': cliques_bq_settings.PROJECT_ID,
-        },
-        'createDisposition': 'CREATE_AS_NEEDED',
-        'writeDisposition': 'WRITE_APPEND',
-        'useLegacySQL': False
-}
 name = 'HourlyAdStats'
 
 if __name__ == '__main__':
@@ -67,230 +99,42 @@ if __name__ == '__main__':
     else:
         logger.info('Pricing structure set to %s, will calculate spend based on this metric.' % pricing)
 
+    if scan_budget_config is not None:
+        scan_budget = ScanBudget(step_bytes=scan_budget_config.get('stepBytes'),
+                                 run_bytes=scan_budget_config.get('runBytes'),
+                                 on_exceed=scan_budget_config.get('onExceed') or 'refuse',
+                                 price_per_tb=scan_budget_config.get('pricePerTB') or 5.0)
+    else:
+        scan_budget = None
+
     # Wrap whole thing in blanket exception handler to write to log
     try:
-        ###########################
-        # IMP_MATCHED_ACTIONS ETL #
-        ###########################
-        imp_matched_query_opts = GLOBAL_QUERY_OPTS
-
-        imp_matched_query_opts['destinationTable']['tableId'] = 'imp_matched_actions'
-        imp_matched_actions_etl = BigQueryIntermediateETL('intermediates/imp_matched_actions.sql',
-                                                          cliques_bq_settings,
-                                                          query_options=imp_matched_query_opts)
-        logger.info('Now matching imps to actions, storing in BigQuery')
-        imp_matched_result = imp_matched_actions_etl.run(start=args.start,
-                                                         end=args.end,
-                                                         dataset=dataset,
-                                                         error_callback=pd_error_callback,
-                                                         lookback=view_lookback)
-        logger.info('Done')
-
-        #############################
-        # CLICK_MATCHED_ACTIONS ETL #
-        #############################
-        click_matched_query_opts = GLOBAL_QUERY_OPTS
-        click_matched_query_opts['destinationTable']['tableId'] = 'click_matched_actions'
-        imp_matched_actions_etl = BigQueryIntermediateETL('intermediates/click_matched_actions.sql',
-                                                          cliques_bq_settings,
-                                                          query_options=click_matched_query_opts)
-        logger.info('Now matching clicks to actions, storing in BigQuery')
-        imp_matched_result = imp_matched_actions_etl.run(start=args.start,
-                                                         end=args.end,
-                                                         dataset=dataset,
-                                                         error_callback=pd_error_callback,
-                                                         lookback=click_lookback)
-        logger.info('Done')
-
-        #####################
-        # AUCTION_STATS ETL #
-        #####################
-        auction_query_opts = GLOBAL_QUERY_OPTS
-        auction_query_opts['destinationTable']['tableId'] = 'auction_stats'
-        auction_stats_etl = BigQueryIntermediateETL('intermediates/auction_stats.sql',
-                                                    cliques_bq_settings,
-                                                    query_options=auction_query_opts)
-        wideStart = args.start - timedelta(hours=1)
-        wideEnd = args.end + timedelta(hours=1)
-        logger.info('Now creating auction stats, containing bid density & clearprice')
-        auction_stats_result = auction_stats_etl.run(start=args.start,
-                                                     end=args.end,
-                                                     wideStart=wideStart,
-                                                     wideEnd=wideEnd,
-                                                     dataset=dataset,
-                                                     error_callback=pd_error_callback)
-        logger.info('Done')
-
-        #################################
-        # AUCTION_STATS DEFAULT ADS ETL #
-        #################################
-        auction_stats_defaults_etl = BigQueryIntermediateETL('intermediates/auction_stats_defaults.sql',
-                                                             cliques_bq_settings,
-                                                             query_options=auction_query_opts)
-
-        logger.info('Now creating auction stats for all errored auctions (i.e. auctions w/ no bids)')
-        auction_stats_defaults_result = auction_stats_defaults_etl.run(start=args.start,
-                                                                       end=args.end,
-                                                                       dataset=dataset,
-                                                                       error_callback=pd_error_callback)
-        logger.info('Done')
-
-        ##########################################
-        # LOAD IMP & CLICK AGGREGATES TO MONGODB #
-        ##########################################
-        HOURLY_ADSTAT_COLLECTION = destination_db.hourlyadstats
-        # Toggle query based on pricing config
-        HOURLY_ADSTAT_QUERY = 'hourlyadstats/hourlyadstats_imps_clicks_cpc.sql' if pricing == 'CPC' else \
-            'hourlyadstats/hourlyadstats_imps_clicks_cpm.sql'
-        main_etl = BigQueryMongoETL(HOURLY_ADSTAT_QUERY, cliques_bq_settings, HOURLY_ADSTAT_COLLECTION)
-        logger.info('Now loading imps and clicks aggregates to MongoDB')
-        result = main_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(result.inserted_ids), HOURLY_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Primary ETL Complete' % name)
-        else:
-            logger.info('No rows to insert, Primary ETL complete.')
-
-        #####################################
-        # LOAD ACTION AGGREGATES TO MONGODB #
-        #####################################
-        actions_etl = BigQueryMongoETL('hourlyadstats/hourlyadstats_actions.sql', cliques_bq_settings, HOURLY_ADSTAT_COLLECTION)
-        logger.info('Now loading matched action aggregates to MongoDB')
-        result = actions_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(result.inserted_ids), HOURLY_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Actions ETL Complete' % name)
-        else:
-            logger.info('No rows to insert, Actions ETL complete.')
-
-        ##############################################
-        # LOAD DEFAULT AUCTION AGGREGATES TO MONGODB #
-        ##############################################
-        defaults_etl = BigQueryMongoETL('hourlyadstats/hourlyadstats_defaults.sql', cliques_bq_settings, HOURLY_ADSTAT_COLLECTION)
-        logger.info('Now loading auction default aggregates to MongoDB')
-        new_result = defaults_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if new_result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(new_result.inserted_ids), HOURLY_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Auction Defaults ETL Complete' % name)
-        else:
-            logger.info('No rows to insert, Auction Defaults ETL complete.')
-
-        ##############################################
-        # LOAD GEO IMP & CLICK AGGREGATES TO MONGODB #
-        ##############################################
-        GEO_ADSTAT_COLLECTION = destination_db.geoadstats
-        GEO_ADSTAT_QUERY = 'geoadstats/geoadstats_imps_clicks_cpc.sql' if pricing == 'CPC' else \
-            'geoadstats/geoadstats_imps_clicks_cpm.sql'
-        geo_main_etl = BigQueryMongoETL(GEO_ADSTAT_QUERY, cliques_bq_settings,
-                                        GEO_ADSTAT_COLLECTION)
-        logger.info('Now loading GEO imps and clicks aggregates to MongoDB')
-        result = geo_main_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(result.inserted_ids), GEO_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Primary ETL Complete' % GEO_ADSTAT_COLLECTION.full_name)
-        else:
-            logger.info('No rows to insert, Geo Primary ETL complete.')
-
-        #########################################
-        # LOAD GEO ACTION AGGREGATES TO MONGODB #
-        #########################################
-        geo_actions_etl = BigQueryMongoETL('geoadstats/geoadstats_actions.sql', cliques_bq_settings,
-                                           GEO_ADSTAT_COLLECTION)
-        logger.info('Now loading GEO matched action aggregates to MongoDB')
-        result = geo_actions_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(result.inserted_ids), GEO_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Actions ETL Complete' % GEO_ADSTAT_COLLECTION.full_name)
-        else:
-            logger.info('No rows to insert, Geo Actions ETL complete.')
-
-        ##################################################
-        # LOAD GEO DEFAULT AUCTION AGGREGATES TO MONGODB #
-        ##################################################
-        geo_defaults_etl = BigQueryMongoETL('geoadstats/geoadstats_defaults.sql', cliques_bq_settings,
-                                            GEO_ADSTAT_COLLECTION)
-        logger.info('Now loading GEO auction default aggregates to MongoDB')
-        new_result = geo_defaults_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if new_result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(new_result.inserted_ids), GEO_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Auction Defaults ETL Complete' % GEO_ADSTAT_COLLECTION.full_name)
-        else:
-            logger.info('No rows to insert, GEO Auction Defaults ETL complete.')
-
-        ###################################################
-        # LOAD KEYWORDS IMP & CLICK AGGREGATES TO MONGODB #
-        ###################################################
-        KEYWORD_ADSTAT_COLLECTION = destination_db.keywordadstats
-        KEYWORD_ADSTAT_QUERY = 'keywordadstats/keywordadstats_imps_clicks_cpc.sql' if pricing == 'CPC' else \
-            'keywordadstats/keywordadstats_imps_clicks_cpm.sql'
-        keyword_main_etl = BqMongoKeywordETL(KEYWORD_ADSTAT_QUERY, cliques_bq_settings,
-                                             KEYWORD_ADSTAT_COLLECTION)
-        logger.info('Now loading KEYWORD imps and clicks aggregates to MongoDB')
-        result = keyword_main_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(result.inserted_ids), KEYWORD_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Primary ETL Complete' % KEYWORD_ADSTAT_COLLECTION.full_name)
-        else:
-            logger.info('No rows to insert, Keyword Primary ETL complete.')
-
-        #############################################
-        # LOAD KEYWORD ACTION AGGREGATES TO MONGODB #
-        #############################################
-        keyword_actions_etl = BqMongoKeywordETL('keywordadstats/keywordadstats_actions.sql', cliques_bq_settings,
-                                                KEYWORD_ADSTAT_COLLECTION)
-        logger.info('Now loading KEYWORD matched action aggregates to MongoDB')
-        result = keyword_actions_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(result.inserted_ids), KEYWORD_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Actions ETL Complete' % KEYWORD_ADSTAT_COLLECTION.full_name)
-        else:
-            logger.info('No rows to insert, Keyword Actions ETL complete.')
-
-        ##################################################
-        # LOAD KEYWORD DEFAULT AUCTION AGGREGATES TO MONGODB #
-        ##################################################
-        keyword_defaults_etl = BqMongoKeywordETL('keywordadstats/keywordadstats_defaults.sql', cliques_bq_settings,
-                                                 KEYWORD_ADSTAT_COLLECTION)
-        logger.info('Now loading KEYWORD auction default aggregates to MongoDB')
-        new_result = keyword_defaults_etl.run(start=args.start, end=args.end, dataset=dataset, error_callback=pd_error_callback)
-        if new_result is not None:
-            logger.info('Inserted %s documents into collection %s' %
-                        (len(new_result.inserted_ids), KEYWORD_ADSTAT_COLLECTION.full_name))
-            logger.info('%s Auction Defaults ETL Complete' % KEYWORD_ADSTAT_COLLECTION.full_name)
-        else:
-            logger.info('No rows to insert, KEYWORD Auction Defaults ETL complete.')
-
-        ########################################################
-        # POPULATE DAILYADSTATS FROM HOURLYADSTATS AGGREGATION #
-        ########################################################
-        input_collection = destination_db.hourlyadstats
-        output_collection = destination_db.dailyadstats
-        update_keys = [
-            "date",
-            "advertiser",
-            "campaign",
-            "adv_clique",
-            "publisher",
-            "site",
-            "pub_clique"
-        ]
-        daily_start = args.start.replace(hour=0, minute=0, second=0)
-        daily_end = daily_start + timedelta(days=1)
-        logger.info('Now upserting MongoDB DailyAdStats with aggregation results from HourlyAdStats...')
-        logger.info('Day interval is %s to (but not including) %s' % (daily_start, daily_end))
-        etl = DailyMongoAggregationETL('date', daily_ad_stats_pipeline, input_collection, output_collection,
-                                       upsert=True, update_keys=update_keys)
-        result = etl.run(start_datetime=daily_start,
-                         end_datetime=daily_end)
-        logger.info('DailyAdStats ETL complete.')
+        steps = hourly_adstats_steps(destination_db, dataset, args.start, args.end,
+                                     pricing=pricing,
+                                     view_lookback=view_lookback,
+                                     click_lookback=click_lookback,
+                                     error_callback=pd_error_callback,
+                                     chunksize=chunksize,
+                                     page_size=page_size,
+                                     num_readers=num_readers,
+                                     job_waiter=JobWaiter(deadline=job_deadline),
+                                     cache=query_cache,
+                                     cache_bypass=args.bypass_cache,
+                                     writer_options=writer_options,
+                                     daily_mode=daily_mode,
+                                     incremental_attribution=incremental_attribution,
+                                     scan_budget=scan_budget)
+        try:
+            ETLScheduler(steps, concurrency=concurrency).run()
+        finally:
+            # also on failure, so queries refused for going over budget show up
+            if scan_budget is not None:
+                scan_budget.log_cost_table(args.start)
+                if scan_budget_config.get('costTable'):
+                    scan_budget.write_cost_table(os.path.expanduser(scan_budget_config['costTable']), args.start)
+        logger.info('%s ETLs complete.' % name)
+        if query_cache is not None:
+            logger.info('Query result cache: %s hits, %s misses' % (query_cache.hits, query_cache.misses))
     except:
         # Trigger incident in PagerDuty, then write out to log file
         if os.environ.get('ENV', None) == 'production':
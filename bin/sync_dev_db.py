@@ -49,6 +49,7 @@ from cliquesadmin import logger
 from pymongo import MongoClient, DESCENDING
 from cliquesadmin.pagerduty_utils import stacktrace_to_pd_event
 from cliquesadmin.jsonconfig import JsonConfigParser
+from cliquesadmin.etl.indexes import copy_indexes, ensure_indexes
 
 config = JsonConfigParser()
 
@@ -83,6 +84,19 @@ def insert_to_dev_from_cursor(curs, collection):
     logger.info('DONE. %s documents inserted into exchange_dev.%s' % (len(results.inserted_ids), collection))
 
 
+def recreate_indexes(collection):
+    """
+    Dropping a dev collection drops its indexes too, so copy prod's back over & make sure
+    any declared ETL indexes exist.
+
+    :param collection: collection name
+    :return:
+    """
+    created = copy_indexes(client.exchange[collection], client.exchange_dev[collection])
+    ensure_indexes(client.exchange_dev[collection])
+    logger.info('Recreated %s indexes on exchange_dev.%s' % (len(created), collection))
+
+
 if __name__ == '__main__':
 
     logger.info('============ BEGIN Prod to Dev MongoDB Sync ===========')
@@ -98,6 +112,7 @@ if __name__ == '__main__':
             cursor = client.exchange[col].find()
             if cursor.count():
                 insert_to_dev_from_cursor(cursor, col)
+                recreate_indexes(col)
             else:
                 logger.info('Prod collection %s is empty, skipping...' % col)
         logger.info(' ============= DONE syncing SYNC collections ============= ')
@@ -113,6 +128,7 @@ if __name__ == '__main__':
             cursor = client.exchange[col[0]].find(sort=[(col[1], DESCENDING)], limit=AGGREGATES_LIMIT)
             if cursor.count():
                 insert_to_dev_from_cursor(cursor, col[0])
+                recreate_indexes(col[0])
             else:
                 logger.info('Prod collection %s is empty, skipping...' % col[0])
         logger.info(' ============= DONE syncing AGGREGATES collections ============= ')
@@ -1,13 +1,19 @@
-
 class ETL(object):
     """
     Abstract class to provide scaffolding for ETL subclasses. Basically just outlines order
     of operations. All application-specific logic should be written into subclass methods.
 
     Whole process can be accessed via the `ETL.run` method
+
+    :param query_options: options passed along to the query, interpreted by subclasses.
+    :param chunksize: If set, `run` operates in streaming mode: `extract_chunks` yields DataFrames
+        of at most this many rows and each one is transformed & loaded before the next is pulled,
+        so memory use is bounded by the chunk size rather than by the size of the extract.
+        Default is None, i.e. extract, transform & load everything in one go.
     """
-    def __init__(self, query_options=None):
+    def __init__(self, query_options=None, chunksize=None):
         self.query_options = query_options
+        self.chunksize = chunksize
 
     def run_query(self, **kwargs):
         """
@@ -29,6 +35,21 @@ class ETL(object):
         query_response = self.run_query(**kwargs)
         return query_response
 
+    def extract_chunks(self, **kwargs):
+        """
+        Generator version of `extract` used in streaming mode, yielding DataFrames
+        of at most `self.chunksize` rows.
+
+        Base class just yields the whole extract as a single chunk, subclasses which
+        can page through their source should override this.
+
+        :param kwargs: all kwargs passed directly into template as template vars
+        :return:
+        """
+        dataframe = self.extract(**kwargs)
+        if dataframe is not None:
+            yield dataframe
+
     def transform(self, dataframe):
         """
         Hook for subclasses to do any necessary transformation
@@ -51,11 +72,44 @@ class ETL(object):
         """
         return dataframe
 
+    def combine_load_results(self, results):
+        """
+        Hook for subclasses to merge the `load` results of each chunk in streaming
+        mode into a single result, so callers get the same kind of object back
+        from `run` regardless of mode.
+
+        Base class just returns the list of per-chunk results.
+
+        :param results: list of results returned by `load`, one per chunk
+        :return:
+        """
+        return results
+
     def run(self, **kwargs):
+        if self.chunksize:
+            return self.run_chunked(**kwargs)
         dataframe = self.extract(**kwargs)
         if dataframe is not None:
             dataframe = self.transform(dataframe)
             result = self.load(dataframe)
             return result
         else:
-            return None
\ No newline at end of file
+            return None
+
+    def run_chunked(self, **kwargs):
+        """
+        Streaming version of `run`. Pulls one chunk at a time from `extract_chunks`
+        and pushes it through `transform` & `load` before pulling the next one.
+
+        :param kwargs: all kwargs passed directly into template as template vars
+        :return: combined result of all `load` calls, or None if nothing was extracted
+        """
+        results = []
+        for chunk in self.extract_chunks(**kwargs):
+            if chunk.empty:
+                continue
+            chunk = self.transform(chunk)
+            results.append(self.load(chunk))
+        if not results:
+            return None
+        return self.combine_load_results(results)
@@ -0,0 +1,166 @@
+"""
+Helpers for backfill commands: splitting a range into partitions, running partitions on a
+pool of worker threads, and recording finished units so an interrupted backfill resumes
+where it stopped.
+"""
+import os
+import sys
+import json
+import logging
+import threading
+from datetime import timedelta
+from time import time
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+
+def datetime_range(start, end, step):
+    """
+    :return: list of datetimes from start (inclusive) to end (exclusive) every `step`
+    """
+    datetimes = []
+    dt = start
+    while dt < end:
+        datetimes.append(dt)
+        dt += step
+    return datetimes
+
+
+def day_range(start, end):
+    return datetime_range(start, end, timedelta(days=1))
+
+
+def hour_range(start, end):
+    return datetime_range(start, end, timedelta(hours=1))
+
+
+def partition(items, size):
+    """
+    Splits items into consecutive lists of at most `size` items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class BackfillState(object):
+    """
+    Finished backfill units (e.g. days or hours) persisted to a JSON file, rewritten
+    atomically each time a unit is marked done. Thread-safe.
+
+    :param path: path of state file, created if it doesn't exist
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = set(json.load(f).get('done', []))
+            logger.info('Loaded backfill state from %s, %s units already done' % (path, len(self.done)))
+
+    @staticmethod
+    def key(unit):
+        return unit.isoformat() if hasattr(unit, 'isoformat') else str(unit)
+
+    def is_done(self, unit):
+        return self.key(unit) in self.done
+
+    def pending(self, units):
+        """
+        :return: units not yet marked done, in order
+        """
+        return [u for u in units if not self.is_done(u)]
+
+    def mark_done(self, units):
+        with self._lock:
+            self.done.update(self.key(u) for u in units)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp_path = '%s.tmp-%s' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({'done': sorted(self.done)}, f, indent=2)
+            os.rename(tmp_path, self.path)
+
+
+class BackfillStats(object):
+    """
+    Counts finished & failed units & logs progress w/ throughput.
+    """
+    def __init__(self, total_units, unit_name='units'):
+        self.total_units = total_units
+        self.unit_name = unit_name
+        self.done_units = 0
+        self.failed_units = 0
+        self.start = time()
+        self._lock = threading.Lock()
+
+    def record(self, num_units, failed=False):
+        with self._lock:
+            if failed:
+                self.failed_units += num_units
+            else:
+                self.done_units += num_units
+            logger.info('Backfill progress: %s/%s %s done, %s failed, %.1f %s/hour'
+                        % (self.done_units, self.total_units, self.unit_name, self.failed_units,
+                           self.rate, self.unit_name))
+
+    @property
+    def rate(self):
+        elapsed = time() - self.start
+        return self.done_units / elapsed * 3600 if elapsed else 0.0
+
+    def summary(self):
+        elapsed = time() - self.start
+        return 'Backfill finished in %.1fs: %s/%s %s done, %s failed, %.1f %s/hour' \
+               % (elapsed, self.done_units, self.total_units, self.unit_name, self.failed_units,
+                  self.rate, self.unit_name)
+
+
+def run_partitions(partitions, func, workers=1, state=None, unit_name='units'):
+    """
+    Runs `func(partition)` for each partition on `workers` threads. Once a partition's `func`
+    returns, all of its units are marked done in `state`. A failed partition is logged & left
+    pending, the rest keep going.
+
+    :param partitions: list of lists of units, see `partition`
+    :param func: callable taking a list of units
+    :param workers: number of partitions run at once
+    :param state: `BackfillState`, or None to not record progress
+    :param unit_name: name of units for log messages, e.g. 'days'
+    :return: list of (partition, exc_info) for failed partitions
+    """
+    stats = BackfillStats(sum(len(p) for p in partitions), unit_name)
+    work = queue.Queue()
+    for p in partitions:
+        work.put(p)
+    failures = []
+
+    def worker():
+        while True:
+            try:
+                p = work.get_nowait()
+            except queue.Empty:
+                return
+            label = '%s to %s' % (p[0], p[-1]) if len(p) > 1 else str(p[0])
+            try:
+                logger.info('Starting backfill of %s' % label)
+                func(p)
+            except Exception:
+                logger.exception('Backfill of %s failed' % label)
+                failures.append((p, sys.exc_info()))
+                stats.record(len(p), failed=True)
+                continue
+            if state is not None:
+                state.mark_done(p)
+            stats.record(len(p))
+
+    threads = [threading.Thread(target=worker, name='backfill-%s' % i)
+               for i in range(min(workers, len(partitions)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    logger.info(stats.summary())
+    return failures
@@ -1,16 +1,41 @@
+import re
 import logging
-from time import sleep
 import pandas as pd
 from jinja2 import Environment, PackageLoader
 from datetime import datetime
-from cliquesadmin.gce_utils import authenticate_and_build_jwt_client
+from cliquesadmin.gce_utils import get_service
 from cliquesadmin.etl import ETL
-from cliquesadmin.gce_utils.bigquery import query_response_to_dataframe
+from cliquesadmin.etl.indexes import ensure_indexes
+from cliquesadmin.etl.mongo_writer import MongoWriter, merge_insert_many_results
+from googleapiclient.errors import HttpError
+from cliquesadmin.gce_utils.bigquery import query_response_to_dataframe, read_table_rows_parallel, JobWaiter, \
+    make_job_id, insert_or_reuse_job, find_reusable_job, dry_run_bytes
 
 logger = logging.getLogger(__name__)
 
 jinja_bq_env = Environment(loader=PackageLoader('cliquesadmin', 'etl/query_templates/bigquery'))
 
+# query options which don't change a query's results, so are left out of cache keys & job IDs.
+# E.g. a backfill's BATCH priority job can reuse the results of the live INTERACTIVE one.
+RESULT_NEUTRAL_OPTIONS = ('query', 'priority')
+
+
+def split_keywords(dataframe, column='keywords'):
+    """
+    Splits comma separated keyword strings in `column` into lists of keywords, in place.
+    Nulls & empty strings are left as they are.
+
+    :param dataframe: DataFrame w/ `column`
+    :param column: name of keywords column
+    :return: dataframe
+    """
+    if dataframe.empty:
+        return dataframe
+    keywords = dataframe[column]
+    has_keywords = keywords.notnull() & (keywords != '')
+    dataframe[column] = keywords.str.split(',').where(has_keywords, keywords)
+    return dataframe
+
 
 class BigQueryETL(ETL):
     """
@@ -25,12 +50,57 @@ class BigQueryETL(ETL):
 
     Base class doesn't transform resulting data at all but provides
     hook for custom subclasses to perform their own custom transforms
+
+    If `chunksize` is set, `run` streams the result one page of `chunksize` rows
+    at a time (see `ETL.run_chunked`). Otherwise the whole result is retrieved,
+    following `pageToken`, or when `num_readers` > 1 by reading the query's
+    destination table with parallel `tabledata.list` calls.
+
+    :param page_size: max rows per results page, default lets BigQuery decide. Required
+        if `num_readers` > 1.
+    :param num_readers: number of threads reading result pages in parallel
+    :param job_waiter: `JobWaiter` used to wait on BigQuery jobs, default long-polls w/ no deadline
+    :param cache: optional `QueryResultCache`. Results of previous runs of the same rendered
+        query & options are read from it instead of querying BigQuery again.
+    :param cache_bypass: If True, always query BigQuery, but still refresh the cache entry.
+    :param reuse_jobs: If True (default), jobs get deterministic IDs derived from the template,
+        its vars & the query options, and a rerun picks up the existing job (& its results or
+        destination table) instead of running the query again. Set False to force a rerun,
+        e.g. after raw event data has been corrected.
+    :param service: BigQuery API service to run queries with instead of one built from
+        `gce_settings`, e.g. a `cliquesadmin.gce_utils.local_bigquery.LocalBigQueryService`
+    :param scan_budget: optional `ScanBudget`. Each query is dry run first & checked against it,
+        which may refuse it or downgrade it to BATCH priority, and its bytes are recorded in the
+        budget's cost table.
     """
-    def __init__(self, template, gce_settings, query_options=None):
+    # whether results of this ETL's queries can be served from a QueryResultCache
+    cacheable = True
+
+    def __init__(self, template, gce_settings, query_options=None, chunksize=None,
+                 page_size=None, num_readers=1, job_waiter=None, cache=None, cache_bypass=False,
+                 reuse_jobs=True, service=None, scan_budget=None):
         self.gce_settings = gce_settings
-        self.gce_service = authenticate_and_build_jwt_client(gce_settings)
+        self.service = service
+        self.scan_budget = scan_budget
+        self.reuse_jobs = reuse_jobs
+        self.job_waiter = job_waiter or JobWaiter()
+        self.cache = cache if self.cacheable else None
+        self.cache_bypass = cache_bypass
+        self.gce_service = self.build_service()
         self.template = jinja_bq_env.get_template(template)
-        super(BigQueryETL, self).__init__(query_options=query_options)
+        self.page_size = page_size
+        self.num_readers = num_readers
+        if num_readers > 1 and not page_size:
+            raise ValueError('page_size must be set to read pages with num_readers > 1')
+        super(BigQueryETL, self).__init__(query_options=query_options, chunksize=chunksize)
+
+    def build_service(self):
+        """
+        BigQuery API service for the calling thread, `self.service` if one was passed in.
+        """
+        if self.service is not None:
+            return self.service
+        return get_service(self.gce_settings)
 
     def run_query(self, rendered_template, query_request, error_callback=None, **kwargs):
         """
@@ -41,23 +111,25 @@ class BigQueryETL(ETL):
         """
         # TODO: This isn't a comprehensive parsing of query options
         if self.query_options is not None:
-            # Need to use 'insert' method if destinationTable is specified
-            query_data = self.query_options
+            # Need to use 'insert' method if destinationTable is specified.
+            # Copy options, they may be shared between ETLs running concurrently.
+            query_data = dict(self.query_options)
             query_data['query'] = rendered_template
         else:
             query_data = {'query': rendered_template}
         query_data = {'configuration': {'query': query_data}}
 
-        # Insert job and then wait for it to be complete
-        job_response = query_request.insert(projectId=self.gce_settings.PROJECT_ID,
-                                            body=query_data).execute()
-        query_response = query_request.getQueryResults(projectId=self.gce_settings.PROJECT_ID,
-                                                       jobId=job_response['jobReference']['jobId']).execute()
+        # In streaming mode only ask for the first chunk, rest is paged in by `extract_chunks`
+        results_kwargs = {}
+        if self.chunksize or self.page_size:
+            results_kwargs['maxResults'] = self.chunksize or self.page_size
 
-        while not query_response['jobComplete']:
-            query_response = query_request.getQueryResults(projectId=self.gce_settings.PROJECT_ID,
-                                                           jobId=job_response['jobReference']['jobId']).execute()
-            sleep(1)
+        # Insert job and then wait for it to be complete
+        budget_entry = self.preflight(query_request, query_data, rendered_template, **kwargs)
+        job_response = self.insert_job(query_request, query_data, rendered_template, **kwargs)
+        query_response = self.job_waiter.wait_for_query_results(query_request, self.gce_settings.PROJECT_ID,
+                                                                 job_response['jobReference']['jobId'],
+                                                                 **results_kwargs)
 
         # Handle any errors in job
         if query_response.has_key('errors'):
@@ -70,23 +142,182 @@ class BigQueryETL(ETL):
         logger.info('Query completed, %s rows returned by jobId %s' %
                     (query_response['totalRows'],
                      query_response['jobReference']['jobId']))
+        if 'totalBytesProcessed' in query_response:
+            logger.info('totalBytesProcessed: %s ' % query_response['totalBytesProcessed'])
+            logger.info('cacheHit: %s ' % query_response.get('cacheHit'))
+            self.record_scan(budget_entry, query_response['totalBytesProcessed'], query_response.get('cacheHit'))
+        if not self.chunksize and 'errors' not in query_response:
+            query_response = self.fetch_remaining_rows(query_response, query_request)
         return query_response
 
-    def extract(self, **kwargs):
+    def fetch_remaining_rows(self, query_response, query_request):
         """
-        Run BigQuery query and load response into dataframe
+        Retrieves all rows of a completed query beyond the first page of `query_response`
+        and adds them to its `rows`, so no rows are dropped on large results.
+
+        :param query_response: first `getQueryResults` response of a completed job
+        :param query_request: BigQuery jobs resource
+        :return: `query_response` holding all rows
+        """
+        total_rows = int(query_response['totalRows'])
+        rows = query_response.get('rows', [])
+        if len(rows) >= total_rows:
+            return query_response
+
+        job_reference = query_response['jobReference']
+        if self.num_readers > 1:
+            job = query_request.get(projectId=job_reference['projectId'],
+                                    jobId=job_reference['jobId']).execute()
+            table_ref = job['configuration']['query']['destinationTable']
+            logger.info('Reading remaining %s rows of jobId %s from %s with %s parallel readers' %
+                        (total_rows - len(rows), job_reference['jobId'], table_ref['tableId'], self.num_readers))
+            rows.extend(read_table_rows_parallel(self.build_service,
+                                                 table_ref, len(rows), total_rows,
+                                                 self.page_size, self.num_readers))
+        else:
+            page_token = query_response.get('pageToken')
+            while page_token:
+                page = query_request.getQueryResults(projectId=job_reference['projectId'],
+                                                     jobId=job_reference['jobId'],
+                                                     pageToken=page_token,
+                                                     maxResults=self.page_size).execute()
+                rows.extend(page.get('rows', []))
+                page_token = page.get('pageToken')
+
+        query_response['rows'] = rows
+        query_response.pop('pageToken', None)
+        logger.info('Retrieved all %s rows of jobId %s' % (len(rows), job_reference['jobId']))
+        return query_response
+
+    def insert_job(self, query_request, body, rendered_template, **kwargs):
+        """
+        Inserts query job. If `self.reuse_jobs`, job gets a deterministic ID based on the
+        template name, time window, rendered query & query options, and an existing job
+        w/ that ID is returned instead of inserting a new one.
+
+        :param query_request: BigQuery jobs resource
+        :param body: job resource to insert
+        :param rendered_template: rendered query string
+        :param kwargs: all kwargs passed into template
+        :return: job resource
+        """
+        if not self.reuse_jobs:
+            return query_request.insert(projectId=self.gce_settings.PROJECT_ID, body=body).execute()
+
+        job_id = self.job_id(body, rendered_template, **kwargs)
+        job, _ = insert_or_reuse_job(query_request, self.gce_settings.PROJECT_ID, job_id, body)
+        return job
+
+    def job_id(self, body, rendered_template, **kwargs):
+        """
+        Deterministic ID of query job `body`, see `insert_job`.
+
+        :param body: job resource to insert
+        :param rendered_template: rendered query string
+        :param kwargs: all kwargs passed into template
+        """
+        query_options = body['configuration']['query']
+        return make_job_id(self.job_name(**kwargs), rendered_template,
+                           dict((k, v) for k, v in query_options.items() if k not in RESULT_NEUTRAL_OPTIONS))
+
+    def job_name(self, **kwargs):
+        """
+        Template name & start of time window, e.g. `intermediates/auction_stats_201711091300`.
+
+        :param kwargs: all kwargs passed into template
+        """
+        name = self.template.name.rsplit('.', 1)[0]
+        window = kwargs.get('start')
+        if isinstance(window, datetime):
+            name += '_' + window.strftime('%Y%m%d%H%M')
+        elif window:
+            name += '_' + re.sub(r'[^0-9]', '', str(window))[:12]
+        return name
+
+    def preflight(self, query_request, body, rendered_template, **kwargs):
+        """
+        Dry runs query job `body` & checks its estimated bytes against `self.scan_budget`, which
+        may set BATCH priority in `body` or raise `BudgetExceeded`. Priority doesn't change job
+        IDs, so a downgraded job still reuses an earlier run's job.
+
+        If `self.reuse_jobs` & an earlier run's job is going to be reused, it's recorded as
+        reused w/o a dry run & isn't charged to the budget.
+
+        :param query_request: BigQuery jobs resource
+        :param body: job resource about to be inserted
+        :param rendered_template: rendered query string
+        :param kwargs: all kwargs passed into template
+        :return: budget's cost table entry, or None if there's no budget
+        """
+        if self.scan_budget is None:
+            return None
+        name = self.job_name(**kwargs)
+        query_options = body['configuration']['query']
+        if self.reuse_jobs and find_reusable_job(query_request, self.gce_settings.PROJECT_ID,
+                                                 self.job_id(body, rendered_template, **kwargs)) is not None:
+            return self.scan_budget.record_reused(name, self.template.name, query_options)
+        options = dict((k, v) for k, v in query_options.items() if k != 'query')
+        try:
+            estimated_bytes = dry_run_bytes(query_request, self.gce_settings.PROJECT_ID, rendered_template,
+                                            query_options=options)
+        except HttpError as e:
+            # real job will most likely fail the same way, so leave reporting it to that
+            logger.warn('Dry run of %s failed, running it unestimated: %s' % (name, e))
+            estimated_bytes = None
+        return self.scan_budget.check(name, self.template.name, estimated_bytes, query_options)
+
+    def record_scan(self, budget_entry, total_bytes_processed, cache_hit):
+        """
+        Records bytes a query actually processed in `self.scan_budget`'s cost table, if any.
+        """
+        if budget_entry is not None:
+            self.scan_budget.record_actual(budget_entry, total_bytes_processed, cache_hit)
+
+    def render_template(self, **kwargs):
+        """
+        Formats any datetime keyword args and renders query template with them.
 
         :param kwargs: all kwargs passed directly into template as template vars
-        :return:
+        :return: rendered query string
         """
-        # first format any datetime keyword args
         for kw in kwargs:
             if isinstance(kwargs[kw], datetime):
                 kwargs[kw] = kwargs[kw].strftime('%Y-%m-%d %H:%M:%S')
+        return self.template.render(**kwargs)
+
+    def cache_key(self, rendered_template, **kwargs):
+        """
+        Key for this query's entry in `self.cache`, or None if not caching.
+
+        :param rendered_template: rendered query string
+        :param kwargs: all kwargs passed into template
+        :return:
+        """
+        if self.cache is None:
+            return None
+        query_options = dict((k, v) for k, v in (self.query_options or {}).items()
+                             if k not in RESULT_NEUTRAL_OPTIONS)
+        # callables like `error_callback` don't affect results, & their reprs differ per process
+        template_vars = dict((k, v) for k, v in kwargs.items() if not callable(v))
+        return self.cache.make_key(rendered_template, {'template': self.template.name,
+                                                       'query_options': query_options,
+                                                       'template_vars': template_vars})
 
+    def extract(self, **kwargs):
+        """
+        Run BigQuery query and load response into dataframe
+
+        :param kwargs: all kwargs passed directly into template as template vars
+        :return:
+        """
         # parse query template with provided kwargs
-        rendered_template = self.template.render(**kwargs)
-        # TODO: Save response to Cloud Storage as backup?
+        rendered_template = self.render_template(**kwargs)
+        cache_key = self.cache_key(rendered_template, **kwargs)
+        if cache_key is not None and not self.cache_bypass:
+            dataframe = self.cache.get(cache_key)
+            if dataframe is not None:
+                return dataframe if not dataframe.empty else None
+
         query_request = self.gce_service.jobs()
         query_response = self.run_query(rendered_template, query_request, **kwargs)
 
@@ -97,13 +328,80 @@ class BigQueryETL(ETL):
         # If you want to parse async job result into dataframe, use
         # getQueryResult in runQuery subclass method
         if query_response['kind'] == 'bigquery#getQueryResultsResponse':
+            dataframe = None
             if int(query_response['totalRows']) > 0:
                 # load into dataframe
                 dataframe = query_response_to_dataframe(query_response)
                 logger.info('Loaded query result to DataFrame')
-                return dataframe
+            if cache_key is not None and 'errors' not in query_response:
+                self.cache.put(cache_key, dataframe if dataframe is not None else pd.DataFrame())
+            return dataframe
         return None
 
+    def extract_chunks(self, **kwargs):
+        """
+        Run BigQuery query and yield the result one page of `self.chunksize` rows at
+        a time, following `pageToken` until the result is exhausted. Only one page is
+        held in memory at once.
+
+        :param kwargs: all kwargs passed directly into template as template vars
+        :return:
+        """
+        rendered_template = self.render_template(**kwargs)
+        cache_key = self.cache_key(rendered_template, **kwargs)
+        if cache_key is not None and not self.cache_bypass:
+            cached_chunks = self.cache.iter_chunks(cache_key)
+            if cached_chunks is not None:
+                for chunk in cached_chunks:
+                    if not chunk.empty:
+                        yield chunk
+                return
+
+        query_request = self.gce_service.jobs()
+        query_response = self.run_query(rendered_template, query_request, **kwargs)
+
+        # async job resources (i.e. intermediate tables) have nothing to page through
+        if query_response['kind'] != 'bigquery#getQueryResultsResponse':
+            return
+
+        chunks = self.iter_result_pages(query_response, query_request)
+        if cache_key is not None and 'errors' not in query_response:
+            # pages are cached as they're loaded, & the rest of them if loading stops partway
+            # through, so a retry reads them from the cache rather than from BigQuery
+            chunks = self.cache.put_chunks(cache_key, chunks)
+        try:
+            for chunk in chunks:
+                if not chunk.empty:
+                    yield chunk
+        finally:
+            chunks.close()
+
+    def iter_result_pages(self, query_response, query_request):
+        """
+        Yields completed query's result as DataFrames, one page of `self.chunksize`
+        rows at a time, starting w/ the page in `query_response`.
+
+        :param query_response: first `getQueryResults` response of a completed job
+        :param query_request: BigQuery jobs resource
+        :return:
+        """
+        job_reference = query_response['jobReference']
+        schema = query_response.get('schema')
+        chunks = 0
+        while True:
+            if query_response.get('rows'):
+                query_response['schema'] = schema
+                chunks += 1
+                logger.info('Loaded chunk %s of jobId %s to DataFrame' % (chunks, job_reference['jobId']))
+                yield query_response_to_dataframe(query_response)
+            page_token = query_response.get('pageToken')
+            if not page_token:
+                break
+            query_response = query_request.getQueryResults(projectId=job_reference['projectId'],
+                                                           jobId=job_reference['jobId'],
+                                                           pageToken=page_token,
+                                                           maxResults=self.chunksize).execute()
+
     def transform(self, dataframe):
         """
         Hook for subclasses to do any necessary transformation
@@ -116,24 +414,22 @@ class BigQueryETL(ETL):
         """
         # For keyword adstats, have to transform the keywords field,
         # a string with comma separated keywords, to an string array
-        is_keyword_dataframe = False
-        for c in dataframe.columns:
-            if c == 'keywords':
-                is_keyword_dataframe = True
-                break
-
-        if is_keyword_dataframe == True:
-            for index, row in dataframe.iterrows():
-                row['keywords'] = row['keywords'].split(',')
-                dataframe.set_value(index, 'keywords', row['keywords'])
-
+        if 'keywords' in dataframe.columns:
+            split_keywords(dataframe)
         return dataframe
 
 
 class BigQueryMongoETL(BigQueryETL):
+    """
+    Loads BigQuery query results into a MongoDB collection.
 
-    def __init__(self, template, gce_settings, mongo_collection, **kwargs):
+    :param mongo_collection: pymongo Collection to insert results into
+    :param writer_options: dict of `MongoWriter` kwargs used for loading, e.g. batch size, number of
+        writer threads & write concern.
+    """
+    def __init__(self, template, gce_settings, mongo_collection, writer_options=None, **kwargs):
         self.mongo_collection = mongo_collection
+        self.writer = MongoWriter(mongo_collection, **(writer_options or {}))
         super(BigQueryMongoETL, self).__init__(template, gce_settings, **kwargs)
 
     def load(self, dataframe):
@@ -143,41 +439,21 @@ class BigQueryMongoETL(BigQueryETL):
         :param dataframe:
         :return:
         """
-        records = dataframe.to_dict(orient='records')
-
-        # Not proud of this, would love to figure out a way
-        # around this natively in Pandas
-        for row in records:
-            for k in row:
-                if isinstance(row[k], pd.tslib.Timestamp):
-                    row[k] = row[k].to_datetime()
+        ensure_indexes(self.mongo_collection)
+        return self.writer.insert_dataframe(dataframe)
 
-        return self.mongo_collection.insert_many(records)
-
-
-class BqMongoKeywordETL(BigQueryMongoETL):
-
-    def __init__(self, template, gce_settings, mongo_collection, **kwargs):
-        self.mongo_collection = mongo_collection
-        super(BigQueryMongoETL, self).__init__(template, gce_settings, **kwargs)
-
-    def load(self, dataframe):
+    def combine_load_results(self, results):
         """
-        Loads a pandas dataframe object into MongoDB collection
+        Merges per-chunk `InsertManyResult`s into one so streaming runs report
+        `inserted_ids` the same way as regular runs.
 
-        :param dataframe:
+        :param results: list of `InsertManyResult`s
         :return:
         """
-        records = dataframe.to_dict(orient='records')
+        return merge_insert_many_results(results)
 
-        # Not proud of this, would love to figure out a way
-        # around this natively in Pandas
-        for row in records:
-            for k in row:
-                if isinstance(row[k], pd.tslib.Timestamp):
-                    row[k] = row[k].to_datetime()
 
-        return self.mongo_collection.insert_many(records)
+class BqMongoKeywordETL(BigQueryMongoETL):
 
     def transform(self, dataframe):
         """
@@ -189,15 +465,72 @@ class BqMongoKeywordETL(BigQueryMongoETL):
         """
         # For keyword adstats, have to transform the keywords field,
         # a string with comma separated keywords, to an string array
-        for index, row in dataframe.iterrows():
-            if row['keywords']:
-                row['keywords'] = row['keywords'].split(',')
-            dataframe.set_value(index, 'keywords', row['keywords'])
-
+        split_keywords(dataframe)
         return dataframe
 
 
+class BigQueryJobHandle(object):
+    """
+    Handle on a job submitted w/ `BigQueryIntermediateETL.submit`, to be waited on w/ `wait_all`.
+
+    :param etl: ETL which submitted the job
+    :param job: job resource returned on insert
+    :param budget_entry: job's `ScanBudget` cost table entry, if any
+    :param error_callback: called w/ error message if job fails
+    """
+    def __init__(self, etl, job, budget_entry=None, error_callback=None):
+        self.etl = etl
+        self.job = job
+        self.budget_entry = budget_entry
+        self.error_callback = error_callback
+
+    @property
+    def project_id(self):
+        return self.job['jobReference']['projectId']
+
+    @property
+    def job_id(self):
+        return self.job['jobReference']['jobId']
+
+    @property
+    def done(self):
+        return self.job['status']['state'] == 'DONE'
+
+    def __repr__(self):
+        return '<BigQueryJobHandle %s (%s)>' % (self.job_id, self.job['status']['state'])
+
+
 class BigQueryIntermediateETL(BigQueryETL):
+    # runs for the side effect of writing to a destination table, so can't be cached
+    cacheable = False
+
+    def submit(self, **kwargs):
+        """
+        Non-blocking version of `run`: renders template & inserts query job, w/o waiting for it.
+        Wait on the returned handle(s) w/ `wait_all`, so any number of jobs run at once & are
+        waited on together.
+
+        :param kwargs: all kwargs passed directly into template as template vars
+        :return: `BigQueryJobHandle`
+        """
+        error_callback = kwargs.pop('error_callback', None)
+        rendered_template = self.render_template(**kwargs)
+        return self.insert_query_job(rendered_template, self.gce_service.jobs(), error_callback, **kwargs)
+
+    def insert_query_job(self, rendered_template, query_request, error_callback=None, **kwargs):
+        """
+        Inserts query job storing results in a destination table.
+
+        :return: `BigQueryJobHandle`
+        """
+        query_data = dict(self.query_options)
+        query_data['query'] = rendered_template
+        # For insert jobs, need to nest options in 'query' sub-object under 'configuration'
+        query_data = {'configuration': {'query': query_data}}
+        budget_entry = self.preflight(query_request, query_data, rendered_template, **kwargs)
+        job = self.insert_job(query_request, query_data, rendered_template, **kwargs)
+        logger.info('Submitted BigQuery JobId %s' % job['jobReference']['jobId'])
+        return BigQueryJobHandle(self, job, budget_entry=budget_entry, error_callback=error_callback)
 
     def run_query(self, rendered_template, query_request, error_callback=None, **kwargs):
         """
@@ -207,23 +540,22 @@ class BigQueryIntermediateETL(BigQueryETL):
         :param kwargs: passed to template
         :return:
         """
-        SECONDS_TO_SLEEP_BETWEEN_JOB_CALLS = 3
+        handle = self.insert_query_job(rendered_template, query_request, error_callback, **kwargs)
 
-        query_data = self.query_options
-        query_data['query'] = rendered_template
-        # For insert jobs, need to nest options in 'query' sub-object under 'configuration'
-        query_data = {'configuration': {'query': query_data}}
-        job = query_request.insert(projectId=self.gce_settings.PROJECT_ID,
-                                   body=query_data).execute()
+        # Results here could be very large, so waiter only long-polls getQueryResults
+        # w/ maxResults=0 and then picks up the job resource
+        if not handle.done:
+            handle.job = self.job_waiter.wait_for_job(query_request, handle.project_id, handle.job_id)
+        return self.finish(handle)
 
-        # You can call getQueryResults which will only return when job
-        # is complete, but the results here could be very large so
-        # it's better to just check on the job resource periodically
-        while job['status']['state'] != 'DONE':
-            sleep(SECONDS_TO_SLEEP_BETWEEN_JOB_CALLS)
-            job = self.gce_service.jobs().get(projectId=job['jobReference']['projectId'],
-                                              jobId=job['jobReference']['jobId']).execute()
+    def finish(self, handle):
+        """
+        Logs outcome of a DONE job & reports any errors.
 
+        :param handle: `BigQueryJobHandle` of DONE job
+        :return: job resource
+        """
+        job = handle.job
         # logging stuff
         statistics = job['statistics']
         status = job['status']
@@ -237,15 +569,42 @@ class BigQueryIntermediateETL(BigQueryETL):
         if status.has_key('errorResult'):
             error_msg = 'ERRORS encountered in BigQuery JobId %s: \n %s' % (jobReference['jobId'], status['errorResult'])
             logger.error(error_msg)
-            if error_callback:
-                error_callback(error_msg)
+            if handle.error_callback:
+                handle.error_callback(error_msg)
         else:
             if statistics.has_key('query'):
                 logger.info('totalBytesProcessed: %s ' % statistics['query']['totalBytesProcessed'])
                 logger.info('cacheHit: %s ' % statistics['query']['cacheHit'])
+                self.record_scan(handle.budget_entry, statistics['query']['totalBytesProcessed'],
+                                 statistics['query']['cacheHit'])
         return job
 
 
+def wait_all(handles, job_waiter=None, poller=None):
+    """
+    Waits on jobs submitted w/ `BigQueryIntermediateETL.submit` from one poll loop w/ one set
+    of backoff timers, then logs each job's outcome & reports errors as `run` would.
+
+    :param handles: list of `BigQueryJobHandle`s
+    :param job_waiter: `JobWaiter` to poll w/, default that of the first handle's ETL
+    :param poller: `JobPoller` to wait on instead, when jobs are waited on from many threads
+    :return: list of DONE job resources, in the same order as `handles`
+    """
+    pending = [handle for handle in handles if not handle.done]
+    if pending and poller is not None:
+        jobs = poller.wait_for_jobs([handle.job_id for handle in pending])
+        for handle in pending:
+            handle.job = jobs[handle.job_id]
+    elif pending:
+        job_waiter = job_waiter or pending[0].etl.job_waiter
+        for project_id in set(handle.project_id for handle in pending):
+            in_project = [handle for handle in pending if handle.project_id == project_id]
+            jobs = job_waiter.wait_for_jobs(in_project[0].etl.gce_service.jobs(), project_id,
+                                            [handle.job_id for handle in in_project])
+            for handle in in_project:
+                handle.job = jobs[handle.job_id]
+    return [handle.etl.finish(handle) for handle in handles]
+
 
 # if __name__ == '__main__':
     # from cliquesadmin.jsonconfig import JsonConfigParser
@@ -0,0 +1,481 @@
+"""
+Declarative step list for the hourly ad stats pipeline, run by `ETLScheduler`.
+
+BigQuery intermediates only depend on raw event tables, so they all run at once.
+Their jobs are waited on together by one `JobPoller` rather than each step polling its own.
+Each MongoDB load only waits on the intermediates it actually reads, and the
+dailyadstats rollup waits on the hourlyadstats loads.
+"""
+import logging
+from datetime import timedelta
+from functools import partial
+import pandas as pd
+from cliquesadmin.gce_utils import get_service
+from cliquesadmin.gce_utils.bigquery import table_layout, has_layout, get_table, JobPoller
+from cliquesadmin.etl.bigquery_etl import BigQueryETL, BigQueryMongoETL, BigQueryIntermediateETL, BqMongoKeywordETL, \
+    wait_all
+from cliquesadmin.etl.mongo_etl import DailyMongoAggregationETL, IncrementalDailyMongoAggregationETL, \
+    AppliedHoursLedger, mark_full_recompute
+from cliquesadmin.etl.pipeline import PipelinedETLRunner
+from cliquesadmin.etl.scheduler import ETLStep
+from cliquesadmin.etl.query_templates.mongo.daily_ad_stats import daily_ad_stats_pipeline, \
+    DAILY_AD_STATS_UPDATE_KEYS, DAILY_AD_STATS_SUM_FIELDS, DAILY_AD_STATS_AVERAGE_FIELDS
+from cliquesadmin.gce_utils.bigquery import cliques_bq_settings
+
+logger = logging.getLogger(__name__)
+
+# `kind` determines the ETL class & backend used for a step:
+#   - 'intermediate': BigQueryIntermediateETL writing to BigQuery table `table`
+#   - 'mongo' / 'keyword': BigQueryMongoETL / BqMongoKeywordETL loading into collection `collection`.
+#     Several steps load the same collection, `row_field` is only in the documents a step loads, so
+#     its documents for an hour can be cleared before loading it again (see `replace_rows`).
+#   - 'daily': DailyMongoAggregationETL rolling hourlyadstats up into dailyadstats
+#   - 'touch_state': BigQueryIntermediateETL overwriting last-touch state table `table`, see below
+# `params` maps template var names to pipeline context values, `{pricing}` in templates
+# is replaced with 'cpc' or 'cpm'.
+#
+# Incremental attribution: imp_ & click_touch_state hold the latest impression / click per uuid &
+# advertiser up to their `through` hour. When a matching step's `state_table` is current to the
+# start of the hour being run, it's rendered w/ `incremental` & matches actions against the state
+# plus the hour's own touches, rather than scanning the whole lookback of raw events. The state
+# step then folds the hour into the state. If the state is behind or missing, matching falls back
+# to the full scan & the state is rebuilt from the lookback, after which runs are incremental again.
+# Rerunning the hour the state was last folded through renders the incremental query again, so its
+# job is reused rather than the full scan appending the hour's matches a second time.
+HOURLY_ADSTATS_STEPS = [
+    # BigQuery intermediates
+    {'name': 'imp_matched_actions', 'kind': 'intermediate',
+     'template': 'intermediates/imp_matched_actions.sql', 'table': 'imp_matched_actions',
+     'state_table': 'imp_touch_state',
+     'params': {'lookback': 'view_lookback', 'touchAuctionStart': 'touch_auction_start'}},
+    {'name': 'click_matched_actions', 'kind': 'intermediate',
+     'template': 'intermediates/click_matched_actions.sql', 'table': 'click_matched_actions',
+     'state_table': 'click_touch_state',
+     'params': {'lookback': 'click_lookback', 'touchAuctionStart': 'touch_auction_start'}},
+    {'name': 'imp_touch_state', 'kind': 'touch_state',
+     'template': 'intermediates/imp_touch_state.sql', 'table': 'imp_touch_state',
+     'params': {'lookback': 'view_lookback', 'touchAuctionStart': 'touch_auction_start'},
+     'depends_on': ['imp_matched_actions']},
+    {'name': 'click_touch_state', 'kind': 'touch_state',
+     'template': 'intermediates/click_touch_state.sql', 'table': 'click_touch_state',
+     'params': {'lookback': 'click_lookback', 'touchAuctionStart': 'touch_auction_start'},
+     'depends_on': ['click_matched_actions']},
+    {'name': 'auction_stats', 'kind': 'intermediate',
+     'template': 'intermediates/auction_stats.sql', 'table': 'auction_stats',
+     'params': {'wideStart': 'wide_start', 'wideEnd': 'wide_end'}},
+    {'name': 'auction_stats_defaults', 'kind': 'intermediate',
+     'template': 'intermediates/auction_stats_defaults.sql', 'table': 'auction_stats'},
+    # per-impression facts for the hour, the only source of the imps/clicks rollups below
+    {'name': 'imp_facts', 'kind': 'intermediate',
+     'template': 'intermediates/hourly_imp_facts.sql', 'table': 'hourly_imp_facts',
+     'params': {'wideStart': 'wide_start', 'wideEnd': 'wide_end'},
+     'depends_on': ['auction_stats', 'auction_stats_defaults']},
+
+    # HourlyAdStats
+    {'name': 'hourly_imps_clicks', 'kind': 'mongo', 'collection': 'hourlyadstats', 'row_field': 'clearprice',
+     'template': 'hourlyadstats/hourlyadstats_imps_clicks_{pricing}.sql',
+     'depends_on': ['imp_facts']},
+    {'name': 'hourly_actions', 'kind': 'mongo', 'collection': 'hourlyadstats', 'row_field': 'actionbeacon',
+     'template': 'hourlyadstats/hourlyadstats_actions.sql',
+     'depends_on': ['imp_matched_actions', 'click_matched_actions']},
+    {'name': 'hourly_defaults', 'kind': 'mongo', 'collection': 'hourlyadstats', 'row_field': 'defaults',
+     'template': 'hourlyadstats/hourlyadstats_defaults.sql'},
+
+    # GeoAdStats
+    {'name': 'geo_imps_clicks', 'kind': 'mongo', 'collection': 'geoadstats', 'row_field': 'clearprice',
+     'template': 'geoadstats/geoadstats_imps_clicks_{pricing}.sql',
+     'depends_on': ['imp_facts']},
+    {'name': 'geo_actions', 'kind': 'mongo', 'collection': 'geoadstats', 'row_field': 'actionbeacon',
+     'template': 'geoadstats/geoadstats_actions.sql', 'params': {'lookback': 'view_lookback'},
+     'depends_on': ['imp_matched_actions', 'click_matched_actions']},
+    {'name': 'geo_defaults', 'kind': 'mongo', 'collection': 'geoadstats', 'row_field': 'defaults',
+     'template': 'geoadstats/geoadstats_defaults.sql'},
+
+    # KeywordAdStats
+    {'name': 'keyword_imps_clicks', 'kind': 'keyword', 'collection': 'keywordadstats', 'row_field': 'clearprice',
+     'template': 'keywordadstats/keywordadstats_imps_clicks_{pricing}.sql',
+     'depends_on': ['imp_facts']},
+    {'name': 'keyword_actions', 'kind': 'keyword', 'collection': 'keywordadstats', 'row_field': 'actionbeacon',
+     'template': 'keywordadstats/keywordadstats_actions.sql', 'params': {'lookback': 'view_lookback'},
+     'depends_on': ['imp_matched_actions', 'click_matched_actions']},
+    {'name': 'keyword_defaults', 'kind': 'keyword', 'collection': 'keywordadstats', 'row_field': 'defaults',
+     'template': 'keywordadstats/keywordadstats_defaults.sql'},
+
+    # DailyAdStats
+    {'name': 'daily_rollup', 'kind': 'daily',
+     'depends_on': ['hourly_imps_clicks', 'hourly_actions', 'hourly_defaults']},
+]
+
+# partitioning & clustering of intermediate tables, which downstream templates filter by partition
+# field for the hour they cover. Tables that already exist w/o their layout are appended to as they
+# are until converted w/ bin/convert_intermediate_tables.py.
+INTERMEDIATE_TABLE_LAYOUTS = {
+    'auction_stats': table_layout('tstamp', clustering_fields=['auctionId', 'impid']),
+    'hourly_imp_facts': table_layout('tstamp', clustering_fields=['advertiser', 'impid']),
+    'imp_matched_actions': table_layout('action_tstamp', clustering_fields=['advertiser', 'actionid']),
+    'click_matched_actions': table_layout('action_tstamp', clustering_fields=['advertiser', 'actionid'])
+}
+
+STEP_BACKENDS = {
+    'intermediate': 'bigquery',
+    'touch_state': 'bigquery',
+    'mongo': 'mongo',
+    'keyword': 'mongo',
+    'daily': 'mongo'
+}
+
+MONGO_ETL_CLASSES = {
+    'mongo': BigQueryMongoETL,
+    'keyword': BqMongoKeywordETL
+}
+
+# 'upsert': daily rollup is pulled into Python & upserted back by `MongoWriter`
+# 'merge': daily rollup is `$merge`d into dailyadstats server-side, requires MongoDB >= 4.2
+# 'incremental': only the hours just loaded are rolled up & `$inc`ed into dailyadstats.
+#   'upsert' & 'merge' recompute the whole day so far & are the fallback if an incremental run fails.
+DAILY_MODES = ('upsert', 'merge', 'incremental')
+
+# hours already rolled into dailyadstats, see `AppliedHoursLedger`
+DAILY_LEDGER_COLLECTION = 'dailyadstats_applied_hours'
+
+DEFAULT_CONCURRENCY = {
+    'bigquery': 4,
+    'mongo': 3
+}
+
+# how far back of an hour's first touch its auction is looked for when folding the hour into
+# touch state, rather than the whole lookback. Touches further than this from their auction
+# are left out of the state.
+TOUCH_AUCTION_WINDOW = timedelta(days=1)
+
+
+HOURLY_STEP_NAMES = [spec['name'] for spec in HOURLY_ADSTATS_STEPS]
+
+# BigQuery job priorities, BATCH jobs queue until idle slots are free rather than competing
+# w/ INTERACTIVE ones, so backfills don't slow down the live hourly run
+BQ_PRIORITIES = ('INTERACTIVE', 'BATCH')
+
+
+def intermediate_query_opts(dataset, table_id, priority=None):
+    """
+    Query options for a BigQuery intermediate job appending to `dataset.table_id`.
+    Returns a new dict each call, so steps never share (and clobber) each other's options.
+    """
+    query_opts = {
+        'destinationTable': {
+            'datasetId': dataset,
+            'projectId': cliques_bq_settings.PROJECT_ID,
+            'tableId': table_id
+        },
+        'createDisposition': 'CREATE_AS_NEEDED',
+        'writeDisposition': 'WRITE_APPEND',
+        'useLegacySQL': False
+    }
+    if priority:
+        query_opts['priority'] = priority
+    return query_opts
+
+
+def intermediate_table_layout(table_id, context):
+    """
+    Partitioning & clustering options for query jobs writing to intermediate table `table_id`,
+    i.e. its layout from `INTERMEDIATE_TABLE_LAYOUTS`. If the table already exists w/ a different
+    layout, BigQuery would reject them, so returns no options & the table is appended to as is.
+    Looked up once per pipeline run.
+
+    :return: dict of query options
+    """
+    layout = INTERMEDIATE_TABLE_LAYOUTS.get(table_id)
+    if layout is None:
+        return {}
+    checked = context['table_layouts']
+    if table_id not in checked:
+        service = context.get('service') or get_service(cliques_bq_settings)
+        table = get_table(service.tables(), cliques_bq_settings.PROJECT_ID, context['dataset'], table_id)
+        if table is not None and not has_layout(table, layout):
+            logger.warn('%s.%s is not partitioned & clustered as configured, appending to it as is. '
+                        'Convert it w/ bin/convert_intermediate_tables.py' % (context['dataset'], table_id))
+            checked[table_id] = {}
+        else:
+            checked[table_id] = layout
+    return checked[table_id]
+
+
+def touch_state_through(table_id, context):
+    """
+    End of the last hour folded into touch state table `table_id`, i.e. the hour its state
+    is current to. Looked up once per pipeline run.
+
+    :return: datetime, or None if table doesn't exist or is empty
+    """
+    cached = context['touch_state_through']
+    if table_id not in cached:
+        service = context.get('service') or get_service(cliques_bq_settings)
+        if get_table(service.tables(), cliques_bq_settings.PROJECT_ID, context['dataset'], table_id) is None:
+            cached[table_id] = None
+            return None
+        # watermark changes between runs w/ identical queries, so never reuse an earlier job
+        etl = BigQueryETL('intermediates/touch_state_through.sql', cliques_bq_settings, reuse_jobs=False,
+                          job_waiter=context.get('job_waiter'), service=context.get('service'),
+                          scan_budget=context.get('scan_budget'))
+        dataframe = etl.extract(dataset=context['dataset'], table=table_id)
+        through = None
+        if dataframe is not None and not pd.isnull(dataframe['through'][0]):
+            through = dataframe['through'][0].to_pydatetime()
+        cached[table_id] = through
+    return cached[table_id]
+
+
+def run_intermediate_step(spec, context):
+    query_opts = intermediate_query_opts(context['dataset'], spec['table'], priority=context.get('priority'))
+    query_opts.update(intermediate_table_layout(spec['table'], context))
+    etl = BigQueryIntermediateETL(spec['template'], cliques_bq_settings, query_options=query_opts,
+                                  job_waiter=context.get('job_waiter'), service=context.get('service'),
+                                  scan_budget=context.get('scan_budget'))
+    template_vars = _template_vars(spec, context)
+    if spec.get('state_table') and context.get('incremental_attribution'):
+        through = touch_state_through(spec['state_table'], context)
+        # state only moves on to the hour's end once this step's job for the hour succeeded, so a
+        # rerun renders the same incremental query & reuses that job rather than appending again
+        template_vars['incremental'] = through in (context['start'], context['end'])
+        if through == context['end']:
+            logger.info('%s already folded in %s, reusing its incremental %s job'
+                        % (spec['state_table'], context['start'], spec['name']))
+        elif not template_vars['incremental']:
+            logger.warn('%s is current to %s rather than %s, %s will scan the whole lookback'
+                        % (spec['state_table'], through, context['start'], spec['name']))
+    logger.info('Now running %s, storing in BigQuery' % spec['name'])
+    return wait_all([etl.submit(**template_vars)], poller=context['job_poller'])[0]
+
+
+def run_touch_state_step(spec, context):
+    if not context.get('incremental_attribution'):
+        logger.info('Incremental attribution off, not updating %s' % spec['table'])
+        return None
+    through = touch_state_through(spec['table'], context)
+    if through is not None and through >= context['end']:
+        logger.info('%s already current to %s, nothing to fold in' % (spec['table'], through))
+        return None
+    rebuild = through != context['start']
+    if rebuild:
+        logger.warn('%s is current to %s rather than %s, rebuilding it from the whole lookback'
+                    % (spec['table'], through, context['start']))
+    query_opts = intermediate_query_opts(context['dataset'], spec['table'], priority=context.get('priority'))
+    query_opts['writeDisposition'] = 'WRITE_TRUNCATE'
+    etl = BigQueryIntermediateETL(spec['template'], cliques_bq_settings, query_options=query_opts,
+                                  job_waiter=context.get('job_waiter'), service=context.get('service'),
+                                  scan_budget=context.get('scan_budget'))
+    logger.info('Now updating %s through %s' % (spec['table'], context['end']))
+    template_vars = _template_vars(spec, context)
+    template_vars['rebuild'] = rebuild
+    return wait_all([etl.submit(**template_vars)], poller=context['job_poller'])[0]
+
+
+def run_mongo_step(spec, context):
+    collection = context['destination_db'][spec['collection']]
+    etl_class = MONGO_ETL_CLASSES[spec['kind']]
+    query_opts = {'priority': context['priority']} if context.get('priority') else None
+    etl = etl_class(spec['template'], cliques_bq_settings, collection, query_options=query_opts,
+                    chunksize=context.get('chunksize'), page_size=context.get('page_size'),
+                    num_readers=context.get('num_readers') or 1, job_waiter=context.get('job_waiter'),
+                    cache=context.get('cache'), cache_bypass=context.get('cache_bypass', False),
+                    writer_options=context.get('writer_options'), service=context.get('service'),
+                    scan_budget=context.get('scan_budget'))
+    if context.get('replace_rows'):
+        # loads are plain inserts, so drop whatever an earlier, partly loaded run of the hours left behind
+        deleted = collection.delete_many({'hour': {'$gte': context['start'], '$lt': context['end']},
+                                          spec['row_field']: {'$exists': True}})
+        if deleted.deleted_count:
+            logger.info('Deleted %s %s documents from %s to %s in %s, replacing them'
+                        % (deleted.deleted_count, spec['name'], context['start'], context['end'],
+                           collection.full_name))
+    logger.info('Now loading %s aggregates to MongoDB' % spec['name'])
+    if etl.chunksize:
+        # fetch & transform the next result pages while the current one is being written
+        result = PipelinedETLRunner(etl).run(**_template_vars(spec, context))
+    else:
+        result = etl.run(**_template_vars(spec, context))
+    if result is not None:
+        logger.info('Inserted %s documents into collection %s' % (len(result.inserted_ids), collection.full_name))
+    else:
+        logger.info('No rows to insert, %s ETL complete.' % spec['name'])
+    return result
+
+
+def run_daily_step(spec, context):
+    destination_db = context['destination_db']
+    ledger = AppliedHoursLedger(destination_db[DAILY_LEDGER_COLLECTION])
+    if context.get('daily_mode') == 'incremental':
+        logger.info('Now incrementing MongoDB DailyAdStats with HourlyAdStats from %s to %s...'
+                    % (context['start'], context['end']))
+        etl = IncrementalDailyMongoAggregationETL('date', daily_ad_stats_pipeline, destination_db.hourlyadstats,
+                                                  destination_db.dailyadstats, DAILY_AD_STATS_UPDATE_KEYS,
+                                                  DAILY_AD_STATS_SUM_FIELDS, ledger,
+                                                  average_fields=DAILY_AD_STATS_AVERAGE_FIELDS,
+                                                  chunksize=context.get('chunksize'),
+                                                  writer_options=context.get('writer_options'))
+        result = etl.run(start_datetime=context['start'], end_datetime=context['end'])
+        logger.info('DailyAdStats ETL complete.')
+        return result
+
+    daily_start = context['start'].replace(hour=0, minute=0, second=0)
+    daily_end = daily_start + timedelta(days=1)
+    logger.info('Now upserting MongoDB DailyAdStats with aggregation results from HourlyAdStats...')
+    logger.info('Day interval is %s to (but not including) %s' % (daily_start, daily_end))
+    etl = DailyMongoAggregationETL('date', daily_ad_stats_pipeline, destination_db.hourlyadstats,
+                                   destination_db.dailyadstats, upsert=True,
+                                   update_keys=DAILY_AD_STATS_UPDATE_KEYS, chunksize=context.get('chunksize'),
+                                   writer_options=context.get('writer_options'),
+                                   merge=context.get('daily_mode') == 'merge')
+    result = etl.run(start_datetime=daily_start, end_datetime=daily_end)
+    # full recompute covers every hour loaded so far, so incremental runs mustn't add them again
+    mark_full_recompute(ledger, destination_db.hourlyadstats, daily_start, daily_end)
+    logger.info('DailyAdStats ETL complete.')
+    return result
+
+
+STEP_RUNNERS = {
+    'intermediate': run_intermediate_step,
+    'touch_state': run_touch_state_step,
+    'mongo': run_mongo_step,
+    'keyword': run_mongo_step,
+    'daily': run_daily_step
+}
+
+
+def _template_vars(spec, context):
+    template_vars = {
+        'start': context['start'],
+        'end': context['end'],
+        'dataset': context['dataset'],
+        'error_callback': context.get('error_callback')
+    }
+    for var, context_key in spec.get('params', {}).items():
+        template_vars[var] = context[context_key]
+    return template_vars
+
+
+def _window_context(dataset, start, end, view_lookback, click_lookback):
+    """
+    Part of the pipeline context that template vars are drawn from.
+    """
+    return {
+        'dataset': dataset,
+        'start': start,
+        'end': end,
+        'wide_start': start - timedelta(hours=1),
+        'wide_end': end + timedelta(hours=1),
+        'view_lookback': view_lookback,
+        'click_lookback': click_lookback,
+        'touch_auction_start': start - TOUCH_AUCTION_WINDOW
+    }
+
+
+def hourly_template_vars(dataset, start, end, pricing='CPM', view_lookback=None, click_lookback=None):
+    """
+    BigQuery templates the hourly pipeline runs over [start, end), w/ the vars each is rendered
+    with, for checking queries w/o running the pipeline, e.g. w/ dry runs.
+
+    :return: list of (step name, template, dict of template vars)
+    """
+    context = _window_context(dataset, start, end, view_lookback, click_lookback)
+    pricing = 'cpc' if pricing == 'CPC' else 'cpm'
+    queries = []
+    for spec in HOURLY_ADSTATS_STEPS:
+        # every step w/ a template runs it on BigQuery, whichever backend it loads into
+        if 'template' not in spec:
+            continue
+        template = spec['template'].format(pricing=pricing)
+        template_vars = _template_vars(spec, context)
+        del template_vars['error_callback']
+        queries.append((spec['name'], template, template_vars))
+        # variants rendered depending on touch state
+        if spec.get('state_table'):
+            queries.append(('%s (incremental)' % spec['name'], template, dict(template_vars, incremental=True)))
+        if spec['kind'] == 'touch_state':
+            queries.append(('%s (rebuild)' % spec['name'], template, dict(template_vars, rebuild=True)))
+    return queries
+
+
+def hourly_adstats_steps(destination_db, dataset, start, end, pricing='CPM', view_lookback=None,
+                         click_lookback=None, error_callback=None, chunksize=None, page_size=None,
+                         num_readers=1, job_waiter=None, cache=None, cache_bypass=False, writer_options=None,
+                         daily_mode='upsert', priority=None, step_names=None, service=None,
+                         incremental_attribution=False, scan_budget=None, replace_rows=False):
+    """
+    Builds `ETLStep`s for one run of the hourly ad stats pipeline over [start, end).
+
+    :param destination_db: pymongo Database to load aggregates into
+    :param dataset: BigQuery ad events dataset
+    :param start: start of ETL range, inclusive
+    :param end: end of ETL range, exclusive
+    :param pricing: 'CPC' or 'CPM', selects imps & clicks templates. Anything else falls back to CPM.
+    :param view_lookback: view-through attribution lookback in days
+    :param click_lookback: click-through attribution lookback in days
+    :param error_callback: called w/ error message if a BigQuery job reports errors
+    :param chunksize: passed to MongoDB-loading ETLs to run them in streaming mode, w/ extract,
+        transform & load overlapped by a `PipelinedETLRunner`
+    :param page_size: rows per BigQuery results page for MongoDB-loading ETLs
+    :param num_readers: number of parallel BigQuery result page readers for MongoDB-loading ETLs
+    :param job_waiter: `JobWaiter` shared by all BigQuery steps, default waits w/ no deadline
+    :param cache: `QueryResultCache` for MongoDB-loading ETLs' query results
+    :param cache_bypass: If True, re-run cached queries & refresh their cache entries
+    :param writer_options: dict of `MongoWriter` kwargs for all MongoDB loads
+    :param daily_mode: how the dailyadstats rollup is written, one of `DAILY_MODES`
+    :param priority: BigQuery job priority, one of `BQ_PRIORITIES`. Default is BigQuery's, i.e. INTERACTIVE.
+    :param step_names: names of steps to include, default is all of `HOURLY_STEP_NAMES`. Dependencies
+        on steps which aren't included are dropped, i.e. their output is assumed to be there already.
+    :param service: BigQuery API service for all BigQuery steps, default builds one per step
+    :param incremental_attribution: If True, match actions against last-touch state tables & keep them
+        up to date, rather than scanning the whole lookback of impressions & clicks every hour. State
+        assumes hours are run in order, so leave off for backfills.
+    :param scan_budget: `ScanBudget` all BigQuery queries are dry run & checked against before running
+    :param replace_rows: If True, MongoDB-loading steps first delete their documents for [start, end),
+        so reruns of a partly loaded range don't insert them twice
+    :return: list of `ETLStep`s, to be passed to `ETLScheduler`
+    """
+    if daily_mode not in DAILY_MODES:
+        raise ValueError('Unknown daily rollup mode %s, must be one of %s' % (daily_mode, ', '.join(DAILY_MODES)))
+    if priority is not None and priority not in BQ_PRIORITIES:
+        raise ValueError('Unknown BigQuery priority %s, must be one of %s' % (priority, ', '.join(BQ_PRIORITIES)))
+    if step_names is None:
+        step_names = HOURLY_STEP_NAMES
+    unknown = set(step_names) - set(HOURLY_STEP_NAMES)
+    if unknown:
+        raise ValueError('Unknown hourly ETL steps %s, must be in %s'
+                         % (', '.join(sorted(unknown)), ', '.join(HOURLY_STEP_NAMES)))
+    context = _window_context(dataset, start, end, view_lookback, click_lookback)
+    context.update({
+        'destination_db': destination_db,
+        'error_callback': error_callback,
+        'chunksize': chunksize,
+        'page_size': page_size,
+        'num_readers': num_readers,
+        'job_waiter': job_waiter,
+        'cache': cache,
+        'cache_bypass': cache_bypass,
+        'writer_options': writer_options,
+        'daily_mode': daily_mode,
+        'priority': priority,
+        'service': service,
+        'incremental_attribution': incremental_attribution,
+        'scan_budget': scan_budget,
+        'replace_rows': replace_rows,
+        'job_poller': JobPoller(lambda: service or get_service(cliques_bq_settings), cliques_bq_settings.PROJECT_ID,
+                                job_waiter=job_waiter),
+        'touch_state_through': {},
+        'table_layouts': {}
+    })
+    pricing = 'cpc' if pricing == 'CPC' else 'cpm'
+    steps = []
+    for spec in HOURLY_ADSTATS_STEPS:
+        if spec['name'] not in step_names:
+            continue
+        spec = dict(spec)
+        if 'template' in spec:
+            spec['template'] = spec['template'].format(pricing=pricing)
+        steps.append(ETLStep(spec['name'],
+                             partial(STEP_RUNNERS[spec['kind']], spec, context),
+                             depends_on=[d for d in spec.get('depends_on', []) if d in step_names],
+                             backend=STEP_BACKENDS[spec['kind']]))
+    return steps
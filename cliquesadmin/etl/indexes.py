@@ -0,0 +1,207 @@
+"""
+Declared indexes for the collections ETLs write to, so query & upsert performance doesn't
+depend on whatever was built by hand.
+
+`ensure_indexes` is called by ETL `load` methods before writing, `check_indexes` reports
+missing & unused indexes along with collection scans in the plans of the queries we run.
+
+Unique indexes can't be built on collections that already hold duplicate keys, so ETLs never
+build them, they're built once by bin/check_indexes.py --ensure after `remove_duplicates`.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DeleteMany
+from pymongo.errors import OperationFailure
+from cliquesadmin.etl.query_templates.mongo.daily_ad_stats import daily_ad_stats_pipeline, \
+    DAILY_AD_STATS_UPDATE_KEYS
+
+logger = logging.getLogger(__name__)
+
+# collection name -> list of index specs, each a dict of `keys` (list of (field, direction))
+# & any `create_index` options. Indexes are left w/ their default names, so ones created by
+# other means (e.g. `MongoAggregationETL.run_merge`) on the same keys are recognized.
+INDEX_SPECS = {
+    # `$match` on `hour` in daily_ad_stats_pipeline, and sync_dev_db sorts on it
+    'hourlyadstats': [
+        {'keys': [('hour', ASCENDING)]}
+    ],
+    'geoadstats': [
+        {'keys': [('hour', ASCENDING)]}
+    ],
+    'keywordadstats': [
+        {'keys': [('hour', ASCENDING)]}
+    ],
+    # upsert filter & `$merge` `on` fields, `date` first so per-day lookups can use it too
+    'dailyadstats': [
+        {'keys': [(k, ASCENDING) for k in DAILY_AD_STATS_UPDATE_KEYS], 'unique': True}
+    ]
+}
+
+_ensured = set()
+_ensured_lock = threading.Lock()
+
+
+def ensure_indexes(collection, specs=None, build_unique=False):
+    """
+    Creates any missing indexes declared for collection. Only hits the server the first
+    time it's called for a collection in this process.
+
+    Unless `build_unique`, missing unique indexes are only warned about, and failures are
+    logged rather than raised, so loads never fail over an index.
+
+    :param collection: pymongo Collection
+    :param specs: list of index specs, defaults to `INDEX_SPECS` entry for collection's name
+    :param build_unique: If True, build unique indexes too & raise on failure, e.g. from
+        bin/check_indexes.py --ensure once duplicates are removed
+    :return:
+    """
+    specs = INDEX_SPECS.get(collection.name, []) if specs is None else specs
+    if not specs:
+        return
+    with _ensured_lock:
+        if collection.full_name in _ensured:
+            return
+        for spec in specs:
+            options = dict((k, v) for k, v in spec.items() if k != 'keys')
+            # don't lock up production collections while building
+            options.setdefault('background', True)
+            try:
+                if spec.get('unique') and not build_unique:
+                    existing_keys = [list(info['key']) for info in collection.index_information().values()]
+                    if list(spec['keys']) not in existing_keys:
+                        logger.warn('Unique index on %s missing from %s, build it w/ bin/check_indexes.py --ensure'
+                                    % (spec['keys'], collection.full_name))
+                    continue
+                name = collection.create_index(spec['keys'], **options)
+                logger.debug('Ensured index %s on %s' % (name, collection.full_name))
+            except OperationFailure as e:
+                if build_unique:
+                    raise
+                logger.error('Could not ensure index on %s for %s, carrying on w/o it: %s'
+                             % (spec['keys'], collection.full_name, e))
+        _ensured.add(collection.full_name)
+
+
+def remove_duplicates(collection, keys, missing_value=None):
+    """
+    Deletes all but the most recently inserted document of each set of documents sharing the
+    same `keys`, so a unique index can be built on them.
+
+    :param collection: pymongo Collection
+    :param keys: list of fields
+    :param missing_value: if set, null & missing keys are set to this value first, e.g. '' for
+        dailyadstats, whose rollups store missing update keys that way
+    :return: list of distinct `keys` values (as dicts) which had duplicates
+    """
+    if missing_value is not None:
+        for k in keys:
+            result = collection.update_many({k: None}, {'$set': {k: missing_value}})
+            if result.modified_count:
+                logger.info('Set missing %s to %r in %s documents of %s'
+                            % (k, missing_value, result.modified_count, collection.full_name))
+    pipeline = [
+        {'$group': {'_id': dict((k, '$' + k) for k in keys), 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ]
+    duplicated = []
+    requests = []
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        duplicated.append(group['_id'])
+        # ObjectIds increase w/ insertion time
+        requests.append(DeleteMany({'_id': {'$in': sorted(group['ids'])[:-1]}}))
+        if len(requests) == 1000:
+            collection.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+    logger.info('Removed duplicates of %s keys from %s' % (len(duplicated), collection.full_name))
+    return duplicated
+
+
+def copy_indexes(source_collection, dest_collection):
+    """
+    Recreates all of source collection's indexes on dest collection, e.g. after a dropped
+    collection has been cloned.
+
+    :param source_collection: pymongo Collection to copy indexes from
+    :param dest_collection: pymongo Collection to create them on
+    :return: list of index names created
+    """
+    created = []
+    for name, info in source_collection.index_information().items():
+        if name == '_id_':
+            continue
+        options = dict((k, v) for k, v in info.items() if k not in ('key', 'v', 'ns'))
+        options['name'] = name
+        created.append(dest_collection.create_index(info['key'], **options))
+    return created
+
+
+def _plan_stages(plan):
+    """
+    Yields all stage names in a query plan tree.
+    """
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for v in plan.values():
+            for stage in _plan_stages(v):
+                yield stage
+    elif isinstance(plan, list):
+        for v in plan:
+            for stage in _plan_stages(v):
+                yield stage
+
+
+def check_queries(db):
+    """
+    Queries the ETLs run, as (collection name, description, explain function) tuples.
+    """
+    day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    upsert_filter = dict((k, '') for k in DAILY_AD_STATS_UPDATE_KEYS)
+    upsert_filter['date'] = day
+    return [
+        ('hourlyadstats', 'daily_ad_stats_pipeline',
+         lambda: db.command('aggregate', 'hourlyadstats', explain=True,
+                            pipeline=daily_ad_stats_pipeline(day, day + timedelta(days=1)))),
+        ('dailyadstats', 'daily upsert filter',
+         lambda: db.dailyadstats.find(upsert_filter).explain()),
+        ('dailyadstats', 'daily refresh by date',
+         lambda: db.dailyadstats.find({'date': day}).explain())
+    ]
+
+
+def check_indexes(db):
+    """
+    Reports on indexes of all collections in `INDEX_SPECS`.
+
+    :param db: pymongo Database
+    :return: dict w/ lists of `missing` (collection, keys), `unused` (collection, index name)
+        & `collscans` (collection, query description)
+    """
+    report = {'missing': [], 'unused': [], 'collscans': []}
+    existing_names = db.collection_names()
+    for name, specs in sorted(INDEX_SPECS.items()):
+        if name not in existing_names:
+            logger.info('Collection %s.%s does not exist yet, skipping' % (db.name, name))
+            continue
+        collection = db[name]
+        existing_keys = [list(info['key']) for info in collection.index_information().values()]
+        for spec in specs:
+            if list(spec['keys']) not in existing_keys:
+                report['missing'].append((name, spec['keys']))
+        # $indexStats needs MongoDB >= 3.2, usage counts reset on restart
+        try:
+            for stats in collection.aggregate([{'$indexStats': {}}]):
+                if stats['name'] != '_id_' and not stats['accesses']['ops']:
+                    report['unused'].append((name, stats['name']))
+        except Exception as e:
+            logger.warn('Could not get $indexStats for %s: %s' % (collection.full_name, e))
+
+    for name, description, explain in check_queries(db):
+        if name not in existing_names:
+            continue
+        if 'COLLSCAN' in set(_plan_stages(explain())):
+            report['collscans'].append((name, description))
+    return report
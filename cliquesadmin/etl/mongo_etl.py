@@ -1,6 +1,12 @@
 import logging
+from datetime import datetime, timedelta
+from time import time
 import pandas as pd
+from pymongo import UpdateOne
 from cliquesadmin.etl import ETL
+from cliquesadmin.etl.records import iter_cursor_frames
+from cliquesadmin.etl.indexes import ensure_indexes, INDEX_SPECS
+from cliquesadmin.etl.mongo_writer import MongoWriter, merge_insert_many_results, merge_bulk_write_results
 
 logger = logging.getLogger(__name__)
 
@@ -27,84 +33,165 @@ class MongoAggregationETL(ETL):
         Default is False.
     :param update_keys: List of fields in query results considered to be identifiers for update filter.
         If `upsert` == True, these must be provided.
+    :param query_options: kwargs for `aggregate`, e.g. `{'allowDiskUse': True, 'batchSize': 5000}`.
+        Default is `{'allowDiskUse': True}`.
+    :param chunksize: If set, aggregation cursor is consumed & loaded `chunksize` documents at a time.
+    :param writer_options: dict of `MongoWriter` kwargs used for loading, e.g. batch size, number of
+        writer threads & write concern.
+    :param merge: If True, `run` appends a `$merge` stage keyed on `update_keys` to the pipeline so results
+        are upserted into output_mongo_collection by the server itself & never pass through Python. `upsert`,
+        `chunksize` & `writer_options` are ignored. Requires MongoDB >= 4.2 & a unique index on `update_keys`,
+        which is created if missing. Default is False.
     """
     def __init__(self, pipeline_func, input_mongo_collection, output_mongo_collection,
-                 upsert=False, update_keys=None, query_options=None):
+                 upsert=False, update_keys=None, query_options=None, chunksize=None,
+                 writer_options=None, merge=False):
+        if query_options is None:
+            # let big $group stages spill to disk rather than fail at the 100MB limit
+            query_options = {'allowDiskUse': True}
         self.pipeline_func = pipeline_func
         self.input_mongo_collection = input_mongo_collection
         self.output_mongo_collection = output_mongo_collection
         self.upsert = upsert
         self.update_keys = update_keys
-        super(MongoAggregationETL, self).__init__(query_options=query_options)
+        self.merge = merge
+        if merge and not update_keys:
+            raise ValueError('update_keys must be provided to run a MongoAggregationETL with merge=True')
+        self.writer = MongoWriter(output_mongo_collection, **(writer_options or {}))
+        super(MongoAggregationETL, self).__init__(query_options=query_options, chunksize=chunksize)
 
     def run_query(self, pipeline, **kwargs):
         """
-        Runs query against Mongo collection and returns result
+        Runs query against Mongo collection and returns result cursor. `self.query_options`
+        are passed to `aggregate`, e.g. `allowDiskUse`, `batchSize` or `maxTimeMS`.
 
         :param kwargs: passed to template
         :return:
         """
-        return self.input_mongo_collection.aggregate(pipeline)
+        return self.input_mongo_collection.aggregate(pipeline, **self.query_options)
 
     def extract(self, **kwargs):
         """
-        Run BigQuery query and load response into dataframe
+        Run aggregation and stream cursor into a single dataframe
 
         :param kwargs: all kwargs passed directly into template as template vars
         :return:
         """
+        frames = list(self._iter_frames(None, **kwargs))
+        return frames[0] if frames else self.cast_columns(pd.DataFrame())
+
+    def extract_chunks(self, **kwargs):
+        """
+        Run aggregation and yield results from the cursor as DataFrames of
+        at most `self.chunksize` documents.
+
+        :param kwargs: all kwargs passed directly into pipeline_func
+        :return:
+        """
+        return self._iter_frames(self.chunksize, **kwargs)
+
+    def _iter_frames(self, chunksize, **kwargs):
         pipeline = self.pipeline_func(**kwargs)
-        results = self.run_query(pipeline)
-        results = list(results)
+        cursor = self.run_query(pipeline)
+        total = 0
+        for dataframe in iter_cursor_frames(cursor, chunksize):
+            total += len(dataframe)
+            yield self.cast_columns(dataframe)
         logger.info('MongoDB aggregation pipeline against %s returned %s results'
-                    % (self.input_mongo_collection, len(results)))
-        return pd.DataFrame(list(results))
+                    % (self.input_mongo_collection, total))
+
+    def cast_columns(self, dataframe):
+        """
+        Hook for subclasses to apply any type casting to a DataFrame of aggregation
+        results, called once per chunk in streaming mode.
+
+        :param dataframe:
+        :return:
+        """
+        return dataframe
 
     def load(self, dataframe):
         """
         Loads a pandas dataframe object into MongoDB collection.
 
-        If `self.upsert == True`, performs an individual row update using self.update_keys fields as
-        filter for each row. If `self.upsert == False`, just performs an `insert_many`.
+        If `self.upsert == True`, upserts rows using self.update_keys fields as filter for each row,
+        sent as batched `bulk_write`s by `self.writer`. If `self.upsert == False`, just inserts
+        them in batches.
 
         :param dataframe:
-        :return:
+        :return: BulkWriteResult if upserting, else InsertManyResult
         """
         if dataframe.empty:
             return {}
-        records = dataframe.to_dict(orient='records')
+        ensure_indexes(self.output_mongo_collection)
         if self.upsert:
-            updated = 0
-            inserted = 0
-            upserts = []
             logger.info('Now upserting rows to collection %s...' % self.output_mongo_collection)
-            for row in records:
-                # first convert timestamp fields to datetime
-                for k in row:
-                    if isinstance(row[k], pd.tslib.Timestamp):
-                        row[k] = row[k].to_datetime()
-                # now perform update w/ upsert = true
-                update_filter = {h: row[h] for h in self.update_keys}
-                result = self.output_mongo_collection.update_one(update_filter, {"$set": row}, upsert=True)
-                if result.matched_count:
-                    updated += result.matched_count
-                else:
-                    inserted += 1
-                upserts.append(result)
-            logger.info('Upsert complete. Updated %s rows, inserted %s new ones.' % (updated, inserted))
-            return upserts
+            result = self.writer.upsert_dataframe(dataframe, self.update_keys)
+            logger.info('Upsert complete. Updated %s rows, inserted %s new ones.'
+                        % (result.matched_count, result.upserted_count))
+            return result
         else:
             logger.info('Now inserting rows to collection %s...' % self.output_mongo_collection)
-            # Not proud of this, would love to figure out a way
-            # around this natively in Pandas
-            for row in records:
-                for k in row:
-                    if isinstance(row[k], pd.tslib.Timestamp):
-                        row[k] = row[k].to_datetime()
-            res = self.output_mongo_collection.insert_many(records)
+            res = self.writer.insert_dataframe(dataframe)
             logger.info('Insert complete, inserted %s rows.' % len(res.inserted_ids))
             return res
 
+    def merge_stages(self):
+        """
+        Stages appended to the pipeline in merge mode. `$merge` refuses documents w/ a missing or
+        null `on` field, so the pipeline itself must fill in missing update keys, the same way for
+        every mode (see `daily_ad_stats_pipeline`).
+
+        :return: list of pipeline stages
+        """
+        return [
+            {'$merge': {
+                'into': self.output_mongo_collection.name,
+                'on': list(self.update_keys),
+                'whenMatched': 'merge',
+                'whenNotMatched': 'insert'
+            }}
+        ]
+
+    def run_merge(self, **kwargs):
+        """
+        Runs pipeline w/ `merge_stages` appended, so results are written by the server.
+
+        :param kwargs: all kwargs passed directly into pipeline_func
+        :return: dict of run stats
+        """
+        # $merge needs a unique index on its `on` fields, built by bin/check_indexes.py --ensure,
+        # this only builds non-unique ones & warns if it's missing
+        ensure_indexes(self.output_mongo_collection,
+                       specs=INDEX_SPECS.get(self.output_mongo_collection.name) or
+                       [{'keys': [(k, 1) for k in self.update_keys], 'unique': True}])
+        pipeline = self.pipeline_func(**kwargs) + self.merge_stages()
+        start = time()
+        # $merge returns no documents, just exhaust the cursor
+        for _ in self.run_query(pipeline):
+            pass
+        elapsed = time() - start
+        logger.info('Merged aggregation of %s into %s server-side in %.2fs'
+                    % (self.input_mongo_collection.full_name, self.output_mongo_collection.full_name, elapsed))
+        return {'into': self.output_mongo_collection.full_name, 'elapsed': elapsed}
+
+    def run(self, **kwargs):
+        if self.merge:
+            return self.run_merge(**kwargs)
+        return super(MongoAggregationETL, self).run(**kwargs)
+
+    def combine_load_results(self, results):
+        """
+        Merges per-chunk load results: `BulkWriteResult`s of upserts are merged into one,
+        as are `InsertManyResult`s.
+
+        :param results: list of per-chunk `load` results
+        :return:
+        """
+        if self.upsert:
+            return merge_bulk_write_results(results)
+        return merge_insert_many_results(results)
+
 
 class DailyMongoAggregationETL(MongoAggregationETL):
     """
@@ -120,24 +207,177 @@ class DailyMongoAggregationETL(MongoAggregationETL):
 
     def extract(self, **kwargs):
         """
-        Run BigQuery query and load response into dataframe
+        Run aggregation and stream cursor into a single dataframe
 
         :param kwargs: all kwargs passed directly into template as template vars
         :return:
         """
-        pipeline = self.pipeline_func(**kwargs)
-        results = self.run_query(pipeline)
-        results = list(results)
-        logger.info('MongoDB aggregation pipeline against %s returned %s results'
-                    % (self.input_mongo_collection, len(results)))
-        results = pd.DataFrame(results)
-        # Cast date_field to date
-        if not results.empty:
-            results[self.date_field] = results[self.date_field].astype('datetime64[s]')
-            logger.info('Date that will be inserted using as_type: %s' % results[self.date_field][0])
-            # results[self.date_field] = pd.to_datetime(results[self.date_field][0], utc=True)
-            # logger.info('Date that will be inserted using to_datetime: %s' % results[self.date_field][0])
-        else:
+        results = super(DailyMongoAggregationETL, self).extract(**kwargs)
+        if results.empty:
             logger.info('No results returned from aggregation pipeline against %s, skipping remaining steps...'
                         % self.input_mongo_collection)
         return results
+
+    def cast_columns(self, dataframe):
+        """
+        Casts `date_field` to datetime.
+
+        :param dataframe:
+        :return:
+        """
+        # Cast date_field to date. Pipelines now return it as a Date already, & old pandas refuses to
+        # astype datetime64[ns] to another unit, so only convert what isn't datetime64 yet
+        if not dataframe.empty:
+            dataframe[self.date_field] = pd.to_datetime(dataframe[self.date_field])
+            logger.info('Date that will be inserted: %s' % dataframe[self.date_field][0])
+        return dataframe
+
+
+class AppliedHoursLedger(object):
+    """
+    Records which hours have been rolled into an incrementally maintained collection, so
+    rerunning an hour can't add its deltas twice. One document per hour, w/ the hour as `_id`.
+
+    :param collection: pymongo Collection holding the ledger
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def applied(self, hours):
+        """
+        :param hours: list of hour datetimes
+        :return: set of those hours already applied
+        """
+        return set(doc['_id'] for doc in self.collection.find({'_id': {'$in': list(hours)}}, {'_id': 1}))
+
+    def mark(self, hours, mode):
+        """
+        Records hours as applied.
+
+        :param hours: list of hour datetimes
+        :param mode: how they were applied, e.g. 'incremental' or 'full', for the record
+        """
+        now = datetime.utcnow()
+        requests = [UpdateOne({'_id': hour}, {'$set': {'applied': now, 'mode': mode}}, upsert=True)
+                    for hour in hours]
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+
+class IncrementalDailyMongoAggregationETL(DailyMongoAggregationETL):
+    """
+    Daily rollup which only aggregates newly loaded hours, applying each hour's totals to
+    the output collection as `$inc` deltas instead of recomputing the whole day so far.
+
+    - `pipeline_func` is run once per hour in [start_datetime, end_datetime) & must output
+      per-hour totals for every field in `sum_fields`.
+    - Averages can't be incremented, so each is stored alongside sum & count companions
+      (which are in `sum_fields`) & recomputed from them once the hour is applied.
+    - Hours already in `ledger` are skipped, so reruns are safe. A failed hour may have been
+      partially applied though: recompute the day w/ `DailyMongoAggregationETL` & `mark_full_recompute`
+      to recover.
+
+    :param date_field: see `DailyMongoAggregationETL`
+    :param sum_fields: list of fields to `$inc`
+    :param average_fields: dict of average field -> (sum field, count field)
+    :param ledger: `AppliedHoursLedger`
+    """
+    def __init__(self, date_field, pipeline_func, input_mongo_collection, output_mongo_collection,
+                 update_keys, sum_fields, ledger, average_fields=None, **kwargs):
+        self.sum_fields = sum_fields
+        self.average_fields = average_fields or {}
+        self.ledger = ledger
+        super(IncrementalDailyMongoAggregationETL, self).__init__(date_field, pipeline_func, input_mongo_collection,
+                                                                  output_mongo_collection, upsert=True,
+                                                                  update_keys=update_keys, **kwargs)
+
+    def transform(self, dataframe):
+        """
+        Drops averages, which are only valid for this hour & are recomputed after loading.
+        """
+        return dataframe.drop([c for c in self.average_fields if c in dataframe.columns], axis=1)
+
+    def load(self, dataframe):
+        """
+        Applies rows to output collection, incrementing `sum_fields` & setting everything else.
+
+        :param dataframe:
+        :return: BulkWriteResult
+        """
+        if dataframe.empty:
+            return {}
+        ensure_indexes(self.output_mongo_collection)
+        logger.info('Now applying %s rows of deltas to collection %s...' % (len(dataframe), self.output_mongo_collection))
+        result = self.writer.upsert_dataframe(dataframe, self.update_keys, inc_fields=self.sum_fields)
+        logger.info('Deltas applied. Updated %s rows, inserted %s new ones.'
+                    % (result.matched_count, result.upserted_count))
+        return result
+
+    def refresh_averages(self, date):
+        """
+        Recomputes `average_fields` from their sum & count companions for all documents on date.
+
+        :param date: value of `date_field` to refresh
+        :return: number of documents updated
+        """
+        if not self.average_fields:
+            return 0
+        projection = {}
+        for avg_field, (sum_field, count_field) in self.average_fields.items():
+            projection.update({avg_field: 1, sum_field: 1, count_field: 1})
+        requests = []
+        for doc in self.output_mongo_collection.find({self.date_field: date}, projection):
+            update = {}
+            for avg_field, (sum_field, count_field) in self.average_fields.items():
+                count = doc.get(count_field)
+                value = doc.get(sum_field) / float(count) if count else None
+                if avg_field not in doc or doc[avg_field] != value:
+                    update[avg_field] = value
+            if update:
+                requests.append(UpdateOne({'_id': doc['_id']}, {'$set': update}))
+        for i in range(0, len(requests), self.writer.batch_size):
+            self.output_mongo_collection.bulk_write(requests[i:i + self.writer.batch_size], ordered=False)
+        return len(requests)
+
+    def run(self, start_datetime=None, end_datetime=None, **kwargs):
+        """
+        Applies each hour in [start_datetime, end_datetime) not yet in the ledger.
+
+        :return: dict of hour -> load result for the hours applied
+        """
+        hours = []
+        hour = start_datetime.replace(minute=0, second=0, microsecond=0)
+        while hour < end_datetime:
+            hours.append(hour)
+            hour += timedelta(hours=1)
+        applied = self.ledger.applied(hours)
+        results = {}
+        dates = set()
+        for hour in hours:
+            if hour in applied:
+                logger.warn('Hour %s already applied to %s, skipping' % (hour, self.output_mongo_collection))
+                continue
+            start = time()
+            results[hour] = super(IncrementalDailyMongoAggregationETL, self).run(
+                start_datetime=hour, end_datetime=hour + timedelta(hours=1), **kwargs)
+            self.ledger.mark([hour], 'incremental')
+            dates.add(hour.replace(hour=0))
+            logger.info('Applied hour %s to %s in %.2fs' % (hour, self.output_mongo_collection, time() - start))
+        for date in sorted(dates):
+            refreshed = self.refresh_averages(date)
+            logger.info('Refreshed averages of %s documents for %s' % (refreshed, date))
+        return results
+
+
+def mark_full_recompute(ledger, hourly_collection, start_datetime, end_datetime):
+    """
+    Marks all hours w/ data in [start_datetime, end_datetime) as applied after a full recompute
+    of those hours, so incremental runs don't add them again.
+
+    :param ledger: `AppliedHoursLedger`
+    :param hourly_collection: pymongo Collection the rollup reads from, w/ an `hour` field
+    :param start_datetime:
+    :param end_datetime:
+    """
+    hours = hourly_collection.distinct('hour', {'hour': {'$gte': start_datetime, '$lt': end_datetime}})
+    ledger.mark(hours, 'full')
@@ -0,0 +1,218 @@
+import sys
+import logging
+import threading
+from time import time, sleep
+import six
+from six.moves import queue
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, AutoReconnect
+from pymongo.results import InsertManyResult, BulkWriteResult
+from pymongo.write_concern import WriteConcern
+from cliquesadmin.etl.records import iter_record_batches, DEFAULT_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def merge_insert_many_results(results):
+    """
+    Merges `InsertManyResult`s from several `insert_many` calls into one.
+
+    :param results: list of InsertManyResults
+    :return: InsertManyResult
+    """
+    inserted_ids = []
+    for result in results:
+        inserted_ids.extend(result.inserted_ids)
+    return InsertManyResult(inserted_ids, all(result.acknowledged for result in results))
+
+
+def merge_bulk_write_results(results):
+    """
+    Merges `BulkWriteResult`s from several `bulk_write` calls into one.
+
+    :param results: list of BulkWriteResults
+    :return: BulkWriteResult
+    """
+    merged = {
+        'nInserted': 0,
+        'nUpserted': 0,
+        'nMatched': 0,
+        'nModified': 0,
+        'nRemoved': 0,
+        'upserted': [],
+        'writeErrors': [],
+        'writeConcernErrors': []
+    }
+    for result in results:
+        raw = result.bulk_api_result
+        for k in ('nInserted', 'nUpserted', 'nMatched', 'nRemoved'):
+            merged[k] += raw.get(k, 0)
+        # nModified is missing when talking to servers older than 2.6
+        if merged['nModified'] is not None and raw.get('nModified') is not None:
+            merged['nModified'] += raw['nModified']
+        else:
+            merged['nModified'] = None
+        merged['upserted'].extend(raw.get('upserted', []))
+        merged['writeErrors'].extend(raw.get('writeErrors', []))
+        merged['writeConcernErrors'].extend(raw.get('writeConcernErrors', []))
+    if merged['nModified'] is None:
+        del merged['nModified']
+    return BulkWriteResult(merged, all(result.acknowledged for result in results))
+
+
+class MongoWriter(object):
+    """
+    Writes DataFrames to a MongoDB collection in batches, shared by all ETL `load` methods.
+
+    - Rows are turned into documents one batch at a time (see `cliquesadmin.etl.records`),
+      so only `batch_size` documents per writer thread are in memory at once.
+    - Batches are written unordered by default, so one slow or bad document doesn't hold
+      up the rest of its batch.
+    - Up to `num_threads` batches are in flight at once.
+    - A batch which fails w/ a network error or write errors is retried on its own, up to
+      `max_retries` times, without re-sending any other batch. Duplicate key errors on a
+      retried insert just mean the first attempt got those documents in, and are ignored.
+      Upserts which `$inc` fields aren't idempotent, so are never retried.
+
+    :param collection: pymongo Collection to write to
+    :param batch_size: documents per `insert_many` / `bulk_write` call
+    :param num_threads: number of batches written concurrently. Default is 1.
+    :param write_concern: `WriteConcern` or dict of WriteConcern kwargs, e.g. `{'w': 1, 'j': False}`
+        for aggregates which can be rebuilt from BigQuery. Default is the collection's own.
+    :param ordered: passed to `insert_many` / `bulk_write`. Default is False.
+    :param max_retries: number of times a failed batch is retried
+    :param retry_delay: seconds to wait before the first retry, doubled each time
+    """
+    def __init__(self, collection, batch_size=DEFAULT_BATCH_SIZE, num_threads=1, write_concern=None,
+                 ordered=False, max_retries=3, retry_delay=1.0):
+        if isinstance(write_concern, dict):
+            write_concern = WriteConcern(**write_concern)
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=write_concern)
+        self.collection = collection
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.ordered = ordered
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def insert_dataframe(self, dataframe):
+        """
+        Inserts dataframe rows as new documents.
+
+        :param dataframe:
+        :return: InsertManyResult covering all batches
+        """
+        return merge_insert_many_results(self._write_batches(self._insert_batch, dataframe))
+
+    def upsert_dataframe(self, dataframe, update_keys, inc_fields=None):
+        """
+        Upserts dataframe rows, matching existing documents on `update_keys` fields.
+
+        Fields in `inc_fields` are added to existing values w/ `$inc`, all others are `$set`. As `$inc`
+        isn't idempotent, batches w/ `inc_fields` are never retried: a failed batch may have been
+        partially applied.
+
+        :param dataframe:
+        :param update_keys: list of fields identifying a document
+        :param inc_fields: list of fields to increment rather than overwrite
+        :return: BulkWriteResult covering all batches
+        """
+        inc_fields = set(inc_fields or [])
+        return merge_bulk_write_results(
+            self._write_batches(lambda batch, retry: self._upsert_batch(batch, update_keys, inc_fields, retry),
+                                dataframe, retryable=not inc_fields))
+
+    def _insert_batch(self, batch, retry):
+        try:
+            self.collection.insert_many(batch, ordered=self.ordered)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if not retry or e.details.get('writeConcernErrors') or \
+                    any(err.get('code') != DUPLICATE_KEY_ERROR for err in errors):
+                raise
+        # insert_many sets `_id` on each document before sending it
+        return InsertManyResult([doc['_id'] for doc in batch], self.collection.write_concern.acknowledged)
+
+    def _upsert_batch(self, batch, update_keys, inc_fields, retry):
+        requests = []
+        for row in batch:
+            update = {'$set': dict((k, v) for k, v in row.items() if k not in inc_fields)}
+            if inc_fields:
+                update['$inc'] = dict((k, v) for k, v in row.items() if k in inc_fields)
+            # a chunk where no document has one of the keys has no column for it at all,
+            # matching on None finds documents where it's null or missing, same as a NaN row would
+            requests.append(UpdateOne(dict((k, row.get(k)) for k in update_keys), update, upsert=True))
+        return self.collection.bulk_write(requests, ordered=self.ordered)
+
+    def _write_batch(self, write_batch, batch, retryable=True):
+        """
+        Writes one batch, retrying just this batch on failure if `retryable`.
+        """
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            start = time()
+            try:
+                result = write_batch(batch, attempt > 0)
+            except (AutoReconnect, BulkWriteError) as e:
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warn('Write of %s documents to %s failed (%s), retry %s of %s in %.1fs'
+                            % (len(batch), self.collection.full_name, e, attempt, self.max_retries, delay))
+                sleep(delay)
+                delay *= 2
+                continue
+            elapsed = time() - start
+            logger.info('Wrote batch of %s documents to %s in %.2fs (%.0f docs/sec)'
+                        % (len(batch), self.collection.full_name, elapsed, len(batch) / max(elapsed, 1e-6)))
+            return result
+
+    def _write_batches(self, write_batch, dataframe, retryable=True):
+        """
+        Writes all of dataframe's batches w/ up to `self.num_threads` in flight at once.
+
+        :return: list of per-batch results
+        """
+        batches = iter_record_batches(dataframe, batch_size=self.batch_size)
+        if self.num_threads <= 1:
+            return [self._write_batch(write_batch, batch, retryable) for batch in batches]
+
+        # bounded queue, so batches are only built as fast as threads can write them
+        work = queue.Queue(maxsize=self.num_threads)
+        results = []
+        errors = []
+
+        def worker():
+            while True:
+                batch = work.get()
+                if batch is None:
+                    return
+                if errors:
+                    continue
+                try:
+                    results.append(self._write_batch(write_batch, batch, retryable))
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=worker, name='mongo-writer-%s' % i)
+                   for i in range(self.num_threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            for batch in batches:
+                if errors:
+                    break
+                work.put(batch)
+        finally:
+            for _ in threads:
+                work.put(None)
+            for t in threads:
+                t.join()
+        if errors:
+            six.reraise(*errors[0])
+        return results
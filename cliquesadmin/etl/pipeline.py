@@ -0,0 +1,200 @@
+import sys
+import logging
+import threading
+from time import time
+import six
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+# marks the end of the chunk stream between stages
+_END_OF_STREAM = object()
+
+
+class StageStats(object):
+    """
+    Busy/idle accounting for a single pipeline stage.
+
+    `busy` is time spent doing the stage's own work (pulling a page, transforming,
+    loading), `idle` is time spent blocked waiting on the upstream queue or on a
+    full downstream queue. The stage with the most busy time is the bottleneck.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.idle = 0.0
+        self.chunks = 0
+
+    @property
+    def utilization(self):
+        total = self.busy + self.idle
+        return self.busy / total if total else 0.0
+
+    def __repr__(self):
+        return '<StageStats %s: %s chunks, busy %.2fs, idle %.2fs (%.0f%% utilized)>' % \
+               (self.name, self.chunks, self.busy, self.idle, self.utilization * 100)
+
+
+class PipelinedETLRunner(object):
+    """
+    Runs an `ETL` with extract, transform & load overlapped in separate threads.
+
+    Stages are joined by bounded queues of `queue_size` chunks, so e.g. the next page
+    of a BigQuery result can be fetched while the current chunk is being written to
+    MongoDB, while still holding at most ~(2 * queue_size + 3) chunks in memory.
+
+    ETL must be run in streaming mode, i.e. have `chunksize` set, otherwise
+    `extract_chunks` yields a single chunk and there is nothing to overlap.
+
+    Usage::
+
+        runner = PipelinedETLRunner(etl, queue_size=2)
+        result = runner.run(start=start, end=end, dataset=dataset)
+        logger.info(runner.stage_stats)
+
+    :param etl: ETL instance to run
+    :param queue_size: max number of chunks buffered between two stages
+    """
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, etl, queue_size=2):
+        self.etl = etl
+        self.queue_size = queue_size
+        self.stage_stats = []
+        self._stop = threading.Event()
+        self._exc_info = None
+
+    def _put(self, q, item, stats):
+        """
+        Puts item on queue, counting time blocked on a full queue as idle. Gives up
+        if another stage has failed.
+        """
+        start = time()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=self.POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+        stats.idle += time() - start
+
+    def _get(self, q, stats):
+        """
+        Gets item from queue, counting time waiting on upstream as idle. Returns
+        end-of-stream marker if another stage has failed.
+        """
+        start = time()
+        item = _END_OF_STREAM
+        while not self._stop.is_set():
+            try:
+                item = q.get(timeout=self.POLL_INTERVAL)
+                break
+            except queue.Empty:
+                continue
+        stats.idle += time() - start
+        return item
+
+    def _fail(self):
+        # keep the first exception only, later ones are usually fallout
+        if self._exc_info is None:
+            self._exc_info = sys.exc_info()
+        self._stop.set()
+
+    def _extract_stage(self, out_q, stats, kwargs):
+        try:
+            chunks = iter(self.etl.extract_chunks(**kwargs))
+            while not self._stop.is_set():
+                start = time()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    stats.busy += time() - start
+                stats.chunks += 1
+                self._put(out_q, chunk, stats)
+        except Exception:
+            self._fail()
+        finally:
+            self._put(out_q, _END_OF_STREAM, stats)
+
+    def _transform_stage(self, in_q, out_q, stats):
+        try:
+            while True:
+                chunk = self._get(in_q, stats)
+                if chunk is _END_OF_STREAM:
+                    break
+                if chunk.empty:
+                    continue
+                start = time()
+                chunk = self.etl.transform(chunk)
+                stats.busy += time() - start
+                stats.chunks += 1
+                self._put(out_q, chunk, stats)
+        except Exception:
+            self._fail()
+        finally:
+            self._put(out_q, _END_OF_STREAM, stats)
+
+    def _load_stage(self, in_q, stats, results):
+        try:
+            while True:
+                chunk = self._get(in_q, stats)
+                if chunk is _END_OF_STREAM:
+                    break
+                start = time()
+                results.append(self.etl.load(chunk))
+                stats.busy += time() - start
+                stats.chunks += 1
+        except Exception:
+            self._fail()
+
+    def run(self, **kwargs):
+        """
+        Runs ETL with all three stages overlapped & blocks until the load stage has
+        drained the pipeline. Any exception raised in a stage stops the other stages
+        and is re-raised here.
+
+        :param kwargs: all kwargs passed directly into template as template vars
+        :return: combined load result as returned by `ETL.combine_load_results`,
+            or None if nothing was extracted
+        """
+        if not self.etl.chunksize:
+            logger.warn('%s has no chunksize set, pipelined run will not overlap any stages'
+                        % self.etl.__class__.__name__)
+        self._stop.clear()
+        self._exc_info = None
+        extract_stats = StageStats('extract')
+        transform_stats = StageStats('transform')
+        load_stats = StageStats('load')
+        self.stage_stats = [extract_stats, transform_stats, load_stats]
+
+        extracted_q = queue.Queue(maxsize=self.queue_size)
+        transformed_q = queue.Queue(maxsize=self.queue_size)
+        results = []
+        threads = [
+            threading.Thread(target=self._extract_stage, name='etl-extract',
+                             args=(extracted_q, extract_stats, kwargs)),
+            threading.Thread(target=self._transform_stage, name='etl-transform',
+                             args=(extracted_q, transformed_q, transform_stats)),
+            threading.Thread(target=self._load_stage, name='etl-load',
+                             args=(transformed_q, load_stats, results))
+        ]
+        start = time()
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time() - start
+
+        for stats in self.stage_stats:
+            logger.info('Pipelined %s %s' % (self.etl.__class__.__name__, stats))
+        bottleneck = max(self.stage_stats, key=lambda s: s.busy)
+        logger.info('Pipelined run finished in %.2fs, bottleneck stage: %s' % (elapsed, bottleneck.name))
+
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        if not results:
+            return None
+        return self.etl.combine_load_results(results)
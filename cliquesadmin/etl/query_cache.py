@@ -0,0 +1,213 @@
+import os
+import json
+import errno
+import logging
+import hashlib
+import threading
+from time import time
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class QueryResultCache(object):
+    """
+    Local on-disk cache of query results, so reruns over the same hours (e.g. retrying
+    the MongoDB half of a failed run) don't pay for the same BigQuery scans again.
+
+    - Entries are keyed by a hash of the rendered query & its parameters (see `make_key`).
+    - Each entry is a zlib-compressed msgpack file holding one or more DataFrames
+      (one per chunk in streaming mode), which pandas stores column-block-wise.
+    - Entries older than `ttl` seconds are treated as misses & deleted.
+    - Once the cache grows past `max_bytes`, least recently used entries are evicted.
+      Last use is tracked in each file's atime, creation time in its mtime.
+
+    Safe to share between threads & processes: entries are written to a temp file and
+    renamed into place once complete. Temp files of writers that died are removed by `evict`.
+
+    :param cache_dir: directory to store entries in, created if it doesn't exist
+    :param max_bytes: max total size of all entries
+    :param ttl: max age of an entry in seconds, None never expires entries
+    """
+    EXTENSION = '.msgpack'
+    # entries are written to `<entry path><TMP_MARKER><pid>-<thread ident>` & renamed once complete
+    TMP_MARKER = '.tmp-'
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, ttl=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def make_key(rendered_template, params=None):
+        """
+        Hashes rendered query along with any parameters that affect its result, e.g.
+        template vars & query options. Callables (like error callbacks) are ignored.
+
+        :param rendered_template: rendered query string
+        :param params: dict of parameters
+        :return: hex digest
+        """
+        params = dict((k, v) for k, v in (params or {}).items() if not callable(v))
+        key = hashlib.sha1(rendered_template.encode('utf-8'))
+        key.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+        return key.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.EXTENSION)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _lookup(self, key):
+        """
+        Returns path of live entry for key, or None on a miss. Deletes expired entries.
+        """
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._count(False)
+            return None
+        now = time()
+        if self.ttl is not None and now - stat.st_mtime > self.ttl:
+            logger.info('Query result cache entry %s expired, removing' % key)
+            self._remove(path)
+            self._count(False)
+            return None
+        # mark as recently used, keeping mtime as creation time for TTL
+        os.utime(path, (now, stat.st_mtime))
+        self._count(True)
+        return path
+
+    def iter_chunks(self, key):
+        """
+        Returns iterator over cached DataFrame chunks for key, or None on a miss.
+        """
+        path = self._lookup(key)
+        if path is None:
+            logger.info('Query result cache MISS for %s (%s hits, %s misses)' % (key, self.hits, self.misses))
+            return None
+        logger.info('Query result cache HIT for %s (%s hits, %s misses)' % (key, self.hits, self.misses))
+        return pd.read_msgpack(path, iterator=True)
+
+    def get(self, key):
+        """
+        Returns cached DataFrame for key, or None on a miss. Chunks are concatenated.
+        """
+        chunks = self.iter_chunks(key)
+        if chunks is None:
+            return None
+        chunks = list(chunks)
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, ignore_index=True)
+
+    def put_chunks(self, key, chunks):
+        """
+        Wraps iterator of DataFrame chunks, writing each one to the cache as it passes
+        through. Entry is only committed once `chunks` is exhausted, so a partially
+        retrieved result is never cached.
+
+        If the consumer stops early, e.g. because loading a chunk failed, the rest of `chunks`
+        is written w/o being yielded & the entry committed anyway, so a retry reads the result
+        back rather than querying again.
+
+        :param key: cache key
+        :param chunks: iterable of DataFrames
+        :return: generator yielding the same chunks
+        """
+        path = self.path(key)
+        tmp_path = '%s%s%s-%s' % (path, self.TMP_MARKER, os.getpid(), threading.current_thread().ident)
+        chunks = iter(chunks)
+        committed = False
+        try:
+            try:
+                for chunk in chunks:
+                    pd.to_msgpack(tmp_path, chunk, append=True, compress='zlib')
+                    yield chunk
+            except GeneratorExit:
+                logger.info('Result for cache entry %s abandoned partway through, caching the rest' % key)
+                for chunk in chunks:
+                    pd.to_msgpack(tmp_path, chunk, append=True, compress='zlib')
+            if not os.path.exists(tmp_path):
+                # nothing came back, store empty frame so empty results are cached too
+                pd.to_msgpack(tmp_path, pd.DataFrame(), compress='zlib')
+            os.rename(tmp_path, path)
+            committed = True
+            logger.info('Saved query result to cache entry %s' % key)
+        finally:
+            if not committed:
+                self._remove(tmp_path)
+        self.evict()
+
+    def put(self, key, dataframe):
+        """
+        Stores a single DataFrame in the cache.
+        """
+        for _ in self.put_chunks(key, [dataframe]):
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _is_stale_tmp(self, name):
+        """
+        Whether temp file `name` was left behind by a writer that's gone, i.e. a crashed
+        process or a thread of this one that died mid-write.
+        """
+        try:
+            pid, ident = [int(part) for part in name.rsplit(self.TMP_MARKER, 1)[1].split('-')]
+        except ValueError:
+            return False
+        if pid == os.getpid():
+            return ident not in set(t.ident for t in threading.enumerate())
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        return False
+
+    def evict(self):
+        """
+        Deletes temp files of dead writers & expired entries, then least recently used
+        entries until the cache fits in `max_bytes`.
+        """
+        now = time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if self.TMP_MARKER in name:
+                if self._is_stale_tmp(name):
+                    logger.info('Removing query result cache temp file %s of a dead writer' % name)
+                    self._remove(path)
+                continue
+            if not name.endswith(self.EXTENSION):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if self.ttl is not None and now - stat.st_mtime > self.ttl:
+                self._remove(path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.info('Evicting query result cache entry %s' % os.path.basename(path))
+            self._remove(path)
+            total -= size
@@ -1,41 +1,31 @@
 #standardSQL
+{% import 'macros.sql' as bq with context %}
 SELECT
   TIMESTAMP('{{ start }}') AS hour,
-  auctions.publisher AS publisher,
-  auctions.site AS site,
-  auctions.page AS page,
-  imps.advertiser AS advertiser,
-  imps.campaign AS campaign,
-  auctions.pub_clique AS pub_clique,
-  imps.adv_clique AS adv_clique,
-  auctions.country AS country,
-  CONCAT(auctions.country, '-', auctions.region) AS region,
-  auctions.city AS city,
-  auctions.metro AS DMA,
-  auctions.zip AS zip,
-  AVG(auction_stats.clearprice) AS clearprice,
-  SUM(auction_stats.num_bids) AS bids,
-  SUM(auction_stats.clearprice * IF(clicks.clickid is null, 0, 1)) AS spend,
-  COUNT(auctions.impid) AS imps,
-  COUNT(DISTINCT(auctions.uuid)) AS uniques,
-  COUNT(clicks.clickid) AS clicks,
+  facts.publisher AS publisher,
+  facts.site AS site,
+  facts.page AS page,
+  facts.advertiser AS advertiser,
+  facts.campaign AS campaign,
+  facts.pub_clique AS pub_clique,
+  facts.adv_clique AS adv_clique,
+  facts.country AS country,
+  CONCAT(facts.country, '-', facts.region) AS region,
+  facts.city AS city,
+  facts.metro AS DMA,
+  facts.zip AS zip,
+  AVG(facts.clearprice) AS clearprice,
+  SUM(facts.num_bids) AS bids,
+  SUM(facts.clearprice * IF(facts.clickid is null, 0, 1)) AS spend,
+  COUNT(facts.impid) AS imps,
+  COUNT(DISTINCT(facts.uuid)) AS uniques,
+  COUNT(facts.clickid) AS clicks,
   0 AS view_convs,
   0 AS click_convs
 FROM
-  `{{ dataset }}.auctions` AS auctions
-INNER JOIN `{{ dataset }}.impressions` AS imps
-ON
-  auctions.impid = imps.impid
-INNER JOIN `{{ dataset }}.auction_stats` AS auction_stats
-ON
-  auctions.impid = auction_stats.impid AND
-  auctions.auctionId = auction_stats.auctionId
-LEFT JOIN `{{ dataset }}.clicks` AS clicks
-ON
-  auctions.impid = clicks.impid
+  `{{ dataset }}.hourly_imp_facts` AS facts
 WHERE
-  auctions.tstamp >= TIMESTAMP('{{ start }}')
-  AND auctions.tstamp < TIMESTAMP('{{ end }}')
+  {{ bq.window('facts', start, end) }}
 GROUP BY
   publisher,
   site,
@@ -1,4 +1,5 @@
 #standardSQL
+{% import 'macros.sql' as bq with context %}
 SELECT
     TIMESTAMP('{{ start }}') AS hour,
     i.publisher AS publisher,
@@ -26,9 +27,9 @@ SELECT
   LEFT OUTER JOIN `{{ dataset }}.click_matched_actions` AS c
   ON
     c.actionid = i.actionid
+    AND {{ bq.window('c', start, end, column='action_tstamp') }}
   WHERE
-    i.action_tstamp >= TIMESTAMP('{{ start }}')
-    AND i.action_tstamp < TIMESTAMP('{{ end }}')
+    {{ bq.window('i', start, end, column='action_tstamp') }}
   GROUP BY
     actionbeacon,
     adv_clique,
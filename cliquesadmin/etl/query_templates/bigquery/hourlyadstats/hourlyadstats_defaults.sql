@@ -1,4 +1,5 @@
 #standardSQL
+{% import 'macros.sql' as bq with context %}
 SELECT
   TIMESTAMP('{{ start }}') AS hour,
   auctions.publisher AS publisher,
@@ -23,9 +24,10 @@ ON
   -- TODO: on auctionId AND impId in this case results in the same number of records, even though those records
   -- TODO: on the right side of the join are duplicates.
   auctions.auctionId = defaults.auctionId
+  -- defaults are logged along w/ their auction
+  AND {{ bq.partitions('defaults', start, end) }}
 WHERE
-  auctions.tstamp >= TIMESTAMP('{{ start }}')
-  AND auctions.tstamp < TIMESTAMP('{{ end }}')
+  {{ bq.events('auctions', start, end) }}
 GROUP BY
   publisher,
   site,
@@ -1,4 +1,5 @@
 #standardSQL
+{% import 'macros.sql' as bq with context %}
 SELECT
   tstamp,
   auctionId,
@@ -56,8 +57,7 @@ FROM ( (
             FROM
               `{{ dataset }}.bids`
             WHERE
-              tstamp >= TIMESTAMP('{{ wideStart }}')
-              AND tstamp < TIMESTAMP('{{ wideEnd }}')
+              {{ bq.events('', wideStart, wideEnd) }}
             GROUP BY
               auctionId,
               impid,
@@ -68,17 +68,13 @@ FROM ( (
           AND b.adv_clique = m.adv_clique
           AND b.bid = m.max_bid
         WHERE
-          b.tstamp >= TIMESTAMP('{{ wideStart }}')
-          AND b.tstamp < TIMESTAMP('{{ wideEnd }}') )) AS max_bids
+          {{ bq.events('b', wideStart, wideEnd) }} )) AS max_bids
     ON
       bids.bidid = max_bids.bidid
     WHERE
-      auctions.tstamp >= TIMESTAMP('{{ start }}')
-      AND auctions.tstamp < TIMESTAMP('{{ end }}')
-      AND impressions.tstamp >= TIMESTAMP('{{ wideStart }}')
-      AND impressions.tstamp < TIMESTAMP('{{ wideEnd }}')
-      AND bids.tstamp >= TIMESTAMP('{{ wideStart }}')
-      AND bids.tstamp < TIMESTAMP('{{ wideEnd }}')
+      {{ bq.events('auctions', start, end) }}
+      AND {{ bq.events('impressions', wideStart, wideEnd) }}
+      AND {{ bq.events('bids', wideStart, wideEnd) }}
       AND auctions.level = 'info'
     GROUP BY
       tstamp,
@@ -1,4 +1,5 @@
 #standardSQL
+{% import 'macros.sql' as bq with context %}
 SELECT
   auctions.tstamp AS tstamp,
   auctions.auctionId AS auctionId,
@@ -10,8 +11,7 @@ SELECT
 FROM
   `{{ dataset }}.auctions` AS auctions
 WHERE
-  auctions.tstamp >= TIMESTAMP('{{ start }}')
-  AND auctions.tstamp < TIMESTAMP('{{ end }}')
+  {{ bq.events('auctions', start, end) }}
   AND auctions.level = 'error'
 GROUP BY
   tstamp,
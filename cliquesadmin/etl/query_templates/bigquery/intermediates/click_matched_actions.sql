@@ -1,4 +1,107 @@
 #standardSQL
+{% import 'macros.sql' as bq with context %}
+{% if incremental %}
+-- Incremental mode: candidate clicks are the latest one per uuid & advertiser before this hour,
+-- from click_touch_state, plus this hour's clicks. Last touch is the latest of those at or before
+-- each action, same as scanning the whole lookback, but w/o reading it.
+WITH touches AS (
+  SELECT
+    tstamp,
+    uuid,
+    advertiser,
+    impid,
+    clickid,
+    campaign,
+    creativegroup,
+    creative,
+    publisher,
+    site,
+    page,
+    placement,
+    pub_clique
+  FROM
+    `{{ dataset }}.click_touch_state`
+  WHERE
+    through = TIMESTAMP('{{ start }}')
+  UNION ALL
+  SELECT
+    clicks.tstamp AS tstamp,
+    clicks.uuid AS uuid,
+    clicks.advertiser AS advertiser,
+    clicks.impid AS impid,
+    clicks.clickid AS clickid,
+    clicks.campaign AS campaign,
+    clicks.creativegroup AS creativegroup,
+    clicks.creative AS creative,
+    auctions.publisher AS publisher,
+    auctions.site AS site,
+    auctions.page AS page,
+    auctions.placement AS placement,
+    auctions.pub_clique AS pub_clique
+  FROM
+    `ad_events_pt.clicks` AS clicks
+  INNER JOIN
+    `ad_events_pt.auctions` AS auctions
+  ON
+    clicks.impid = auctions.impid
+  WHERE
+    {{ bq.events('clicks', start, end) }}
+    AND {{ bq.events('auctions', touchAuctionStart, end) }}),
+matched AS (
+  SELECT
+    touches.tstamp AS click_tstamp,
+    actions.tstamp AS action_tstamp,
+    actions.uuid AS uuid,
+    actions.actionid AS actionid,
+    touches.impid AS impid,
+    touches.clickid AS clickid,
+    actions.advertiser AS advertiser,
+    touches.campaign AS campaign,
+    touches.creativegroup AS creativegroup,
+    touches.creative AS creative,
+    actions.actionbeacon AS actionbeacon,
+    actions.value AS value,
+    touches.publisher AS publisher,
+    touches.site AS site,
+    touches.page AS page,
+    touches.placement AS placement,
+    touches.pub_clique AS pub_clique,
+    -- also de-dupes actionids, like the GROUP BY actionid below
+    ROW_NUMBER() OVER (PARTITION BY actions.actionid ORDER BY touches.tstamp DESC) AS touch_rank
+  FROM
+    `ad_events_pt.actions` AS actions
+  INNER JOIN
+    touches
+  ON
+    actions.uuid = touches.uuid
+    AND actions.advertiser = touches.advertiser
+  WHERE
+    {{ bq.events('actions', start, end) }}
+    AND touches.tstamp <= actions.tstamp
+    AND {{ bq.window('touches', end, lookback=lookback) }})
+SELECT
+  click_tstamp,
+  action_tstamp,
+  uuid,
+  actionid,
+  impid,
+  clickid,
+  advertiser,
+  campaign,
+  creativegroup,
+  creative,
+  actionbeacon,
+  value,
+  publisher,
+  site,
+  page,
+  placement,
+  pub_clique
+FROM
+  matched
+WHERE
+  touch_rank = 1
+{% else %}
 WITH thing AS (
 SELECT
   ARRAY_AGG(clicks.tstamp) AS click_tstamp,
@@ -38,15 +141,14 @@ FROM ((
         FROM
           `ad_events_pt.clicks` AS c
         WHERE
-          tstamp >= TIMESTAMP_ADD(TIMESTAMP('{{ end }}'), INTERVAL -{{ lookback }} DAY))) AS inner_clicks
+          {{ bq.events('', end, lookback=lookback) }})) AS inner_clicks
     INNER JOIN ( (
         SELECT
           *
         FROM
           `ad_events_pt.actions`
         WHERE
-          tstamp >= TIMESTAMP('{{ start }}')
-          AND tstamp < TIMESTAMP('{{ end }}'))) AS inner_actions
+          {{ bq.events('', start, end) }})) AS inner_actions
     ON
       inner_actions.uuid = inner_clicks.uuid
       AND inner_actions.advertiser = inner_clicks.advertiser
@@ -69,7 +171,7 @@ INNER JOIN ( (
     FROM
       `ad_events_pt.clicks`
     WHERE
-      tstamp >= TIMESTAMP_ADD(TIMESTAMP('{{ end }}'), INTERVAL -{{ lookback }} DAY))) AS clicks
+      {{ bq.events('', end, lookback=lookback) }})) AS clicks
 ON
   matched_actions.click_tstamp = clicks.tstamp
   AND matched_actions.uuid = clicks.uuid
@@ -81,7 +183,7 @@ INNER JOIN ( (
     FROM
       `ad_events_pt.auctions`
     WHERE
-      tstamp >= TIMESTAMP_ADD(TIMESTAMP('{{ start }}'), INTERVAL -{{ lookback }} DAY))) AS auctions
+      {{ bq.events('', start, lookback=lookback) }})) AS auctions
 ON
   clicks.impid = auctions.impid
 GROUP BY
@@ -104,4 +206,5 @@ SELECT
   page[SAFE_ORDINAL(1)] as page,
   placement[SAFE_ORDINAL(1)] as placement,
   pub_clique[SAFE_ORDINAL(1)] as pub_clique
-FROM thing
\ No newline at end of file
+FROM thing
+{% endif %}
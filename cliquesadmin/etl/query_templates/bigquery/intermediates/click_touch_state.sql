@@ -0,0 +1,80 @@
+#standardSQL
+{% import 'macros.sql' as bq with context %}
+-- Latest click per uuid & advertiser before {{ end }}, along w/ the auction data
+-- click_matched_actions needs, so actions can be attributed w/o rescanning the whole lookback.
+-- Overwrites the state table (WRITE_TRUNCATE). `through` marks the hour the state is current to.
+SELECT
+  tstamp,
+  uuid,
+  advertiser,
+  impid,
+  clickid,
+  campaign,
+  creativegroup,
+  creative,
+  publisher,
+  site,
+  page,
+  placement,
+  pub_clique,
+  TIMESTAMP('{{ end }}') AS through
+FROM (
+  SELECT
+    *,
+    ROW_NUMBER() OVER (PARTITION BY uuid, advertiser ORDER BY tstamp DESC) AS touch_rank
+  FROM (
+    {% if not rebuild %}
+    -- state as of the start of this hour, plus this hour's clicks
+    SELECT
+      tstamp,
+      uuid,
+      advertiser,
+      impid,
+      clickid,
+      campaign,
+      creativegroup,
+      creative,
+      publisher,
+      site,
+      page,
+      placement,
+      pub_clique
+    FROM
+      `{{ dataset }}.click_touch_state`
+    WHERE
+      through = TIMESTAMP('{{ start }}')
+    UNION ALL
+    {% endif %}
+    SELECT
+      clicks.tstamp AS tstamp,
+      clicks.uuid AS uuid,
+      clicks.advertiser AS advertiser,
+      clicks.impid AS impid,
+      clicks.clickid AS clickid,
+      clicks.campaign AS campaign,
+      clicks.creativegroup AS creativegroup,
+      clicks.creative AS creative,
+      auctions.publisher AS publisher,
+      auctions.site AS site,
+      auctions.page AS page,
+      auctions.placement AS placement,
+      auctions.pub_clique AS pub_clique
+    FROM
+      `ad_events_pt.clicks` AS clicks
+    INNER JOIN
+      `ad_events_pt.auctions` AS auctions
+    ON
+      clicks.impid = auctions.impid
+    WHERE
+      {% if rebuild %}
+      -- no usable state, so start over from the whole lookback
+      {{ bq.events('clicks', end, end, lookback=lookback) }}
+      AND {{ bq.events('auctions', end, end, lookback=lookback) }}
+      {% else %}
+      {{ bq.events('clicks', start, end) }}
+      AND {{ bq.events('auctions', touchAuctionStart, end) }}
+      {% endif %}))
+WHERE
+  touch_rank = 1
+  -- a uuid & advertiser whose latest click is outside the lookback can't be matched anymore
+  AND {{ bq.window('', end, lookback=lookback) }}
@@ -0,0 +1,49 @@
+#standardSQL
+{% import 'macros.sql' as bq with context %}
+-- One row per impression (per click, for clicked impressions) in the hour, w/ everything the
+-- hourly, geo & keyword imps/clicks rollups group or aggregate by, so they can read this table alone
+-- rather than each joining auctions, impressions, auction_stats & clicks again.
+SELECT
+  auctions.tstamp AS tstamp,
+  auctions.auctionId AS auctionId,
+  auctions.impid AS impid,
+  auctions.uuid AS uuid,
+  auctions.publisher AS publisher,
+  auctions.site AS site,
+  auctions.page AS page,
+  auctions.placement AS placement,
+  auctions.pub_clique AS pub_clique,
+  auctions.keywords AS keywords,
+  auctions.country AS country,
+  auctions.region AS region,
+  auctions.city AS city,
+  auctions.metro AS metro,
+  auctions.zip AS zip,
+  imps.advertiser AS advertiser,
+  imps.campaign AS campaign,
+  imps.creativegroup AS creativegroup,
+  imps.creative AS creative,
+  imps.adv_clique AS adv_clique,
+  auction_stats.clearprice AS clearprice,
+  auction_stats.num_bids AS num_bids,
+  clicks.clickid AS clickid
+FROM
+  `{{ dataset }}.auctions` AS auctions
+INNER JOIN `{{ dataset }}.impressions` AS imps
+ON
+  auctions.impid = imps.impid
+  -- impressions follow their auction closely, but aren't filtered on tstamp, only pruned
+  AND {{ bq.partitions('imps', wideStart, wideEnd) }}
+INNER JOIN `{{ dataset }}.auction_stats` AS auction_stats
+ON
+  auctions.impid = auction_stats.impid AND
+  auctions.auctionId = auction_stats.auctionId
+LEFT JOIN `{{ dataset }}.clicks` AS clicks
+ON
+  auctions.impid = clicks.impid
+  -- clicks are counted however long after the auction they came in
+  AND {{ bq.partitions('clicks', start) }}
+WHERE
+  {{ bq.events('auctions', start, end) }}
+  -- auction_stats rows carry their auction's tstamp, so this only prunes partitions
+  AND {{ bq.window('auction_stats', start, end) }}
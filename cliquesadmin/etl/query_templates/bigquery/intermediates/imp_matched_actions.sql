@@ -1,4 +1,107 @@
 #standardSQL
+{% import 'macros.sql' as bq with context %}
+{% if incremental %}
+-- Incremental mode: candidate impressions are the latest one per uuid & advertiser before this hour,
+-- from imp_touch_state, plus this hour's impressions. Last touch is the latest of those at or before
+-- each action, same as scanning the whole lookback, but w/o reading it.
+WITH touches AS (
+  SELECT
+    tstamp,
+    uuid,
+    advertiser,
+    impid,
+    campaign,
+    creativegroup,
+    creative,
+    adv_clique,
+    publisher,
+    site,
+    page,
+    placement,
+    pub_clique
+  FROM
+    `{{ dataset }}.imp_touch_state`
+  WHERE
+    through = TIMESTAMP('{{ start }}')
+  UNION ALL
+  SELECT
+    imps.tstamp AS tstamp,
+    imps.uuid AS uuid,
+    imps.advertiser AS advertiser,
+    imps.impid AS impid,
+    imps.campaign AS campaign,
+    imps.creativegroup AS creativegroup,
+    imps.creative AS creative,
+    imps.adv_clique AS adv_clique,
+    auctions.publisher AS publisher,
+    auctions.site AS site,
+    auctions.page AS page,
+    auctions.placement AS placement,
+    auctions.pub_clique AS pub_clique
+  FROM
+    `{{ dataset }}.impressions` AS imps
+  INNER JOIN
+    `{{ dataset }}.auctions` AS auctions
+  ON
+    imps.impid = auctions.impid
+  WHERE
+    {{ bq.events('imps', start, end) }}
+    AND {{ bq.events('auctions', touchAuctionStart, end) }}),
+matched AS (
+  SELECT
+    touches.tstamp AS imp_tstamp,
+    actions.tstamp AS action_tstamp,
+    actions.uuid AS uuid,
+    actions.actionid AS actionid,
+    touches.impid AS impid,
+    actions.advertiser AS advertiser,
+    touches.campaign AS campaign,
+    touches.creativegroup AS creativegroup,
+    touches.creative AS creative,
+    touches.adv_clique AS adv_clique,
+    actions.actionbeacon AS actionbeacon,
+    actions.value AS value,
+    touches.publisher AS publisher,
+    touches.site AS site,
+    touches.page AS page,
+    touches.placement AS placement,
+    touches.pub_clique AS pub_clique,
+    -- also de-dupes actionids, like the GROUP BY actionid below
+    ROW_NUMBER() OVER (PARTITION BY actions.actionid ORDER BY touches.tstamp DESC) AS touch_rank
+  FROM
+    `{{ dataset }}.actions` AS actions
+  INNER JOIN
+    touches
+  ON
+    actions.uuid = touches.uuid
+    AND actions.advertiser = touches.advertiser
+  WHERE
+    {{ bq.events('actions', start, end) }}
+    AND touches.tstamp <= actions.tstamp
+    AND {{ bq.window('touches', end, lookback=lookback) }})
+SELECT
+  imp_tstamp,
+  action_tstamp,
+  uuid,
+  actionid,
+  impid,
+  advertiser,
+  campaign,
+  creativegroup,
+  creative,
+  adv_clique,
+  actionbeacon,
+  value,
+  publisher,
+  site,
+  page,
+  placement,
+  pub_clique
+FROM
+  matched
+WHERE
+  touch_rank = 1
+{% else %}
 WITH thing AS (
 SELECT
   -- Wrap FIRST aggregation functions around all fields
@@ -42,15 +145,14 @@ FROM (
     FROM
       `{{ dataset }}.impressions` AS i
     WHERE
-      tstamp >= TIMESTAMP_ADD(TIMESTAMP('{{ end }}'), INTERVAL -{{ lookback }} DAY))) AS inner_imps
+      {{ bq.events('', end, lookback=lookback) }})) AS inner_imps
   INNER JOIN (
     (SELECT
       *
     FROM
       `{{ dataset }}.actions`
     WHERE
-      tstamp >= TIMESTAMP('{{ start }}')
-      AND tstamp < TIMESTAMP('{{ end }}'))) AS inner_actions
+      {{ bq.events('', start, end) }})) AS inner_actions
   ON
     inner_actions.uuid = inner_imps.uuid
     AND inner_actions.advertiser = inner_imps.advertiser
@@ -77,7 +179,7 @@ INNER JOIN (
   FROM
     `{{ dataset }}.impressions`
   WHERE
-    tstamp >= TIMESTAMP_ADD(TIMESTAMP('{{ end }}'), INTERVAL -{{ lookback }} DAY))) AS imps
+    {{ bq.events('', end, lookback=lookback) }})) AS imps
 ON
   matched_actions.imp_tstamp = imps.tstamp
   AND matched_actions.uuid = imps.uuid
@@ -89,7 +191,7 @@ INNER JOIN (
   FROM
     `{{ dataset }}.auctions`
   WHERE
-    tstamp >= TIMESTAMP_ADD(TIMESTAMP('{{ end }}'), INTERVAL -{{ lookback }} DAY))) AS auctions
+    {{ bq.events('', end, lookback=lookback) }})) AS auctions
 ON
   imps.impid = auctions.impid
 GROUP BY
@@ -113,4 +215,4 @@ SELECT
   placement[SAFE_ORDINAL(1)] as placement,
   pub_clique[SAFE_ORDINAL(1)] as pub_clique
 FROM thing
-  
\ No newline at end of file
+{% endif %}
@@ -0,0 +1,80 @@
+#standardSQL
+{% import 'macros.sql' as bq with context %}
+-- Latest impression per uuid & advertiser before {{ end }}, along w/ the auction data
+-- imp_matched_actions needs, so actions can be attributed w/o rescanning the whole lookback.
+-- Overwrites the state table (WRITE_TRUNCATE). `through` marks the hour the state is current to.
+SELECT
+  tstamp,
+  uuid,
+  advertiser,
+  impid,
+  campaign,
+  creativegroup,
+  creative,
+  adv_clique,
+  publisher,
+  site,
+  page,
+  placement,
+  pub_clique,
+  TIMESTAMP('{{ end }}') AS through
+FROM (
+  SELECT
+    *,
+    ROW_NUMBER() OVER (PARTITION BY uuid, advertiser ORDER BY tstamp DESC) AS touch_rank
+  FROM (
+    {% if not rebuild %}
+    -- state as of the start of this hour, plus this hour's impressions
+    SELECT
+      tstamp,
+      uuid,
+      advertiser,
+      impid,
+      campaign,
+      creativegroup,
+      creative,
+      adv_clique,
+      publisher,
+      site,
+      page,
+      placement,
+      pub_clique
+    FROM
+      `{{ dataset }}.imp_touch_state`
+    WHERE
+      through = TIMESTAMP('{{ start }}')
+    UNION ALL
+    {% endif %}
+    SELECT
+      imps.tstamp AS tstamp,
+      imps.uuid AS uuid,
+      imps.advertiser AS advertiser,
+      imps.impid AS impid,
+      imps.campaign AS campaign,
+      imps.creativegroup AS creativegroup,
+      imps.creative AS creative,
+      imps.adv_clique AS adv_clique,
+      auctions.publisher AS publisher,
+      auctions.site AS site,
+      auctions.page AS page,
+      auctions.placement AS placement,
+      auctions.pub_clique AS pub_clique
+    FROM
+      `{{ dataset }}.impressions` AS imps
+    INNER JOIN
+      `{{ dataset }}.auctions` AS auctions
+    ON
+      imps.impid = auctions.impid
+    WHERE
+      {% if rebuild %}
+      -- no usable state, so start over from the whole lookback
+      {{ bq.events('imps', end, end, lookback=lookback) }}
+      AND {{ bq.events('auctions', end, end, lookback=lookback) }}
+      {% else %}
+      {{ bq.events('imps', start, end) }}
+      AND {{ bq.events('auctions', touchAuctionStart, end) }}
+      {% endif %}))
+WHERE
+  touch_rank = 1
+  -- a uuid & advertiser whose latest impression is outside the lookback can't be matched anymore
+  AND {{ bq.window('', end, lookback=lookback) }}
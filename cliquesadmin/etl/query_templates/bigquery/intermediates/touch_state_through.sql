@@ -0,0 +1,6 @@
+#standardSQL
+-- end of the last hour folded into a touch state table, see imp_touch_state.sql
+SELECT
+  MAX(through) AS through
+FROM
+  `{{ dataset }}.{{ table }}`
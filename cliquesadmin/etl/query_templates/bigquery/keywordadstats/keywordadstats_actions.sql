@@ -1,4 +1,5 @@
 #standardSQL
+{% import 'macros.sql' as bq with context %}
 SELECT
 	TIMESTAMP('{{ start }}') AS hour,
 	i.publisher AS publisher,
@@ -27,12 +28,14 @@ FROM
 INNER JOIN `{{ dataset }}.auctions` as auctions
 ON
 	auctions.impid = i.impid
+	-- an impression's auction is within the view lookback of the action it's matched to
+	AND {{ bq.partitions('auctions', end, lookback=lookback) }}
 LEFT OUTER JOIN `{{ dataset }}.click_matched_actions` AS c
 ON
 	c.actionid = i.actionid
+	AND {{ bq.window('c', start, end, column='action_tstamp') }}
 WHERE
-	i.action_tstamp >= TIMESTAMP('{{ start }}')
-	AND i.action_tstamp < TIMESTAMP('{{ end }}')
+	{{ bq.window('i', start, end, column='action_tstamp') }}
 GROUP BY
 	publisher,
 	site,
@@ -0,0 +1,54 @@
+{#
+Time window predicates shared by all BigQuery templates. Import w/
+
+    {% import 'macros.sql' as bq with context %}
+
+Raw event tables are partitioned by ingestion time, which filters on `tstamp` alone don't prune,
+so `bq.events` emits a `_PARTITIONTIME` predicate alongside the `tstamp` one. Rows land in the
+partition of the day they're ingested, shortly after their `tstamp`, & have a NULL `_PARTITIONTIME`
+while still in the streaming buffer. Partition bounds are therefore widened by PARTITION_SLACK_HOURS
+on either side of the `tstamp` window, & buffered rows are always included.
+
+Intermediate tables are partitioned on a column (see `INTERMEDIATE_TABLE_LAYOUTS`), so `bq.window`
+alone prunes them.
+
+Windows run from `lookback` days before `since` up to (but not including) `until`, or are open
+ended if `until` is none. Rendering w/ `prunePartitions=False` leaves out partition predicates,
+e.g. to compare bytes processed w/ & w/o them.
+#}
+{% set PARTITION_SLACK_HOURS = 6 %}
+
+{# `at` shifted by `hours`, as a TIMESTAMP expression #}
+{% macro shifted(at, hours=0) -%}
+{% if hours %}TIMESTAMP_ADD(TIMESTAMP('{{ at }}'), INTERVAL {{ hours }} HOUR){% else %}TIMESTAMP('{{ at }}'){% endif %}
+{%- endmacro %}
+
+{% macro _column(alias, column) -%}
+{% if alias %}{{ alias }}.{% endif %}{{ column }}
+{%- endmacro %}
+
+{# `column` within window, for tables partitioned on it or not partitioned at all #}
+{% macro window(alias, since, until=none, lookback=0, column='tstamp') -%}
+{{ _column(alias, column) }} >= {{ shifted(since, -24 * (lookback|int)) }}
+{%- if until is not none %}
+  AND {{ _column(alias, column) }} < {{ shifted(until) }}
+{%- endif %}
+{%- endmacro %}
+
+{# ingestion time partitions that can hold rows w/ `tstamp` within window #}
+{% macro partitions(alias, since, until=none, lookback=0) -%}
+{%- set partition_time = _column(alias, '_PARTITIONTIME') -%}
+({{ partition_time }} IS NULL
+  OR ({{ partition_time }} > {{ shifted(since, -24 * (lookback|int) - PARTITION_SLACK_HOURS - 24) }}
+{%- if until is not none %}
+    AND {{ partition_time }} <= {{ shifted(until, PARTITION_SLACK_HOURS) }}
+{%- endif %}))
+{%- endmacro %}
+
+{# `tstamp` within window & the partitions that can hold it, for raw event tables #}
+{% macro events(alias, since, until=none, lookback=0) -%}
+{{ window(alias, since, until, lookback) }}
+{%- if prunePartitions is not defined or prunePartitions %}
+  AND {{ partitions(alias, since, until, lookback) }}
+{%- endif %}
+{%- endmacro %}
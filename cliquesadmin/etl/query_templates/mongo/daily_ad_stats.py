@@ -1,5 +1,75 @@
+from datetime import datetime
 
-def daily_ad_stats_pipeline(start_datetime=None, end_datetime=None):
+# Fields identifying a single dailyadstats document, used as upsert filter
+DAILY_AD_STATS_UPDATE_KEYS = [
+    "date",
+    "advertiser",
+    "campaign",
+    "adv_clique",
+    "publisher",
+    "site",
+    "pub_clique"
+]
+
+# Additive dailyadstats fields, which incremental rollups `$inc` by each new hour's totals.
+# `clearprice` itself is derived from its sum & count companions, see `daily_ad_stats_pipeline`.
+DAILY_AD_STATS_SUM_FIELDS = [
+    "bids",
+    "imps",
+    "defaults",
+    "spend",
+    "clicks",
+    "view_convs",
+    "click_convs",
+    "clearprice_sum",
+    "clearprice_count"
+]
+
+# average field -> (sum field, count field)
+DAILY_AD_STATS_AVERAGE_FIELDS = {
+    "clearprice": ("clearprice_sum", "clearprice_count")
+}
+
+
+def daily_ad_stats_pipeline(start_datetime=None, end_datetime=None, by_day=False):
+    """
+    Rolls hourlyadstats in [start_datetime, end_datetime) up into dailyadstats documents for the day
+    containing start_datetime. Pass a whole day for a full recompute, or a single hour for that hour's
+    deltas.
+
+    If `by_day`, each hourlyadstats document is rolled into its own UTC day instead, so a range
+    spanning many days can be rolled up in a single aggregation.
+
+    Update keys missing from hourlyadstats come out as empty strings rather than null, so upserts,
+    incremental `$inc`s & `$merge` all write & match the same dailyadstats documents.
+
+    `clearprice` is the impression-weighted average of hourly clear prices, kept alongside its
+    `clearprice_sum` & `clearprice_count` (impressions w/ a clear price) companions so that
+    deltas can be added to it exactly.
+    """
+    if by_day:
+        # truncate `hour` to midnight UTC. Plain date arithmetic, so works on any MongoDB version
+        date_expr = {
+            "$subtract": [
+                "$hour",
+                {"$mod": [{"$subtract": ["$hour", datetime(1970, 1, 1)]}, 24 * 3600 * 1000]}
+            ]
+        }
+        date_projection = "$_id.date"
+    else:
+        # a real Date, not a string, so `$merge` & upserts match existing documents on it
+        date_expr = None
+        date_projection = {"$literal": start_datetime.replace(hour=0, minute=0, second=0, microsecond=0)}
+    group_id = {
+        "advertiser": "$advertiser",
+        "campaign": "$campaign",
+        "adv_clique": "$adv_clique",
+        "publisher": "$publisher",
+        "site": "$site",
+        "pub_clique": "$pub_clique"
+    }
+    if date_expr is not None:
+        group_id["date"] = date_expr
     return [
         {
             "$match": {
@@ -11,18 +81,12 @@ def daily_ad_stats_pipeline(start_datetime=None, end_datetime=None):
         },
         {
             "$group": {
-                "_id": {
-                    "advertiser": "$advertiser",
-                    "campaign": "$campaign",
-                    "adv_clique": "$adv_clique",
-                    "publisher": "$publisher",
-                    "site": "$site",
-                    "pub_clique": "$pub_clique"
-                },
+                "_id": group_id,
                 "bids": {"$sum": "$bids"},
                 "imps": {"$sum": "$imps"},
                 "defaults": {"$sum": "$defaults"},
-                "clearprice": {"$avg": "$clearprice"},
+                "clearprice_sum": {"$sum": {"$multiply": ["$clearprice", "$imps"]}},
+                "clearprice_count": {"$sum": {"$cond": [{"$gt": ["$clearprice", None]}, "$imps", 0]}},
                 "spend": {"$sum": "$spend"},
                 "clicks": {"$sum": "$clicks"},
                 "view_convs": {"$sum": "$view_convs"},
@@ -32,19 +96,27 @@ def daily_ad_stats_pipeline(start_datetime=None, end_datetime=None):
         {
             "$project": {
                 "_id": 0,
-                "date": {
-                    "$literal": start_datetime.replace(hour=0, minute=0, second=0, microsecond=0).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
-                },
-                "advertiser": "$_id.advertiser",
-                "campaign": "$_id.campaign",
-                "adv_clique": "$_id.adv_clique",
-                "publisher": "$_id.publisher",
-                "site": "$_id.site",
-                "pub_clique": "$_id.pub_clique",
+                "date": date_projection,
+                # missing keys (e.g. defaults rows w/o advertiser & campaign) are stored as '' by every
+                # rollup mode, since `$merge` refuses null `on` fields & null wouldn't match '' on upsert
+                "advertiser": {"$ifNull": ["$_id.advertiser", ""]},
+                "campaign": {"$ifNull": ["$_id.campaign", ""]},
+                "adv_clique": {"$ifNull": ["$_id.adv_clique", ""]},
+                "publisher": {"$ifNull": ["$_id.publisher", ""]},
+                "site": {"$ifNull": ["$_id.site", ""]},
+                "pub_clique": {"$ifNull": ["$_id.pub_clique", ""]},
                 "bids": 1,
                 "imps": 1,
                 "defaults": 1,
-                "clearprice": 1,
+                "clearprice": {
+                    "$cond": [
+                        {"$gt": ["$clearprice_count", 0]},
+                        {"$divide": ["$clearprice_sum", "$clearprice_count"]},
+                        None
+                    ]
+                },
+                "clearprice_sum": 1,
+                "clearprice_count": 1,
                 "spend": 1,
                 "clicks": 1,
                 "view_convs": 1,
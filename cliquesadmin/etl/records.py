@@ -0,0 +1,135 @@
+"""
+Converts between DataFrames & MongoDB documents column by column.
+
+`DataFrame.to_dict(orient='records')` followed by a per-cell `isinstance` check for
+Timestamps is O(rows x columns) Python work and holds a second full copy of the frame.
+Here each column is converted to BSON-encodable Python objects in one vectorized step,
+only datetime columns get any special handling, and documents are built one batch at
+a time so only a batch's worth of dicts is alive at once.
+
+Going the other way, `iter_cursor_frames` streams documents straight into per-column
+buffers rather than collecting a list of dicts for `pd.DataFrame` to copy again.
+"""
+from collections import OrderedDict
+import six
+import pandas as pd
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+def column_to_objects(series):
+    """
+    Converts a column to an object array of BSON-encodable values: datetime64 columns
+    become `datetime`s w/ None for NaT, everything else is boxed to plain Python
+    scalars by numpy.
+
+    :param series: pandas Series
+    :return: numpy object array
+    """
+    if series.dtype.kind == 'M':
+        values = pd.DatetimeIndex(series).to_pydatetime().astype(object)
+        values[series.isnull().values] = None
+        return values
+    return series.values.astype(object)
+
+
+def iter_record_batches(dataframe, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Lazily yields lists of at most `batch_size` documents built from dataframe rows.
+
+    :param dataframe: DataFrame to convert
+    :param batch_size: documents per batch, None yields all documents in one batch
+    :return: generator of lists of dicts
+    """
+    num_rows = len(dataframe)
+    if not num_rows:
+        return
+    batch_size = batch_size or num_rows
+    columns = [str(c) for c in dataframe.columns]
+    for start in range(0, num_rows, batch_size):
+        batch = dataframe.iloc[start:start + batch_size]
+        values = [column_to_objects(batch[c]) for c in batch.columns]
+        yield [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def dataframe_to_records(dataframe):
+    """
+    Returns all rows of dataframe as a list of documents.
+    """
+    records = []
+    for batch in iter_record_batches(dataframe, batch_size=None):
+        records.extend(batch)
+    return records
+
+
+_MISSING = object()
+
+
+class ColumnBuffers(object):
+    """
+    Per-column value buffers for building a DataFrame one document at a time.
+
+    If `size` is set, each column gets a list of that many slots up front, filled in place,
+    otherwise column capacity doubles whenever it runs out. Fields missing from a document
+    are None. Column order is order of first appearance.
+
+    :param size: number of documents the buffers hold, None to grow without bound
+    """
+    def __init__(self, size=None):
+        self.size = size
+        self.capacity = size or 1024
+        self.columns = OrderedDict()
+        # (field, column) pairs, so the hot loop in `add` doesn't go through the dict
+        self._items = []
+        self.count = 0
+
+    def add(self, document):
+        n = self.count
+        if n == self.capacity:
+            for column in self.columns.values():
+                column.extend([None] * self.capacity)
+            self.capacity *= 2
+        get = document.get
+        found = 0
+        for field, column in self._items:
+            value = get(field, _MISSING)
+            if value is not _MISSING:
+                column[n] = value
+                found += 1
+        if found != len(document):
+            # document has fields not seen before
+            for field, value in six.iteritems(document):
+                if field not in self.columns:
+                    column = self.columns[field] = [None] * self.capacity
+                    column[n] = value
+                    self._items.append((field, column))
+        self.count += 1
+
+    @property
+    def full(self):
+        return self.size is not None and self.count >= self.size
+
+    def to_dataframe(self):
+        n = self.count
+        data = OrderedDict((field, column if len(column) == n else column[:n])
+                           for field, column in self._items)
+        return pd.DataFrame(data, columns=list(data))
+
+
+def iter_cursor_frames(cursor, chunksize=None):
+    """
+    Streams documents from a cursor into DataFrames of at most `chunksize` rows, via
+    `ColumnBuffers` preallocated for each chunk.
+
+    :param cursor: iterable of documents, e.g. pymongo cursor
+    :param chunksize: max rows per DataFrame, None yields a single DataFrame of everything
+    :return: generator of DataFrames. Nothing is yielded for an empty cursor.
+    """
+    buffers = ColumnBuffers(chunksize)
+    for document in cursor:
+        buffers.add(document)
+        if buffers.full:
+            yield buffers.to_dataframe()
+            buffers = ColumnBuffers(chunksize)
+    if buffers.count:
+        yield buffers.to_dataframe()
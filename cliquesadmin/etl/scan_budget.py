@@ -0,0 +1,174 @@
+import os
+import logging
+import threading
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# what to do w/ a query whose dry run puts it over budget:
+#   - 'refuse': raise `BudgetExceeded` instead of running it
+#   - 'batch': run it anyway w/ BATCH priority, so it queues for idle slots rather than competing
+#     w/ interactive queries. Note this doesn't make on-demand scans any cheaper.
+ON_EXCEED_ACTIONS = ('refuse', 'batch')
+
+COST_TABLE_COLUMNS = ['run_start', 'name', 'template', 'estimated_bytes', 'estimated_cost',
+                      'priority', 'decision', 'actual_bytes', 'cache_hit']
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised by `ScanBudget.check` when a query would scan more than its budget allows.
+    """
+    pass
+
+
+class ScanBudget(object):
+    """
+    Caps the bytes BigQuery queries of one ETL run may scan, based on dry runs of each
+    rendered query before it runs, and keeps a cost table of estimated & actual bytes
+    per query.
+
+    Shared by all BigQuery ETLs of a run (see `BigQueryETL`'s `scan_budget`), which may run
+    in different threads.
+
+    :param step_bytes: max estimated bytes of any single query, None for no limit
+    :param run_bytes: max estimated bytes of all queries of the run together, None for no limit
+    :param on_exceed: what to do w/ queries over budget, one of `ON_EXCEED_ACTIONS`
+    :param price_per_tb: on-demand price per TB scanned, for estimated costs
+    """
+    def __init__(self, step_bytes=None, run_bytes=None, on_exceed='refuse', price_per_tb=5.0):
+        if on_exceed not in ON_EXCEED_ACTIONS:
+            raise ValueError('Unknown budget action %s, must be one of %s' % (on_exceed, ', '.join(ON_EXCEED_ACTIONS)))
+        self.step_bytes = step_bytes
+        self.run_bytes = run_bytes
+        self.on_exceed = on_exceed
+        self.price_per_tb = price_per_tb
+        self.committed_bytes = 0
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def cost(self, num_bytes):
+        """
+        On-demand cost of scanning `num_bytes`, BigQuery bills per TiB.
+        """
+        return num_bytes * self.price_per_tb / 1024.0 ** 4
+
+    def over_budget(self, estimated_bytes):
+        """
+        Reason a query estimated to scan `estimated_bytes` is over budget, None if it isn't.
+        Caller must hold the lock.
+        """
+        if self.step_bytes is not None and estimated_bytes > self.step_bytes:
+            return 'estimated %s bytes is over step budget of %s' % (estimated_bytes, self.step_bytes)
+        if self.run_bytes is not None and self.committed_bytes + estimated_bytes > self.run_bytes:
+            return 'estimated %s bytes would take run to %s bytes, over run budget of %s' \
+                   % (estimated_bytes, self.committed_bytes + estimated_bytes, self.run_bytes)
+        return None
+
+    def check(self, name, template, estimated_bytes, query_options):
+        """
+        Decides whether a query may run, given its dry run estimate, & records it in the cost
+        table. Queries downgraded to BATCH get their `priority` set in `query_options`.
+
+        :param name: job name, i.e. template & time window
+        :param template: template name
+        :param estimated_bytes: dry run `totalBytesProcessed`, None if the dry run failed. Such
+            queries always run & don't count towards the run budget.
+        :param query_options: query options of the job about to be inserted, modified in place
+        :return: cost table entry, to pass to `record_actual` once the query is done
+        :raises BudgetExceeded: if over budget & `on_exceed` is 'refuse'
+        """
+        entry = {
+            'name': name,
+            'template': template,
+            'estimated_bytes': estimated_bytes,
+            'estimated_cost': self.cost(estimated_bytes) if estimated_bytes is not None else None,
+            'priority': query_options.get('priority') or 'INTERACTIVE',
+            'decision': 'run',
+            'actual_bytes': None,
+            'cache_hit': None
+        }
+        with self._lock:
+            self.entries.append(entry)
+            if estimated_bytes is None:
+                entry['decision'] = 'unestimated'
+                return entry
+            reason = self.over_budget(estimated_bytes)
+            if reason is not None and self.on_exceed == 'refuse':
+                entry['decision'] = 'refused'
+            else:
+                self.committed_bytes += estimated_bytes
+                if reason is not None:
+                    entry['decision'] = 'batch'
+                    entry['priority'] = query_options['priority'] = 'BATCH'
+        if entry['decision'] == 'refused':
+            logger.error('Refusing to run %s, %s' % (name, reason))
+            raise BudgetExceeded('%s %s' % (name, reason))
+        if entry['decision'] == 'batch':
+            logger.warn('Running %s w/ BATCH priority, %s' % (name, reason))
+        else:
+            logger.info('%s estimated to process %s bytes ($%.4f)' % (name, estimated_bytes, entry['estimated_cost']))
+        return entry
+
+    def record_reused(self, name, template, query_options):
+        """
+        Records a query whose job from an earlier run is being reused rather than inserted
+        again. It isn't dry run & isn't charged to the run budget, as it scans nothing new.
+
+        :param name: job name, i.e. template & time window
+        :param template: template name
+        :param query_options: query options of the job that would've been inserted
+        :return: cost table entry, to pass to `record_actual` once the query is done
+        """
+        entry = {
+            'name': name,
+            'template': template,
+            'estimated_bytes': None,
+            'estimated_cost': None,
+            'priority': query_options.get('priority') or 'INTERACTIVE',
+            'decision': 'reused',
+            'actual_bytes': None,
+            'cache_hit': None
+        }
+        with self._lock:
+            self.entries.append(entry)
+        logger.info('Reusing existing job for %s, not charging it to the budget' % name)
+        return entry
+
+    def record_actual(self, entry, actual_bytes, cache_hit):
+        """
+        Records bytes a query actually processed in its cost table entry.
+
+        :param entry: entry returned by `check`
+        :param actual_bytes: job's `totalBytesProcessed`
+        :param cache_hit: whether BigQuery served the job from its own results cache
+        """
+        with self._lock:
+            entry['actual_bytes'] = int(actual_bytes) if actual_bytes is not None else None
+            entry['cache_hit'] = cache_hit
+
+    def cost_table(self, run_start=None):
+        """
+        :param run_start: start of the ETL range, included as a column to tell runs apart
+        :return: DataFrame w/ one row per query checked, columns `COST_TABLE_COLUMNS`
+        """
+        with self._lock:
+            entries = [dict(entry, run_start=run_start) for entry in self.entries]
+        return pd.DataFrame(entries, columns=COST_TABLE_COLUMNS)
+
+    def log_cost_table(self, run_start=None):
+        cost_table = self.cost_table(run_start)
+        logger.info('BigQuery cost table, %s bytes estimated ($%.4f):\n%s'
+                    % (self.committed_bytes, self.cost(self.committed_bytes),
+                       cost_table.drop('run_start', axis=1).to_string(index=False)))
+
+    def write_cost_table(self, path, run_start=None):
+        """
+        Appends this run's cost table to CSV file `path`, writing a header if it's new, so
+        the file builds up into a history of estimated & actual bytes per query & run.
+        """
+        cost_table = self.cost_table(run_start)
+        exists = os.path.isfile(path)
+        with open(path, 'a') as f:
+            cost_table.to_csv(f, header=not exists, index=False)
+        logger.info('Appended %s rows to BigQuery cost table %s' % (len(cost_table), path))
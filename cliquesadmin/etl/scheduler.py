@@ -0,0 +1,172 @@
+import sys
+import logging
+import threading
+from time import time
+import six
+
+logger = logging.getLogger(__name__)
+
+
+class ETLStep(object):
+    """
+    Single node in an `ETLScheduler` DAG.
+
+    :param name: unique step name, used to declare dependencies
+    :param func: callable taking no arguments which runs the step & returns its result.
+        Build ETL objects inside `func` rather than up front, so each step gets its
+        own API clients in the thread it runs in.
+    :param depends_on: list of step names which must finish successfully first
+    :param backend: name of the resource the step mostly hits (e.g. 'bigquery', 'mongo'),
+        used to cap how many steps run against it at once
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name, func, depends_on=None, backend=None):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on or [])
+        self.backend = backend
+        self.status = self.PENDING
+        self.result = None
+        self.exc_info = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def __repr__(self):
+        return '<ETLStep %s (%s)>' % (self.name, self.status)
+
+
+class ETLScheduler(object):
+    """
+    Runs a list of `ETLStep`s as a DAG, starting every step as soon as all of its
+    dependencies have finished, so wall-clock time is the length of the critical path
+    rather than the sum of all steps.
+
+    Steps are started in list order whenever more than one is ready.
+
+    :param steps: list of `ETLStep`s
+    :param concurrency: dict of backend name -> max number of steps allowed to run against
+        that backend at once. Backends not listed are not capped.
+    :param fail_fast: If True (default), no new steps are started once any step fails, which
+        matches running the steps one after another. If False, steps which don't depend on
+        the failed one keep going. Either way the first exception is re-raised from `run`
+        once all running steps have finished.
+    """
+    def __init__(self, steps, concurrency=None, fail_fast=True):
+        self.steps = steps
+        self.concurrency = concurrency or {}
+        self.fail_fast = fail_fast
+        self._steps_by_name = {}
+        for step in steps:
+            if step.name in self._steps_by_name:
+                raise ValueError('Duplicate ETL step name: %s' % step.name)
+            self._steps_by_name[step.name] = step
+        self._check_dag()
+        self._cond = threading.Condition()
+
+    def _check_dag(self):
+        """
+        Makes sure all dependencies exist and that there are no cycles.
+        """
+        for step in self.steps:
+            for dep in step.depends_on:
+                if dep not in self._steps_by_name:
+                    raise ValueError('ETL step %s depends on unknown step %s' % (step.name, dep))
+        visited = set()
+        visiting = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError('Dependency cycle detected at ETL step %s' % name)
+            visiting.add(name)
+            for dep in self._steps_by_name[name].depends_on:
+                visit(dep)
+            visiting.remove(name)
+            visited.add(name)
+
+        for step in self.steps:
+            visit(step.name)
+
+    def _run_step(self, step):
+        try:
+            logger.info('Starting ETL step %s' % step.name)
+            step.result = step.func()
+            status = ETLStep.DONE
+        except Exception:
+            step.exc_info = sys.exc_info()
+            logger.exception('ETL step %s failed' % step.name)
+            status = ETLStep.FAILED
+        with self._cond:
+            step.finished = time()
+            step.status = status
+            if status == ETLStep.DONE:
+                logger.info('Finished ETL step %s in %.1fs' % (step.name, step.elapsed))
+            self._cond.notify_all()
+
+    def _has_capacity(self, backend, running):
+        limit = self.concurrency.get(backend)
+        return limit is None or running.get(backend, 0) < limit
+
+    def run(self):
+        """
+        Runs all steps & blocks until they're done.
+
+        :return: dict of step name -> result returned by the step's `func`
+        """
+        start = time()
+        pending = list(self.steps)
+        threads = []
+        failed = []
+        with self._cond:
+            while True:
+                running = {}
+                for step in self.steps:
+                    if step.status == ETLStep.RUNNING:
+                        running[step.backend] = running.get(step.backend, 0) + 1
+                failed = [s for s in self.steps if s.status == ETLStep.FAILED]
+
+                for step in list(pending):
+                    deps = [self._steps_by_name[d] for d in step.depends_on]
+                    if (failed and self.fail_fast) or \
+                            any(d.status in (ETLStep.FAILED, ETLStep.SKIPPED) for d in deps):
+                        step.status = ETLStep.SKIPPED
+                        pending.remove(step)
+                        logger.warn('Skipping ETL step %s, upstream step failed' % step.name)
+                    elif all(d.status == ETLStep.DONE for d in deps) and \
+                            self._has_capacity(step.backend, running):
+                        step.status = ETLStep.RUNNING
+                        step.started = time()
+                        running[step.backend] = running.get(step.backend, 0) + 1
+                        pending.remove(step)
+                        t = threading.Thread(target=self._run_step, args=(step,), name='etl-%s' % step.name)
+                        t.daemon = True
+                        t.start()
+                        threads.append(t)
+
+                if not pending and not sum(running.values()):
+                    break
+                self._cond.wait()
+
+        for t in threads:
+            t.join()
+
+        elapsed = time() - start
+        serial = sum(s.elapsed for s in self.steps if s.elapsed is not None)
+        logger.info('ETL DAG finished in %.1fs (%.1fs if run serially)' % (elapsed, serial))
+
+        failed = [s for s in self.steps if s.status == ETLStep.FAILED]
+        if failed:
+            six.reraise(*failed[0].exc_info)
+        return dict((s.name, s.result) for s in self.steps)
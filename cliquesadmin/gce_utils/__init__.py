@@ -4,12 +4,13 @@ import os
 import argparse
 import httplib2
 import json
-from time import sleep
+import threading
+from time import sleep, time
 from oauth2client.client import flow_from_clientsecrets, SignedJwtAssertionCredentials
 from oauth2client.file import Storage
 from oauth2client import tools
 from oauth2client.tools import run_flow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document, DISCOVERY_URI
 from functools import wraps
 from cliquesadmin import CONFIG_PATH
 
@@ -26,23 +27,102 @@ class CliquesGCESettings:
     SCOPE = None
     CLIENT_SECRETS = None
     OAUTH2_STORAGE = None
+    # discovery documents are cached here, & refetched once older than DISCOVERY_CACHE_TTL seconds
+    DISCOVERY_CACHE_DIR = os.path.expanduser('~/.cache/cliquesadmin/discovery')
+    DISCOVERY_CACHE_TTL = 7 * 24 * 3600
+
+
+# Process-wide caches backing `get_service`
+_credentials = {}
+_discovery_documents = {}
+_cache_lock = threading.Lock()
+_thread_local = threading.local()
+
+
+def get_jwt_credentials(gce_settings):
+    """
+    Returns process-wide JWT credentials for settings' secrets file & scope, reading
+    the secrets & fetching an access token only the first time. Thread-safe.
+
+    :param gce_settings: GCESettings object
+    :return: authorized credentials
+    """
+    key = (gce_settings.JWT_SECRETS, gce_settings.SCOPE)
+    with _cache_lock:
+        if key not in _credentials:
+            f = file(gce_settings.JWT_SECRETS, 'rb')
+            secrets = json.load(f)
+            f.close()
+            credentials = SignedJwtAssertionCredentials(
+                secrets['client_email'],
+                secrets['private_key'],
+                scope=gce_settings.SCOPE
+            )
+            # refresh once up front, rather than in every thread on its first request
+            credentials.refresh(httplib2.Http())
+            _credentials[key] = credentials
+        return _credentials[key]
+
+
+def get_discovery_document(gce_settings):
+    """
+    Returns discovery document for settings' API & version, from memory, else from
+    `DISCOVERY_CACHE_DIR` on disk, else fetched from Google & saved to disk.
+
+    :param gce_settings: GCESettings object
+    :return: discovery document JSON string
+    """
+    key = (gce_settings.API_NAME, gce_settings.API_VERSION)
+    with _cache_lock:
+        if key in _discovery_documents:
+            return _discovery_documents[key]
+        path = os.path.join(gce_settings.DISCOVERY_CACHE_DIR, '%s.%s.json' % key)
+        if os.path.exists(path) and time() - os.path.getmtime(path) < gce_settings.DISCOVERY_CACHE_TTL:
+            f = open(path, 'rb')
+            document = f.read()
+            f.close()
+        else:
+            uri = DISCOVERY_URI.replace('{api}', key[0]).replace('{apiVersion}', key[1])
+            resp, document = httplib2.Http().request(uri)
+            if resp.status >= 400:
+                raise IOError('Failed to fetch discovery document %s: HTTP %s' % (uri, resp.status))
+            if not os.path.isdir(gce_settings.DISCOVERY_CACHE_DIR):
+                os.makedirs(gce_settings.DISCOVERY_CACHE_DIR)
+            tmp_path = '%s.tmp-%s' % (path, os.getpid())
+            f = open(tmp_path, 'wb')
+            f.write(document)
+            f.close()
+            os.rename(tmp_path, path)
+        _discovery_documents[key] = document
+        return document
+
+
+def get_service(gce_settings):
+    """
+    Returns API service for settings' API, version & scope, built at most once per thread.
+
+    Credentials & discovery documents are shared process-wide, but each thread gets its
+    own service w/ its own authorized HTTP client, since httplib2 isn't thread-safe.
+
+    :param gce_settings: GCESettings object
+    :return: API service
+    """
+    key = (gce_settings.API_NAME, gce_settings.API_VERSION, gce_settings.SCOPE)
+    services = getattr(_thread_local, 'services', None)
+    if services is None:
+        services = _thread_local.services = {}
+    if key not in services:
+        http = get_jwt_credentials(gce_settings).authorize(httplib2.Http())
+        services[key] = build_from_document(get_discovery_document(gce_settings), http=http)
+    return services[key]
 
 
 def authenticate_and_build_jwt_client(gce_settings):
-    f = file(gce_settings.JWT_SECRETS, 'rb')
-    secrets = json.load(f)
-    f.close()
-    key = secrets['private_key']
-    email = secrets['client_email']
-    credentials = SignedJwtAssertionCredentials(
-        email,
-        key,
-        scope=gce_settings.SCOPE
-    )
-    http = httplib2.Http()
-    http = credentials.authorize(http)
-    service = build(gce_settings.API_NAME, gce_settings.API_VERSION, http=http)
-    return service
+    """
+    Returns JWT-authenticated API service for settings. Services are cached per thread,
+    see `get_service`.
+    """
+    return get_service(gce_settings)
 
 
 def authenticate_and_build_oauth(argv, gce_settings):
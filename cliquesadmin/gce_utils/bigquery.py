@@ -1,7 +1,18 @@
+import re
+import json
+import hashlib
+import logging
+import random
+import threading
+from time import time, sleep
 import numpy as np
+from six.moves import queue
+from googleapiclient.errors import HttpError
 from cliquesadmin.gce_utils import CliquesGCESettings
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 
 class CliquesBigQuerySettings(CliquesGCESettings):
     API_VERSION = 'v2'
@@ -21,38 +32,607 @@ BQ_NP_TYPE_MAPPING = {
     'TIMESTAMP': np.dtype(float),
 }
 
+# NaT as int64, for building datetime64[ns] arrays directly
+NAT_INT64 = np.iinfo(np.int64).min
+
+
+def decode_float_column(values, nulls):
+    """
+    Decodes FLOAT column of BigQuery strings to float64, NULLs as NaN.
+    """
+    decoded = np.empty(len(values), dtype=np.float64)
+    decoded[nulls] = np.nan
+    decoded[~nulls] = values[~nulls].astype(np.float64)
+    return decoded
+
+
+def decode_integer_column(values, nulls):
+    """
+    Decodes INTEGER column of BigQuery strings to int64, or to float64 w/ NULLs
+    as NaN if column has any NULLs (same as pandas does).
+    """
+    if nulls.any():
+        return decode_float_column(values, nulls)
+    return values.astype(np.int64)
+
+
+def decode_boolean_column(values, nulls):
+    """
+    Decodes BOOLEAN column of 'true'/'false' strings to bool, or to object w/
+    NULLs as None if column has any NULLs.
+    """
+    decoded = values == 'true'
+    if nulls.any():
+        decoded = decoded.astype(object)
+        decoded[nulls] = None
+    return decoded
+
+
+def decode_timestamp_column(values, nulls):
+    """
+    Decodes TIMESTAMP column of epoch-seconds strings (e.g. '1.4345676E9') to
+    datetime64[ns] in bulk, NULLs as NaT. Rounds to the microsecond, which is
+    BigQuery's timestamp precision.
+    """
+    seconds = decode_float_column(values, nulls)
+    nanos = np.empty(len(values), dtype=np.int64)
+    nanos[nulls] = NAT_INT64
+    nanos[~nulls] = np.round(seconds[~nulls] * 1e6).astype(np.int64) * 1000
+    return nanos.view('datetime64[ns]')
+
+
+BQ_COLUMN_DECODERS = {
+    'INTEGER': decode_integer_column,
+    'FLOAT': decode_float_column,
+    'BOOLEAN': decode_boolean_column,
+    'TIMESTAMP': decode_timestamp_column,
+}
+
 
 def query_response_to_dataframe(query_response):
     """
     Loads query response to pandas dataframe
 
+    Decodes column-wise: fills one buffer per schema field straight from the row
+    cells, then converts each buffer to its dtype in bulk w/ a NULL mask. Types
+    not in `BQ_COLUMN_DECODERS` (e.g. STRING) are left as object columns.
+
     Automatically handles type conversions as well, including
     timestamp to datetime64
 
     :param query_response: query response from BigQuery API
     :return: pandas DataFrame
     """
-    rows = [tuple(map(lambda field: field['v'], row['f']))
-            for row in query_response['rows']]
+    fields = query_response['schema']['fields']
+    cells = [row['f'] for row in query_response.get('rows', [])]
+
+    data = {}
+    names = []
+    for i, field in enumerate(fields):
+        name = str(field['name'])
+        values = np.array([row[i]['v'] for row in cells], dtype=object)
+        decoder = BQ_COLUMN_DECODERS.get(field['type'])
+        if decoder is not None:
+            values = decoder(values, pd.isnull(values))
+        data[name] = values
+        names.append(name)
+    return pd.DataFrame(data, columns=names)
+
+
+def list_table_rows(gce_service, table_ref, start_index, end_index, page_size=None):
+    """
+    Reads rows [start_index, end_index) of a BigQuery table using `tabledata.list`.
+
+    BigQuery caps the size of each response, so keeps paging from the last row received
+    until the whole range has been read.
+
+    :param gce_service: built BigQuery API service
+    :param table_ref: dict w/ projectId, datasetId & tableId, e.g. a query job's destinationTable
+    :param start_index: first row to read
+    :param end_index: row to stop at, exclusive
+    :param page_size: max rows to request per call, default lets BigQuery decide
+    :return: list of rows in `{'f': [{'v': ...}, ...]}` format, same as `getQueryResults`
+    """
+    rows = []
+    while start_index + len(rows) < end_index:
+        max_results = end_index - start_index - len(rows)
+        if page_size:
+            max_results = min(max_results, page_size)
+        response = gce_service.tabledata().list(projectId=table_ref['projectId'],
+                                                datasetId=table_ref['datasetId'],
+                                                tableId=table_ref['tableId'],
+                                                startIndex=start_index + len(rows),
+                                                maxResults=max_results).execute()
+        page = response.get('rows', [])
+        if not page:
+            break
+        rows.extend(page)
+    return rows
 
-    # Now create dtype list of tuples for np.array
-    dtypes = []
-    # save timestamp columns to convert in DF to datetime64 once complete
-    tstamp_cols = []
-    for field in query_response['schema']['fields']:
-        dtype_tuple = (str(field['name']),
-                       BQ_NP_TYPE_MAPPING[field['type']])
-        dtypes.append(dtype_tuple)
-        if field['type'] == 'TIMESTAMP':
-            tstamp_cols.append(field['name'])
 
-    arr = np.array(rows, dtype=dtypes)
-    df = pd.DataFrame(arr)
+def read_table_rows_parallel(service_builder, table_ref, start_index, end_index, page_size, num_readers):
+    """
+    Reads rows [start_index, end_index) of a BigQuery table with `num_readers` threads,
+    each reading `page_size`-row ranges at computed `startIndex` offsets.
+
+    :param service_builder: callable returning a new BigQuery API service. Each reader
+        builds its own since API services & their HTTP clients aren't thread-safe.
+    :param table_ref: dict w/ projectId, datasetId & tableId
+    :param start_index: first row to read
+    :param end_index: row to stop at, exclusive
+    :param page_size: number of rows read per call
+    :param num_readers: number of reader threads
+    :return: list of rows, in table order
+    """
+    ranges = queue.Queue()
+    for offset in range(start_index, end_index, page_size):
+        ranges.put((offset, min(offset + page_size, end_index)))
+    pages = {}
+    errors = []
+
+    def reader():
+        try:
+            gce_service = service_builder()
+            while not errors:
+                try:
+                    lo, hi = ranges.get_nowait()
+                except queue.Empty:
+                    return
+                pages[lo] = list_table_rows(gce_service, table_ref, lo, hi)
+        except Exception as e:
+            errors.append(e)
 
-    # now go back over dataframe and convert temporary float columns
-    # into datetime64's.
-    for col in tstamp_cols:
-        df[col] = df[col].astype('datetime64[s]')
-    return df
+    threads = [threading.Thread(target=reader, name='bq-reader-%s' % i)
+               for i in range(min(num_readers, ranges.qsize()))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    rows = []
+    for offset in sorted(pages):
+        rows.extend(pages[offset])
+    return rows
+
+
+def make_job_id(name, rendered_query, params=None):
+    """
+    Builds a deterministic BigQuery job ID, so running the same query w/ the same
+    parameters twice maps to the same job.
 
+    :param name: human-readable prefix, e.g. template name & time window. Characters
+        not allowed in job IDs are replaced w/ underscores.
+    :param rendered_query: rendered query string
+    :param params: dict of anything else which affects the job, e.g. query options
+    :return: job ID
+    """
+    digest = hashlib.sha1(rendered_query.encode('utf-8'))
+    digest.update(json.dumps(params or {}, sort_keys=True, default=str).encode('utf-8'))
+    return '%s_%s' % (re.sub(r'[^a-zA-Z0-9_-]', '_', name), digest.hexdigest())
+
+
+def insert_or_reuse_job(jobs_resource, project_id, job_id, body, max_attempts=10):
+    """
+    Inserts job w/ deterministic `job_id`, unless a job w/ that ID already exists, in which
+    case the existing job is returned instead, whether it's still running or DONE. Reruns
+    after a crash therefore attach to the original job rather than scanning (and, for
+    WRITE_APPEND destination tables, appending) all over again.
+
+    Job IDs can never be reused, so if the existing job failed, retries under
+    `<job_id>_retry<n>`, checking each of those for an existing job in turn.
+
+    :param jobs_resource: BigQuery jobs resource, i.e. `gce_service.jobs()`
+    :param project_id: project to run job in
+    :param job_id: deterministic job ID, e.g. from `make_job_id`
+    :param body: job resource to insert, w/o `jobReference`
+    :param max_attempts: max number of job IDs to try
+    :return: tuple of (job resource, whether existing job was reused)
+    """
+    for attempt in range(max_attempts):
+        attempt_id = job_id if attempt == 0 else '%s_retry%s' % (job_id, attempt)
+        try:
+            job = jobs_resource.get(projectId=project_id, jobId=attempt_id).execute()
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            job = None
+
+        if job is None:
+            body = dict(body)
+            body['jobReference'] = {'projectId': project_id, 'jobId': attempt_id}
+            try:
+                return jobs_resource.insert(projectId=project_id, body=body).execute(), False
+            except HttpError as e:
+                # 409 means someone else inserted it in the meantime, go pick it up
+                if e.resp.status != 409:
+                    raise
+                job = jobs_resource.get(projectId=project_id, jobId=attempt_id).execute()
+
+        if 'errorResult' not in job['status']:
+            logger.info('Reusing existing BigQuery job %s (%s)' % (attempt_id, job['status']['state']))
+            return job, True
+        logger.info('Existing BigQuery job %s failed, retrying under new job ID' % attempt_id)
+    raise RuntimeError('All %s job IDs for BigQuery job %s have failed' % (max_attempts, job_id))
+
+
+def find_reusable_job(jobs_resource, project_id, job_id, max_attempts=10):
+    """
+    Existing job `insert_or_reuse_job` would reuse for `job_id`, if any, w/o inserting anything.
+
+    :param jobs_resource: BigQuery jobs resource, i.e. `gce_service.jobs()`
+    :param project_id: project jobs run in
+    :param job_id: deterministic job ID, e.g. from `make_job_id`
+    :param max_attempts: max number of job IDs to try
+    :return: job resource, or None if a new job would be inserted
+    """
+    for attempt in range(max_attempts):
+        attempt_id = job_id if attempt == 0 else '%s_retry%s' % (job_id, attempt)
+        try:
+            job = jobs_resource.get(projectId=project_id, jobId=attempt_id).execute()
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # retries are numbered in order, so there's none after this one either
+            return None
+        if 'errorResult' not in job['status']:
+            return job
+    return None
+
+
+class JobDeadlineExceeded(Exception):
+    """
+    Raised by `JobWaiter` when job(s) aren't done before the waiter's deadline.
+    """
+    pass
+
+
+class JobWaiter(object):
+    """
+    Waits on BigQuery jobs with as little dead time & as few API calls as possible.
 
+    - Single query jobs are long-polled server-side via `getQueryResults`' `timeoutMs`,
+      so the call returns as soon as the job is done rather than on the next poll tick.
+    - Between polls that come back early (e.g. when waiting on many jobs), sleeps an
+      exponentially increasing delay, capped at `max_delay` & randomized by +/- `jitter`.
+    - Gives up w/ `JobDeadlineExceeded` once `deadline` seconds have passed.
+
+    Waiter holds no API clients, so a single one can be shared by any number of ETLs.
+
+    :param timeout_ms: max time BigQuery holds each `getQueryResults` call open
+    :param initial_delay: first backoff delay in seconds
+    :param max_delay: backoff delay cap in seconds
+    :param multiplier: backoff growth factor
+    :param jitter: fraction by which each delay is randomized
+    :param deadline: max seconds to wait in total, None waits forever
+    """
+    def __init__(self, timeout_ms=10000, initial_delay=0.5, max_delay=10.0, multiplier=2.0,
+                 jitter=0.2, deadline=None):
+        self.timeout_ms = timeout_ms
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def delays(self):
+        """
+        Generator of backoff delays in seconds.
+        """
+        delay = self.initial_delay
+        while True:
+            yield delay * (1 + random.uniform(-self.jitter, self.jitter))
+            delay = min(delay * self.multiplier, self.max_delay)
+
+    def _check_deadline(self, started, job_ids):
+        if self.deadline is not None and time() - started > self.deadline:
+            raise JobDeadlineExceeded('BigQuery jobs %s not done after %ss' % (', '.join(job_ids), self.deadline))
+
+    def _sleep(self, delays, started):
+        delay = next(delays)
+        if self.deadline is not None:
+            delay = max(min(delay, self.deadline - (time() - started)), 0)
+        sleep(delay)
+
+    def wait_for_query_results(self, jobs_resource, project_id, job_id, **results_kwargs):
+        """
+        Long-polls `getQueryResults` until query job is complete.
+
+        :param jobs_resource: BigQuery jobs resource, i.e. `gce_service.jobs()`
+        :param project_id: project job runs in
+        :param job_id: query job ID
+        :param results_kwargs: any other `getQueryResults` params, e.g. `maxResults`
+        :return: first complete `getQueryResults` response
+        """
+        started = time()
+        delays = self.delays()
+        while True:
+            polled = time()
+            query_response = jobs_resource.getQueryResults(projectId=project_id, jobId=job_id,
+                                                           timeoutMs=self.timeout_ms,
+                                                           **results_kwargs).execute()
+            if query_response['jobComplete']:
+                return query_response
+            self._check_deadline(started, [job_id])
+            # only back off if BigQuery didn't hold the call open for us
+            if time() - polled < self.timeout_ms / 1000.0 / 2:
+                self._sleep(delays, started)
+
+    def wait_for_job(self, jobs_resource, project_id, job_id):
+        """
+        Waits until a job of any kind is DONE.
+
+        :param jobs_resource: BigQuery jobs resource, i.e. `gce_service.jobs()`
+        :param project_id: project job runs in
+        :param job_id: job ID
+        :return: DONE job resource
+        """
+        return self.wait_for_jobs(jobs_resource, project_id, [job_id])[job_id]
+
+    def poll_jobs(self, jobs_resource, project_id, job_ids):
+        """
+        Single pass over pending jobs: long-polls the first one, which absorbs most of the
+        waiting server-side, then checks all of them with `jobs.get`.
+
+        :param jobs_resource: BigQuery jobs resource, i.e. `gce_service.jobs()`
+        :param project_id: project jobs run in
+        :param job_ids: list of job IDs, oldest first
+        :return: dict of job ID -> DONE job resource, for those of `job_ids` that are done
+        """
+        # getQueryResults only applies to query jobs & errors out on failed ones,
+        # either way jobs.get below sorts it out
+        try:
+            jobs_resource.getQueryResults(projectId=project_id, jobId=job_ids[0],
+                                          timeoutMs=self.timeout_ms, maxResults=0).execute()
+        except HttpError:
+            pass
+        done = {}
+        for job_id in job_ids:
+            job = jobs_resource.get(projectId=project_id, jobId=job_id).execute()
+            if job['status']['state'] == 'DONE':
+                done[job_id] = job
+        return done
+
+    def wait_for_jobs(self, jobs_resource, project_id, job_ids):
+        """
+        Waits on many jobs at once from a single poll loop with one set of backoff timers,
+        see `poll_jobs`.
+
+        :param jobs_resource: BigQuery jobs resource, i.e. `gce_service.jobs()`
+        :param project_id: project jobs run in
+        :param job_ids: list of job IDs
+        :return: dict of job ID -> DONE job resource
+        """
+        started = time()
+        delays = self.delays()
+        pending = list(job_ids)
+        done = {}
+        while True:
+            polled = time()
+            done.update(self.poll_jobs(jobs_resource, project_id, pending))
+            pending = [job_id for job_id in pending if job_id not in done]
+            if not pending:
+                return done
+            self._check_deadline(started, pending)
+            if time() - polled < self.timeout_ms / 1000.0 / 2:
+                self._sleep(delays, started)
+
+
+class JobPoller(object):
+    """
+    Waits on jobs submitted from any number of threads, e.g. concurrent `ETLScheduler` steps,
+    from a single background poll loop w/ one set of backoff timers, rather than each thread
+    polling its own job.
+
+    Poll thread is started when the first job is waited on & exits once no jobs are pending.
+    Each pass covers every pending job, so jobs waited on while a pass is running are picked
+    up by the next one. Timeouts, backoff & deadline (counted per job from when it's first
+    waited on) are those of `job_waiter`.
+
+    :param service_builder: callable returning a BigQuery API service for the poll thread
+    :param project_id: project jobs run in
+    :param job_waiter: `JobWaiter`, default long-polls w/ no deadline
+    """
+    def __init__(self, service_builder, project_id, job_waiter=None):
+        self.service_builder = service_builder
+        self.project_id = project_id
+        self.job_waiter = job_waiter or JobWaiter()
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._done = {}
+        self._new_jobs = False
+        self._thread = None
+
+    def wait_for_jobs(self, job_ids):
+        """
+        Blocks until all jobs are DONE.
+
+        :param job_ids: list of job IDs
+        :return: dict of job ID -> DONE job resource
+        :raises JobDeadlineExceeded: if any job isn't done by the waiter's deadline
+        """
+        with self._cond:
+            for job_id in job_ids:
+                if job_id not in self._done and job_id not in self._pending:
+                    self._pending[job_id] = time()
+                    self._new_jobs = True
+            if self._pending and self._thread is None:
+                self._thread = threading.Thread(target=self._poll, name='bigquery-job-poller')
+                self._thread.daemon = True
+                self._thread.start()
+            while any(job_id not in self._done for job_id in job_ids):
+                self._cond.wait()
+            results = dict((job_id, self._done[job_id]) for job_id in job_ids)
+        for result in results.values():
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def wait_for_job(self, job_id):
+        return self.wait_for_jobs([job_id])[job_id]
+
+    def _finish(self, job_id, result):
+        # caller holds the lock
+        self._done[job_id] = result
+        del self._pending[job_id]
+
+    def _poll(self):
+        try:
+            self._poll_loop()
+        except Exception as e:
+            # e.g. building the service failed, fail everyone waiting rather than leaving them
+            # hanging on a thread that's gone, & let the next waiter start a new one
+            logger.exception('BigQuery job poll thread failed')
+            with self._cond:
+                for job_id in list(self._pending):
+                    self._finish(job_id, e)
+                self._thread = None
+                self._cond.notify_all()
+
+    def _poll_loop(self):
+        jobs_resource = self.service_builder().jobs()
+        delays = None
+        while True:
+            with self._cond:
+                if not self._pending:
+                    self._thread = None
+                    return
+                # new jobs may finish quickly, so start backing off from scratch
+                if self._new_jobs:
+                    delays = self.job_waiter.delays()
+                    self._new_jobs = False
+                job_ids = sorted(self._pending, key=self._pending.get)
+            polled = time()
+            try:
+                done = self.job_waiter.poll_jobs(jobs_resource, self.project_id, job_ids)
+            except Exception as e:
+                # hand API errors to everyone waiting rather than leaving them hanging
+                logger.exception('Polling BigQuery jobs %s failed' % ', '.join(job_ids))
+                done = dict((job_id, e) for job_id in job_ids)
+            with self._cond:
+                for job_id, job in done.items():
+                    self._finish(job_id, job)
+                if self.job_waiter.deadline is not None:
+                    for job_id, registered in list(self._pending.items()):
+                        if time() - registered > self.job_waiter.deadline:
+                            self._finish(job_id, JobDeadlineExceeded('BigQuery job %s not done after %ss'
+                                                                     % (job_id, self.job_waiter.deadline)))
+                self._cond.notify_all()
+                back_off = self._pending and not self._new_jobs
+            if back_off and time() - polled < self.job_waiter.timeout_ms / 1000.0 / 2:
+                sleep(next(delays))
+
+
+def table_layout(partition_field, partition_type='DAY', clustering_fields=None):
+    """
+    Time partitioning & clustering spec for a table, in the form both table resources &
+    query job configurations take it, so it can be merged into either.
+
+    :param partition_field: TIMESTAMP column to partition on
+    :param partition_type: 'DAY' or 'HOUR'
+    :param clustering_fields: up to 4 columns to sort rows by within each partition
+    :return: dict w/ `timePartitioning` & (if clustered) `clustering`
+    """
+    layout = {'timePartitioning': {'type': partition_type, 'field': partition_field}}
+    if clustering_fields:
+        layout['clustering'] = {'fields': list(clustering_fields)}
+    return layout
+
+
+def has_layout(table, layout):
+    """
+    Whether table is partitioned & clustered as `layout` says. BigQuery rejects query jobs
+    whose layout doesn't match that of an existing destination table.
+
+    :param table: table resource, i.e. from `get_table`
+    :param layout: layout from `table_layout`
+    """
+    partitioning = table.get('timePartitioning') or {}
+    wanted = layout['timePartitioning']
+    if partitioning.get('type') != wanted['type'] or partitioning.get('field') != wanted['field']:
+        return False
+    return (table.get('clustering') or {}).get('fields') == (layout.get('clustering') or {}).get('fields')
+
+
+def get_table(tables_resource, project_id, dataset_id, table_id):
+    """
+    :param tables_resource: BigQuery tables resource, i.e. `gce_service.tables()`
+    :return: table resource, or None if table doesn't exist
+    """
+    try:
+        return tables_resource.get(projectId=project_id, datasetId=dataset_id, tableId=table_id).execute()
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        return None
+
+
+def _run_job(gce_service, project_id, configuration, job_waiter):
+    job = gce_service.jobs().insert(projectId=project_id, body={'configuration': configuration}).execute()
+    if job['status']['state'] != 'DONE':
+        job = job_waiter.wait_for_job(gce_service.jobs(), project_id, job['jobReference']['jobId'])
+    if 'errorResult' in job['status']:
+        raise RuntimeError('BigQuery job %s failed: %s' % (job['jobReference']['jobId'], job['status']['errorResult']))
+    return job
+
+
+def relayout_table(gce_service, project_id, dataset_id, table_id, layout, job_waiter, backup_table_id=None):
+    """
+    Rewrites an existing table w/ a new partitioning & clustering layout, which BigQuery
+    can't change in place:
+
+    1. copies table to `backup_table_id` (copy jobs are free)
+    2. deletes table
+    3. recreates it from the backup w/ a query job carrying `layout`
+
+    Table doesn't exist between 2. & 3., so nothing should be reading or writing it meanwhile.
+    Backup is left in place for the caller to drop once satisfied w/ the result.
+
+    :param gce_service: BigQuery API service
+    :param layout: layout from `table_layout`
+    :param job_waiter: `JobWaiter` to wait on copy & query jobs w/
+    :param backup_table_id: default `<table_id>_backup`, must not exist yet
+    :return: DONE query job resource
+    """
+    backup_table_id = backup_table_id or '%s_backup' % table_id
+    table_ref = {'projectId': project_id, 'datasetId': dataset_id, 'tableId': table_id}
+    backup_ref = dict(table_ref, tableId=backup_table_id)
+
+    logger.info('Copying %s.%s to %s' % (dataset_id, table_id, backup_table_id))
+    _run_job(gce_service, project_id, {'copy': {'sourceTable': table_ref, 'destinationTable': backup_ref,
+                                                'createDisposition': 'CREATE_IF_NEEDED',
+                                                'writeDisposition': 'WRITE_EMPTY'}}, job_waiter)
+
+    logger.info('Deleting %s.%s' % (dataset_id, table_id))
+    gce_service.tables().delete(projectId=project_id, datasetId=dataset_id, tableId=table_id).execute()
+
+    logger.info('Recreating %s.%s w/ layout %s' % (dataset_id, table_id, json.dumps(layout, sort_keys=True)))
+    query_config = {
+        'query': '#standardSQL\nSELECT * FROM `%s.%s`' % (dataset_id, backup_table_id),
+        'useLegacySql': False,
+        'destinationTable': table_ref,
+        'createDisposition': 'CREATE_IF_NEEDED',
+        'writeDisposition': 'WRITE_EMPTY'
+    }
+    query_config.update(layout)
+    return _run_job(gce_service, project_id, {'query': query_config}, job_waiter)
+
+
+def dry_run_bytes(jobs_resource, project_id, query, use_legacy_sql=False, query_options=None):
+    """
+    Bytes a query would process, from a dry run, which is free & returns right away
+    w/o running the query.
+
+    :param jobs_resource: BigQuery jobs resource, i.e. `gce_service.jobs()`
+    :param project_id: project to dry run query in
+    :param query: rendered query
+    :param query_options: any other query job options, e.g. destination table & layout
+    :return: int
+    """
+    query_config = {'useLegacySql': use_legacy_sql}
+    query_config.update(query_options or {})
+    query_config['query'] = query
+    body = {'configuration': {'query': query_config, 'dryRun': True}}
+    job = jobs_resource.insert(projectId=project_id, body=body).execute()
+    return int(job['statistics']['query']['totalBytesProcessed'])
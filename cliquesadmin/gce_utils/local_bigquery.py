@@ -0,0 +1,660 @@
+"""
+Embedded stand-in for the BigQuery API, so query templates & the ETLs which run them can be
+benchmarked & checked for correctness offline.
+
+`LocalBigQueryService` mimics the parts of a built BigQuery API service the ETLs use
+(`jobs().insert/get/getQueryResults`, `tabledata().list` & `tables().get/delete`, each returning
+a request w/ an `execute` method), running query & copy jobs. Queries run against an in-process sqlite database after a regex
+translation of the standard SQL constructs our templates use, see `translate_query`. Pass
+one to `BigQueryETL` (or `hourly_adstats_steps`) as `service` instead of a real one.
+
+Raw event tables are filled w/ synthetic data by `load_synthetic_ad_events`. Timestamps are
+stored as 'YYYY-MM-DD HH:MM:SS' strings & returned as epoch seconds like BigQuery does.
+Every table lives in one sqlite database, so dataset names in queries are ignored. Tables'
+partitioning & clustering are only recorded & checked on append, not used.
+
+Queries are run one at a time, so timings are for the queries themselves rather than for
+BigQuery's parallelism.
+"""
+import re
+import json
+import random
+import sqlite3
+import logging
+import calendar
+import threading
+from time import time
+from datetime import datetime, timedelta
+import six
+import httplib2
+from googleapiclient.errors import HttpError
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+TIMESTAMP_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d+)?$')
+
+INTERVAL_UNITS = {
+    'DAY': 'days',
+    'HOUR': 'hours',
+    'MINUTE': 'minutes',
+    'SECOND': 'seconds'
+}
+
+
+def _timestamp_add(match, sign=1):
+    amount = int(match.group(2).replace(' ', '')) * sign
+    return "datetime(%s, '%+d %s')" % (match.group(1), amount, INTERVAL_UNITS[match.group(3).upper()])
+
+
+def _timestamp_trunc(match):
+    if match.group(2).upper() == 'DAY':
+        return "datetime(%s, 'start of day')" % match.group(1)
+    return "strftime('%%Y-%%m-%%d %%H:00:00', %s)" % match.group(1)
+
+
+# (pattern, replacement) pairs applied in order by `translate_query`
+QUERY_TRANSLATIONS = [
+    # comments can hold quotes & parens, which would throw off `resolve_group_by_aliases`
+    (re.compile(r'--[^\n]*'), ''),
+    # dialect prefix isn't valid sqlite
+    (re.compile(r'^\s*#(standard|legacy)SQL\s*$', re.M | re.I), ''),
+    # `project.dataset.table` -> table
+    (re.compile(r'`(?:[\w-]+\.)*(\w+)`'), r'\1'),
+    # timestamps are stored as strings, so literals are just strings
+    (re.compile(r"\bTIMESTAMP\s*\(\s*('[^']*')\s*\)", re.I), r'\1'),
+    (re.compile(r"\bTIMESTAMP_ADD\s*\(\s*('[^']*'|[\w.]+)\s*,\s*INTERVAL\s+(-?\s*\d+)\s+(DAY|HOUR|MINUTE|SECOND)\s*\)",
+                re.I), _timestamp_add),
+    (re.compile(r"\bTIMESTAMP_SUB\s*\(\s*('[^']*'|[\w.]+)\s*,\s*INTERVAL\s+(-?\s*\d+)\s+(DAY|HOUR|MINUTE|SECOND)\s*\)",
+                re.I), lambda m: _timestamp_add(m, sign=-1)),
+    (re.compile(r"\bTIMESTAMP_TRUNC\s*\(\s*('[^']*'|[\w.]+)\s*,\s*(DAY|HOUR)\s*\)", re.I), _timestamp_trunc),
+    # IF is a keyword in sqlite
+    (re.compile(r'\bIF\s*\(', re.I), 'IIF('),
+    # templates only ever take the first element of ARRAY_AGGs, to pick one row per group.
+    # sqlite takes bare columns in an aggregate query from a single row of the group, so
+    # dropping the ARRAY_AGG keeps all columns from the same row, like BigQuery does.
+    (re.compile(r'\bARRAY_AGG\s*\(([^()]*)\)', re.I), r'\1'),
+    (re.compile(r'(\w+)\s*\[\s*(?:SAFE_)?(?:ORDINAL\s*\(\s*1\s*\)|OFFSET\s*\(\s*0\s*\))\s*\]', re.I), r'\1'),
+]
+
+
+GROUP_BY_END = re.compile(r'\b(HAVING|ORDER|LIMIT|UNION|WINDOW)\b', re.I)
+
+
+def _paren_depths(query):
+    """
+    Parenthesis depth at each character of query, ignoring parens in string literals.
+    """
+    depths = []
+    depth = 0
+    in_string = False
+    for ch in query:
+        if ch == "'":
+            in_string = not in_string
+        elif not in_string and ch == ')':
+            depth -= 1
+        depths.append(depth)
+        if not in_string and ch == '(':
+            depth += 1
+    return depths
+
+
+def _split_top_level(text):
+    """
+    Splits text on commas outside of parens & string literals.
+    """
+    parts = []
+    start = 0
+    for i, depth in enumerate(_paren_depths(text)):
+        if depth == 0 and text[i] == ',' and text[:i].count("'") % 2 == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def resolve_group_by_aliases(query):
+    """
+    Replaces select list aliases in GROUP BY clauses w/ the expressions they alias.
+
+    BigQuery resolves GROUP BY names to select list aliases before input columns, sqlite
+    does it the other way round & errors out when a name is a column of more than one
+    joined table, e.g. `GROUP BY tstamp` for `auctions.tstamp AS tstamp`.
+
+    :param query: sqlite query w/o comments
+    :return: query
+    """
+    depths = _paren_depths(query)
+    selects = list(re.finditer(r'\bSELECT\b', query, re.I))
+    froms = list(re.finditer(r'\bFROM\b', query, re.I))
+    replacements = []
+    for group_by in re.finditer(r'\bGROUP\s+BY\b', query, re.I):
+        depth = depths[group_by.start()]
+        # SELECT this GROUP BY belongs to: the closest one before it at the same depth,
+        # w/o leaving the enclosing parens in between
+        select = None
+        for candidate in selects:
+            if candidate.start() < group_by.start() and depths[candidate.start()] == depth and \
+                    min(depths[candidate.start():group_by.start()]) >= depth:
+                select = candidate
+        select_from = select and next((f for f in froms if f.start() > select.end()
+                                       and depths[f.start()] == depth), None)
+        if select_from is None:
+            continue
+        aliases = {}
+        for item in _split_top_level(query[select.end():select_from.start()]):
+            aliased = re.match(r'(?s)\s*(.*?)\s+AS\s+(\w+)\s*$', item, re.I)
+            if aliased and aliased.group(1) != aliased.group(2):
+                aliases[aliased.group(2).lower()] = aliased.group(1)
+
+        end = group_by.end()
+        while end < len(query) and depths[end] >= depth and \
+                not (depths[end] == depth and GROUP_BY_END.match(query, end)):
+            end += 1
+        items = _split_top_level(query[group_by.end():end])
+        resolved = []
+        for item in items:
+            name = item.strip()
+            if re.match(r'^\w+$', name) and name.lower() in aliases:
+                item = item.replace(name, aliases[name.lower()])
+            resolved.append(item)
+        replacements.append((group_by.end(), end, ','.join(resolved)))
+
+    for start, end, text in reversed(replacements):
+        query = query[:start] + text + query[end:]
+    return query
+
+
+def translate_query(query):
+    """
+    Translates a rendered standard SQL query to sqlite.
+
+    Covers what our templates use: `#standardSQL`, backtick table names, TIMESTAMP literals,
+    TIMESTAMP_ADD/SUB/TRUNC, IF, CONCAT (see `_concat`), first-element ARRAY_AGGs, GROUP BY
+    aliases & `_PARTITIONTIME`, which raw tables have as a regular column.
+
+    :param query: rendered BigQuery standard SQL
+    :return: sqlite query
+    """
+    for pattern, replacement in QUERY_TRANSLATIONS:
+        query = pattern.sub(replacement, query)
+    return resolve_group_by_aliases(query)
+
+
+def _concat(*args):
+    """
+    BigQuery CONCAT, which is NULL if any argument is.
+    """
+    if any(arg is None for arg in args):
+        return None
+    return ''.join(six.text_type(arg) for arg in args)
+
+
+def _iif(condition, if_true, if_false):
+    return if_true if condition else if_false
+
+
+def infer_field_type(values):
+    """
+    BigQuery type of a result column from its sqlite values.
+    """
+    values = [v for v in values if v is not None]
+    if not values:
+        return 'STRING'
+    if all(isinstance(v, six.integer_types) and not isinstance(v, bool) for v in values):
+        return 'INTEGER'
+    if all(isinstance(v, six.integer_types + (float,)) for v in values):
+        return 'FLOAT'
+    if all(isinstance(v, six.string_types) and TIMESTAMP_PATTERN.match(v) for v in values):
+        return 'TIMESTAMP'
+    return 'STRING'
+
+
+def encode_value(value, field_type):
+    """
+    Encodes a sqlite value as a BigQuery API cell value.
+    """
+    if value is None:
+        return None
+    if field_type == 'TIMESTAMP':
+        seconds, _, fraction = value.partition('.')
+        epoch = calendar.timegm(datetime.strptime(seconds, TIMESTAMP_FORMAT).timetuple())
+        return repr(epoch + float('0.' + (fraction or '0')))
+    if field_type == 'FLOAT':
+        return repr(float(value))
+    return six.text_type(value)
+
+
+def encode_rows(rows, fields):
+    return [{'f': [{'v': encode_value(v, field['type'])} for v, field in zip(row, fields)]} for row in rows]
+
+
+def _http_error(status, message):
+    content = json.dumps({'error': {'code': status, 'message': message}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class LocalRequest(object):
+    """
+    Deferred call, like the `HttpRequest`s returned by API resource methods.
+    """
+    def __init__(self, func, **kwargs):
+        self.func = func
+        self.kwargs = kwargs
+
+    def execute(self):
+        return self.func(**self.kwargs)
+
+
+class LocalJobsResource(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def insert(self, projectId, body):
+        return LocalRequest(self.service.insert_job, project_id=projectId, body=body)
+
+    def get(self, projectId, jobId):
+        return LocalRequest(self.service.get_job, job_id=jobId)
+
+    def getQueryResults(self, projectId, jobId, pageToken=None, startIndex=None, maxResults=None, **kwargs):
+        return LocalRequest(self.service.get_query_results, job_id=jobId, page_token=pageToken,
+                            start_index=startIndex, max_results=maxResults)
+
+
+class LocalTabledataResource(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, projectId, datasetId, tableId, startIndex=0, maxResults=None, **kwargs):
+        return LocalRequest(self.service.list_table_rows, table_id=tableId, start_index=startIndex,
+                            max_results=maxResults)
+
+
+class LocalTablesResource(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, projectId, datasetId, tableId):
+        return LocalRequest(self.service.get_table, project_id=projectId, dataset_id=datasetId, table_id=tableId)
+
+    def delete(self, projectId, datasetId, tableId):
+        return LocalRequest(self.service.delete_table, project_id=projectId, dataset_id=datasetId, table_id=tableId)
+
+
+class LocalBigQueryService(object):
+    """
+    In-process BigQuery stand-in backed by sqlite. Jobs run synchronously on insert, so are
+    always DONE by the time they're waited on.
+
+    :param path: sqlite database path, default keeps everything in memory
+    :param project_id: project ID reported in job references
+    :param max_page_rows: max rows per `getQueryResults` / `tabledata.list` page when
+        `maxResults` isn't given, like BigQuery's response size cap
+    """
+    def __init__(self, path=':memory:', project_id='local', max_page_rows=100000):
+        self.project_id = project_id
+        self.max_page_rows = max_page_rows
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.create_function('CONCAT', -1, _concat)
+        if sqlite3.sqlite_version_info < (3, 32, 0):
+            self.conn.create_function('IIF', 3, _iif)
+        self._lock = threading.RLock()
+        self._jobs = {}
+        # job ID -> (fields, rows) of query results
+        self._results = {}
+        # table ID -> `timePartitioning` & `clustering` it was created w/, only reported back
+        self._layouts = {}
+
+    def jobs(self):
+        return LocalJobsResource(self)
+
+    def tabledata(self):
+        return LocalTabledataResource(self)
+
+    def tables(self):
+        return LocalTablesResource(self)
+
+    def load_rows(self, table_id, rows, indexes=None):
+        """
+        Appends rows to a table, creating it w/ the first row's columns if needed.
+
+        :param table_id: table name
+        :param rows: list of dicts of column -> value. Datetimes are stored as timestamp strings.
+        :param indexes: list of columns to index, e.g. join keys
+        """
+        if not rows:
+            return
+        columns = sorted(rows[0])
+        values = [[r.get(c).strftime(TIMESTAMP_FORMAT) if isinstance(r.get(c), datetime) else r.get(c)
+                   for c in columns] for r in rows]
+        with self._lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table_id, ', '.join(columns)))
+            self.conn.executemany('INSERT INTO %s (%s) VALUES (%s)'
+                                  % (table_id, ', '.join(columns), ', '.join('?' * len(columns))), values)
+            for column in indexes or []:
+                self.conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                                  % (table_id, column, table_id, column))
+            self.conn.commit()
+
+    def load_synthetic_ad_events(self, start, hours=1, scale=1000, seed=0):
+        """
+        Fills raw event tables w/ synthetic data, see `synthetic_ad_events`.
+
+        :return: dict of table name -> number of rows loaded
+        """
+        counts = {}
+        for table_id, rows in synthetic_ad_events(start, hours=hours, scale=scale, seed=seed).items():
+            self.load_rows(table_id, rows, indexes=SYNTHETIC_INDEXES.get(table_id))
+            counts[table_id] = len(rows)
+        logger.info('Loaded synthetic ad events: %s' % ', '.join('%s %s' % (n, t) for t, n in sorted(counts.items())))
+        return counts
+
+    def table_exists(self, table_id):
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                     (table_id,)).fetchone() is not None
+
+    def table_bytes(self, table_id):
+        """
+        Rough size of a table, counting 8 bytes per cell, used as bytes processed.
+        """
+        with self._lock:
+            cursor = self.conn.execute('SELECT * FROM %s LIMIT 0' % table_id)
+            num_columns = len(cursor.description)
+            num_rows = self.conn.execute('SELECT COUNT(*) FROM %s' % table_id).fetchone()[0]
+        return num_rows * num_columns * 8
+
+    def insert_job(self, project_id, body):
+        if body['configuration'].get('dryRun'):
+            return self._dry_run_job(project_id, body)
+        job_reference = dict(body.get('jobReference') or {})
+        job_reference.setdefault('projectId', project_id)
+        job_reference.setdefault('jobId', 'local_job_%s' % len(self._jobs))
+        job_id = job_reference['jobId']
+        with self._lock:
+            if job_id in self._jobs:
+                raise _http_error(409, 'Already Exists: Job %s' % job_id)
+            configuration = json.loads(json.dumps(body['configuration']))
+            job = {
+                'kind': 'bigquery#job',
+                'id': '%s:%s' % (project_id, job_id),
+                'jobReference': job_reference,
+                'configuration': configuration,
+                'status': {'state': 'DONE'},
+                'statistics': {}
+            }
+            self._jobs[job_id] = job
+            started = time()
+            try:
+                if 'copy' in configuration:
+                    self._run_copy_job(job)
+                else:
+                    self._run_query_job(job)
+            except sqlite3.Error as e:
+                logger.error('Local job %s failed: %s' % (job_id, e))
+                job['status']['errorResult'] = {'reason': 'invalidQuery', 'message': str(e)}
+                job['status']['errors'] = [job['status']['errorResult']]
+            ended = time()
+            job['statistics'].update({
+                'creationTime': str(int(started * 1000)),
+                'startTime': str(int(started * 1000)),
+                'endTime': str(int(ended * 1000))
+            })
+        return job
+
+    def _bytes_processed(self, query):
+        referenced = set(m.group(1) for m in re.finditer(r'`(?:[\w-]+\.)*(\w+)`', query))
+        return sum(self.table_bytes(t) for t in referenced if self.table_exists(t))
+
+    def _dry_run_job(self, project_id, body):
+        # dry runs are neither run nor kept, like BigQuery's
+        configuration = json.loads(json.dumps(body['configuration']))
+        return {
+            'kind': 'bigquery#job',
+            'jobReference': {'projectId': project_id},
+            'configuration': configuration,
+            'status': {'state': 'DONE'},
+            'statistics': {'query': {'totalBytesProcessed': str(self._bytes_processed(configuration['query']['query']))}}
+        }
+
+    def _run_query_job(self, job):
+        query_config = job['configuration']['query']
+        query = query_config['query']
+        job['statistics']['query'] = {
+            'totalBytesProcessed': str(self._bytes_processed(query)),
+            'cacheHit': False
+        }
+        cursor = self.conn.execute(translate_query(query))
+        names = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        fields = [{'name': name, 'type': infer_field_type([r[i] for r in rows]), 'mode': 'NULLABLE'}
+                  for i, name in enumerate(names)]
+
+        destination = query_config.get('destinationTable')
+        if destination:
+            table_id = destination['tableId']
+            exists = self.table_exists(table_id)
+            layout = dict((k, query_config[k]) for k in ('timePartitioning', 'clustering') if k in query_config)
+            if exists and layout and layout != self._layouts.get(table_id, {}):
+                raise sqlite3.OperationalError('Incompatible table partitioning specification for %s' % table_id)
+            if exists and query_config.get('writeDisposition') == 'WRITE_TRUNCATE':
+                self.conn.execute('DELETE FROM %s' % table_id)
+            elif exists and query_config.get('writeDisposition') == 'WRITE_EMPTY' and \
+                    self.conn.execute('SELECT 1 FROM %s LIMIT 1' % table_id).fetchone():
+                raise sqlite3.OperationalError('Table %s is not empty' % table_id)
+            if not exists:
+                if query_config.get('createDisposition') == 'CREATE_NEVER':
+                    raise sqlite3.OperationalError('Table %s does not exist' % table_id)
+                self.conn.execute('CREATE TABLE %s (%s)' % (table_id, ', '.join(names)))
+                self._layouts[table_id] = layout
+            self.conn.executemany('INSERT INTO %s (%s) VALUES (%s)'
+                                  % (table_id, ', '.join(names), ', '.join('?' * len(names))), rows)
+            self.conn.commit()
+        else:
+            # anonymous results table, like BigQuery's temporary destination tables
+            destination = {'projectId': job['jobReference']['projectId'], 'datasetId': '_local',
+                           'tableId': '_results_%s' % job['jobReference']['jobId']}
+            query_config['destinationTable'] = destination
+        self._results[job['jobReference']['jobId']] = (fields, rows)
+        self._results[destination['tableId']] = (fields, rows)
+
+    def _run_copy_job(self, job):
+        copy_config = job['configuration']['copy']
+        source_id = copy_config['sourceTable']['tableId']
+        table_id = copy_config['destinationTable']['tableId']
+        if not self.table_exists(source_id):
+            raise sqlite3.OperationalError('Table %s does not exist' % source_id)
+        if self.table_exists(table_id):
+            if copy_config.get('writeDisposition') == 'WRITE_TRUNCATE':
+                self.conn.execute('DROP TABLE %s' % table_id)
+            elif copy_config.get('writeDisposition') == 'WRITE_EMPTY' and \
+                    self.conn.execute('SELECT 1 FROM %s LIMIT 1' % table_id).fetchone():
+                raise sqlite3.OperationalError('Table %s is not empty' % table_id)
+            else:
+                self.conn.execute('INSERT INTO %s SELECT * FROM %s' % (table_id, source_id))
+                self.conn.commit()
+                return
+        self.conn.execute('CREATE TABLE %s AS SELECT * FROM %s' % (table_id, source_id))
+        self._layouts[table_id] = self._layouts.get(source_id, {})
+        self.conn.commit()
+
+    def delete_table(self, project_id, dataset_id, table_id):
+        with self._lock:
+            if not self.table_exists(table_id):
+                raise _http_error(404, 'Not found: Table %s:%s.%s' % (project_id, dataset_id, table_id))
+            self.conn.execute('DROP TABLE %s' % table_id)
+            self.conn.commit()
+            self._layouts.pop(table_id, None)
+            self._results.pop(table_id, None)
+        return {}
+
+    def get_table(self, project_id, dataset_id, table_id):
+        with self._lock:
+            if not self.table_exists(table_id):
+                raise _http_error(404, 'Not found: Table %s:%s.%s' % (project_id, dataset_id, table_id))
+            cursor = self.conn.execute('SELECT * FROM %s' % table_id)
+            rows = cursor.fetchall()
+            fields = [{'name': d[0], 'type': infer_field_type([r[i] for r in rows]), 'mode': 'NULLABLE'}
+                      for i, d in enumerate(cursor.description)]
+        table = {
+            'kind': 'bigquery#table',
+            'tableReference': {'projectId': project_id, 'datasetId': dataset_id, 'tableId': table_id},
+            'schema': {'fields': fields},
+            'numRows': str(len(rows)),
+            'numBytes': str(self.table_bytes(table_id))
+        }
+        table.update(self._layouts.get(table_id, {}))
+        return table
+
+    def get_job(self, job_id):
+        with self._lock:
+            if job_id not in self._jobs:
+                raise _http_error(404, 'Not found: Job %s' % job_id)
+            return self._jobs[job_id]
+
+    def _page(self, rows, start_index, max_results):
+        if max_results is None:
+            max_results = self.max_page_rows
+        end = min(start_index + int(max_results), len(rows))
+        return rows[start_index:end], (str(end) if end < len(rows) else None)
+
+    def get_query_results(self, job_id, page_token=None, start_index=None, max_results=None):
+        job = self.get_job(job_id)
+        if 'errorResult' in job['status']:
+            raise _http_error(400, job['status']['errorResult']['message'])
+        if job_id not in self._results:
+            raise _http_error(400, 'Job %s is not a query job' % job_id)
+        fields, rows = self._results[job_id]
+        start_index = int(page_token or start_index or 0)
+        page, next_token = self._page(rows, start_index, max_results)
+        response = {
+            'kind': 'bigquery#getQueryResultsResponse',
+            'jobReference': job['jobReference'],
+            'jobComplete': True,
+            'schema': {'fields': fields},
+            'totalRows': str(len(rows)),
+            'rows': encode_rows(page, fields),
+            'totalBytesProcessed': job['statistics']['query']['totalBytesProcessed'],
+            'cacheHit': False
+        }
+        if next_token:
+            response['pageToken'] = next_token
+        return response
+
+    def list_table_rows(self, table_id, start_index=0, max_results=None):
+        with self._lock:
+            if table_id in self._results:
+                fields, rows = self._results[table_id]
+            elif self.table_exists(table_id):
+                cursor = self.conn.execute('SELECT * FROM %s' % table_id)
+                rows = cursor.fetchall()
+                fields = [{'name': d[0], 'type': infer_field_type([r[i] for r in rows]), 'mode': 'NULLABLE'}
+                          for i, d in enumerate(cursor.description)]
+            else:
+                raise _http_error(404, 'Not found: Table %s' % table_id)
+        page, next_token = self._page(rows, int(start_index or 0), max_results)
+        response = {'kind': 'bigquery#tableDataList', 'totalRows': str(len(rows)), 'rows': encode_rows(page, fields)}
+        if next_token:
+            response['pageToken'] = next_token
+        return response
+
+
+# join & filter columns of raw event tables, indexed on load
+SYNTHETIC_INDEXES = {
+    'auctions': ['tstamp', 'impid', 'auctionId'],
+    'impressions': ['tstamp', 'impid', 'uuid'],
+    'bids': ['tstamp', 'auctionId', 'bidid'],
+    'clicks': ['tstamp', 'impid', 'uuid'],
+    'actions': ['tstamp', 'uuid'],
+    'auction_defaults': ['auctionId']
+}
+
+
+def synthetic_ad_events(start, hours=1, scale=1000, seed=0):
+    """
+    Generates raw ad event rows for `hours` hours from `start`, w/ `scale` auctions per hour.
+
+    Roughly 5% of auctions default (level 'error' & an `auction_defaults` row), the rest get
+    1-4 bids from different adv cliques & one impression from the top bidder. 2% of impressions
+    are clicked & 1% of users later convert, about half of them after a click. Users come
+    from a pool a third the size of the number of auctions, so actions can match earlier
+    impressions. Every row has a `_PARTITIONTIME` of midnight of its `tstamp`.
+
+    :param start: datetime of first hour
+    :param hours: number of hours
+    :param scale: auctions per hour
+    :param seed: random seed, same seed gives the same events
+    :return: dict of table name -> list of row dicts
+    """
+    rnd = random.Random(seed)
+    publishers = ['pub%s' % i for i in range(10)]
+    advertisers = ['adv%s' % i for i in range(10)]
+    cliques = ['clique%s' % i for i in range(5)]
+    geos = [('USA', 'USA-%s' % s, 'city%s' % i, str(500 + i), '%05d' % (10000 + i))
+            for i, s in enumerate(['NY', 'CA', 'TX', 'IL', 'WA'])]
+    keywords = ['outdoor,camping', 'ski', 'bike,road,gravel', '', None]
+    users = ['user%s' % i for i in range(max(scale * hours // 3, 1))]
+    tables = dict((name, []) for name in ('auctions', 'impressions', 'bids', 'clicks', 'actions', 'auction_defaults'))
+
+    def partition_time(tstamp):
+        return tstamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    for n in range(scale * hours):
+        tstamp = start + timedelta(seconds=rnd.randint(0, hours * 3600 - 1))
+        publisher = rnd.choice(publishers)
+        site = '%s_site%s' % (publisher, rnd.randint(0, 2))
+        page = '%s_page%s' % (site, rnd.randint(0, 4))
+        country, region, city, metro, zipcode = rnd.choice(geos)
+        auction = {
+            'tstamp': tstamp, '_PARTITIONTIME': partition_time(tstamp),
+            'auctionId': 'auction%s' % n, 'impid': 'imp%s' % n, 'uuid': rnd.choice(users),
+            'publisher': publisher, 'site': site, 'page': page, 'placement': '%s_placement%s' % (page, rnd.randint(0, 1)),
+            'pub_clique': rnd.choice(cliques), 'country': country, 'region': region, 'city': city,
+            'metro': metro, 'zip': zipcode, 'keywords': rnd.choice(keywords), 'level': 'info'
+        }
+        tables['auctions'].append(auction)
+        if rnd.random() < 0.05:
+            auction['level'] = 'error'
+            tables['auction_defaults'].append({'tstamp': tstamp, '_PARTITIONTIME': partition_time(tstamp),
+                                               'auctionId': auction['auctionId'], 'impid': auction['impid']})
+            continue
+
+        bids = []
+        for i, adv_clique in enumerate(rnd.sample(cliques, rnd.randint(1, 4))):
+            bids.append({'tstamp': tstamp, '_PARTITIONTIME': partition_time(tstamp),
+                         'auctionId': auction['auctionId'], 'impid': auction['impid'],
+                         'bidid': '%s_bid%s' % (auction['auctionId'], i), 'adv_clique': adv_clique,
+                         'bid': round(rnd.uniform(0.5, 10.0), 2)})
+        tables['bids'].extend(bids)
+        winner = max(bids, key=lambda b: b['bid'])
+        advertiser = rnd.choice(advertisers)
+        campaign = '%s_campaign%s' % (advertiser, rnd.randint(0, 2))
+        creativegroup = '%s_cg%s' % (campaign, rnd.randint(0, 1))
+        imp_tstamp = tstamp + timedelta(seconds=rnd.randint(0, 2))
+        impression = {
+            'tstamp': imp_tstamp, '_PARTITIONTIME': partition_time(imp_tstamp),
+            'impid': auction['impid'], 'uuid': auction['uuid'], 'advertiser': advertiser,
+            'campaign': campaign, 'creativegroup': creativegroup,
+            'creative': '%s_creative%s' % (creativegroup, rnd.randint(0, 2)), 'adv_clique': winner['adv_clique']
+        }
+        tables['impressions'].append(impression)
+
+        last_touch = imp_tstamp
+        if rnd.random() < 0.02:
+            last_touch = imp_tstamp + timedelta(seconds=rnd.randint(1, 600))
+            click = dict((k, impression[k]) for k in ('impid', 'uuid', 'advertiser', 'campaign', 'creativegroup',
+                                                      'creative', 'adv_clique'))
+            click.update({'tstamp': last_touch, '_PARTITIONTIME': partition_time(last_touch),
+                          'clickid': 'click%s' % n})
+            tables['clicks'].append(click)
+        if rnd.random() < 0.01 or (last_touch != imp_tstamp and rnd.random() < 0.5):
+            action_tstamp = last_touch + timedelta(seconds=rnd.randint(1, 1800))
+            tables['actions'].append({
+                'tstamp': action_tstamp, '_PARTITIONTIME': partition_time(action_tstamp),
+                'actionid': 'action%s' % n, 'uuid': auction['uuid'], 'advertiser': advertiser,
+                'actionbeacon': '%s_beacon%s' % (advertiser, rnd.randint(0, 1)), 'value': rnd.randint(0, 100)
+            })
+    return tables
@@ -14,6 +14,10 @@ def datetimearg(s):
     return datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
 
 
+def datearg(s):
+    return datetime.strptime(s, '%Y-%m-%d')
+
+
 def parse_hourly_etl_args(etl_name):
     parser = argparse.ArgumentParser(description='Runs the %s ETL from BigQuery to MongoDB for '
                                                  'a given time range' % etl_name)
@@ -25,6 +29,9 @@ def parse_hourly_etl_args(etl_name):
                         help='End of ETL range. UTC datetime hour w/ format %Y-%m-%d %H:%M:%S. '
                              'Range is open-ended, i.e. exclusive of end datetime',
                         type=datetimearg)
+    parser.add_argument('--bypass-cache',
+                        help='Re-run BigQuery queries even if their results are in the local query result cache',
+                        action='store_true')
     args = parser.parse_args()
     now = datetime.utcnow()
     end = datetime(now.year, now.month, now.day, now.hour, 0, 0)
@@ -36,4 +43,57 @@ def parse_hourly_etl_args(etl_name):
     if args.start > args.end:
         raise ValueError('Start cannot be after end')
 
-    return args
\ No newline at end of file
+    return args
+
+
+def parse_daily_backfill_args(etl_name):
+    parser = argparse.ArgumentParser(description='Backfills the %s ETL for a range of days' % etl_name)
+    parser.add_argument('--start', required=True, type=datearg,
+                        help='First day to backfill, w/ format %%Y-%%m-%%d. Inclusive.')
+    parser.add_argument('--end', required=True, type=datearg,
+                        help='Day to stop backfilling at, w/ format %%Y-%%m-%%d. Exclusive.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of partitions backfilled at once')
+    parser.add_argument('--days-per-partition', type=int, default=7,
+                        help='Number of consecutive days in each partition')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='Roll up each partition in one aggregation grouped by day, rather than one per day')
+    parser.add_argument('--merge', action='store_true',
+                        help='$merge results server-side instead of upserting them from Python. Needs MongoDB >= 4.2')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Stream aggregation results & load them this many rows at a time')
+    parser.add_argument('--state-file', default=None,
+                        help='JSON file recording finished days, so an interrupted backfill resumes. '
+                             'Defaults to a file in ~/logs named after the range')
+    args = parser.parse_args()
+    if args.start >= args.end:
+        raise ValueError('Start must be before end')
+    return args
+
+
+def parse_hourly_backfill_args(etl_name, step_names):
+    parser = argparse.ArgumentParser(description='Backfills the %s ETLs for a range of hours' % etl_name)
+    parser.add_argument('--start', required=True, type=datetimearg,
+                        help='First hour to backfill, w/ format %%Y-%%m-%%d %%H:%%M:%%S. Inclusive.')
+    parser.add_argument('--end', required=True, type=datetimearg,
+                        help='Hour to stop backfilling at, w/ format %%Y-%%m-%%d %%H:%%M:%%S. Exclusive.')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of hours backfilled at once')
+    parser.add_argument('--steps', type=lambda s: [name.strip() for name in s.split(',') if name.strip()],
+                        default=None,
+                        help='Comma separated steps to run, default is all of: %s' % ', '.join(step_names))
+    parser.add_argument('--priority', choices=['BATCH', 'INTERACTIVE'], default='BATCH',
+                        help='BigQuery job priority. Default is BATCH, which leaves interactive slots to the '
+                             'live hourly ETL.')
+    parser.add_argument('--bypass-cache', action='store_true',
+                        help='Re-run queries even if results are in the local query result cache')
+    parser.add_argument('--state-file', default=None,
+                        help='JSON file recording finished hours, so an interrupted backfill resumes. '
+                             'Defaults to a file in ~/logs named after the range')
+    args = parser.parse_args()
+    if args.start >= args.end:
+        raise ValueError('Start must be before end')
+    unknown = set(args.steps or []) - set(step_names)
+    if unknown:
+        parser.error('Unknown steps %s, must be in %s' % (', '.join(sorted(unknown)), ', '.join(step_names)))
+    return args